@@ -19,5 +19,67 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings (SQLite connections are not pooled)
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+# seconds after which a connection is replaced, -1 keeps connections forever
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+# seconds to wait for a free connection before giving up
+DATABASE_POOL_TIMEOUT = int(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+# test connections with a lightweight ping when they are checked out
+DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_PRE_PING", "true").lower() == "true"
+
+# Read replicas as a comma separated list of URIs, GET routes read from them
+DATABASE_REPLICA_URIS = [
+    uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri
+]
+SQLALCHEMY_BINDS = {
+    "replica_{0}".format(i): uri for i, uri in enumerate(DATABASE_REPLICA_URIS)
+}
+# seconds a client keeps reading from the primary after a write
+REPLICA_LAG_WINDOW = float(os.getenv("REPLICA_LAG_WINDOW", "5"))
+
+# Shards as a comma separated list of URIs, wishlists are spread by user_id.
+# Only append new shards at the end, the position names the shard.
+DATABASE_SHARD_URIS = [
+    uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri
+]
+SQLALCHEMY_BINDS.update({
+    "shard_{0}".format(i): uri for i, uri in enumerate(DATABASE_SHARD_URIS)
+})
+
+# Readiness probe: seconds a database ping is reused, and the share of the
+# connection pool checked out from which the service reports it is not ready
+HEALTH_CHECK_TTL = float(os.getenv("HEALTH_CHECK_TTL", "5"))
+HEALTH_MAX_POOL_SATURATION = float(os.getenv("HEALTH_MAX_POOL_SATURATION", "1.0"))
+
+# Inventory service the refresher checks products against (flask refresh-inventory):
+# items per request, requests in flight, seconds per request, retries per request
+INVENTORY_URL = os.getenv("INVENTORY_URL")
+INVENTORY_BATCH_SIZE = int(os.getenv("INVENTORY_BATCH_SIZE", "500"))
+INVENTORY_CONCURRENCY = int(os.getenv("INVENTORY_CONCURRENCY", "4"))
+INVENTORY_TIMEOUT = float(os.getenv("INVENTORY_TIMEOUT", "5"))
+INVENTORY_RETRIES = int(os.getenv("INVENTORY_RETRIES", "3"))
+
+# Change feed: seconds after which only the latest change of an entity is kept,
+# and seconds deletions are kept (flask compact-changes)
+CHANGES_COMPACT_AFTER = float(os.getenv("CHANGES_COMPACT_AFTER", "3600"))
+CHANGES_RETENTION = float(os.getenv("CHANGES_RETENTION", str(7 * 24 * 3600)))
+
+# Delta sync (GET /wishlists?user_id=&since=): seconds a sync overlaps the previous
+# one, longer than any write transaction and the clock skew between servers
+SYNC_WATERMARK_LAG = float(os.getenv("SYNC_WATERMARK_LAG", "5"))
+
+# Event streams (GET /events): seconds between polls of the change feed, seconds
+# between heartbeats, notifications a stream may fall behind, streams per worker
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1"))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "1000"))
+
+# Idempotency-Key of POST requests: seconds a response is replayed, responses kept
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", str(24 * 3600)))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -0,0 +1,34 @@
+"""
+Gunicorn production profile for the Wishlists Service
+
+The app is loaded and warmed up once in the master process, then the
+garbage collector is frozen before the workers are forked. Workers start
+serving right away, and the pages holding the app stay shared with the
+master instead of being copied by every worker (a gc pass writes to every
+object it visits, which would unshare them).
+
+  gunicorn -c gunicorn.conf.py
+
+Database connections opened while loading are closed before forking, and
+every worker starts with a fresh connection pool (see models/pool.py).
+"""
+import gc
+import os
+
+wsgi_app = "service:app"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:{0}".format(os.getenv("PORT", "3000")))
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+preload_app = True
+
+def when_ready(server):
+  """Runs in the master once the app is loaded, before the first fork"""
+  from service import app
+  from service.routes import warm_up
+  warm_up(app)
+  gc.collect()
+  gc.freeze()
+  server.log.info("App warmed up, %d objects frozen", gc.get_freeze_count())
@@ -15,25 +15,49 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+create_app() creates and configures the Flask app and sets up the logging
+and SQL database. The module level app used by service:app is created on
+first access, so importing the package stays cheap and never connects to
+the database. Tables are created with the flask create-db command.
 """
-import os
-import sys
 import logging
-from flask import Flask
+import threading
 
-from service.models.model_utils import JsonEncoder
+_app_lock = threading.Lock()
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
-app.json_encoder = JsonEncoder
-# Import the rutes After the Flask app is created
-from service import routes
+def create_app(config=None):
+  """Creates the Flask app
 
-# Set up logging for production
-if __name__ != "__main__":
+  config overrides the settings of config.py, it is a mapping, an object
+  or an import name.
+  """
+  from flask import Flask
+  from service.models.model_utils import JsonEncoder, db
+  from service.models import idempotency, unit_of_work
+  from service import routes, commands, health, events
+
+  # Create Flask application
+  app = Flask(__name__)
+  app.config.from_object("config")
+  if isinstance(config, dict):
+    app.config.from_mapping(config)
+  elif config is not None:
+    app.config.from_object(config)
+  app.json_encoder = JsonEncoder
+
+  db.init_app(app)
+  unit_of_work.init_app(app)
+  idempotency.init_app(app)
+  routes.init_app(app)
+  commands.init_app(app)
+  health.init_app(app)
+  events.init_app(app)
+  _init_logging(app)
+  app.logger.info("Service inititalized!")
+  return app
+
+def _init_logging(app):
+  # Set up logging for production
   gunicorn_logger = logging.getLogger("gunicorn.error")
   app.logger.handlers = gunicorn_logger.handlers
   app.logger.setLevel(gunicorn_logger.level)
@@ -46,15 +70,15 @@ if __name__ != "__main__":
     handler.setFormatter(formatter)
   app.logger.info("Logging handler established")
 
-app.logger.info(70 * "*")
-app.logger.info("  WISHLISTS   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-  routes.init_db(app)  # make our sqlalchemy tables
-except Exception as error:
-  app.logger.critical("%s: Cannot continue", error)
-  # gunicorn requires exit code 4 to stop spawning workers when they die
-  sys.exit(4)
+  app.logger.info(70 * "*")
+  app.logger.info("  WISHLISTS   S E R V I C E   R U N N I N G  ".center(70, "*"))
+  app.logger.info(70 * "*")
 
-app.logger.info("Service inititalized!")
+def __getattr__(name):
+  """Creates the module level app the first time it is used"""
+  if name != "app":
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+  with _app_lock:
+    if "app" not in globals():
+      globals()["app"] = create_app()
+  return globals()["app"]
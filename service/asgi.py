@@ -0,0 +1,452 @@
+"""
+Asynchronous Wishlists Service
+
+Serves the route contract of service.routes with async handlers on an ASGI
+server, so a worker keeps serving other requests while it waits on the
+database:
+
+  uvicorn service.asgi:app --port 3000
+
+Queries are SQLAlchemy Core statements on the model tables, run on an async
+driver through the databases package (asyncpg for PostgreSQL, aiosqlite for
+SQLite). Payloads are validated and serialized by the same models and
+Swagger models as the Flask routes. Read replicas and shards are not
+supported in this mode, every query goes to DATABASE_URI. The bulk cart
+routes, POST /inventory/events, POST /batch, the clone, merge and summary
+routes, GET /changes and GET /events are only served by the Flask app, but
+every write here adds its changes to the same outbox. Idempotency-Key
+headers are only honoured by the Flask app.
+
+Paths:
+
+GET /info
+GET, POST /wishlists (GET with ?user_id= or ?ids=1,2,3)
+GET, PUT, DELETE /wishlists/{wishlist_id}
+GET, POST, DELETE /wishlists/{wishlist_id}/products (GET with ?sort=, ?after=, ?limit=,
+  ?status= and ?in_cart_status=, POST with ?upsert=true)
+GET, PUT, PATCH, DELETE /wishlists/{wishlist_id}/products/{product_id}
+PUT /wishlists/{wishlist_id}/products/{product_id}/add-to-cart
+GET /products?ids=1,2,3
+"""
+
+import sqlite3
+from datetime import datetime
+
+from asyncpg.exceptions import IntegrityConstraintViolationError
+from databases import Database
+from flask_restx import inputs, marshal
+from sqlalchemy import and_, asc
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from . import app as flask_app
+from . import status  # HTTP Status Codes
+from service.models.model_utils import Availability, DataValidationError, InCartStatus
+from service.models.product import Product, DEFAULT_PAGE_SIZE, UPSERT_FIELDS
+from service.models.wishlist import Wishlist, WishlistVo
+from service.models import outbox, sharding
+from service.routes import conflict_message, full_product_model, full_wishlist_model, \
+  parse_ids, product_page_model, wishlist_vo
+
+WISHLISTS = Wishlist.__table__
+PRODUCTS = Product.__table__
+# columns written by create and update of a product, updated_at aside: the async
+# driver does not run the column defaults, every write sets it
+PRODUCT_FIELDS = ("name", "price", "status", "pic_url", "short_desc",
+  "inventory_product_id", "wishlist_id")
+
+######################################################################
+# DATABASE
+######################################################################
+def _database_options(uri:str) -> dict:
+  """Returns the async pool options matching the sync pool settings"""
+  if not uri.startswith("postgres"):
+    return {}
+  config = flask_app.config
+  return {
+    "min_size": 1,
+    "max_size": config['DATABASE_POOL_SIZE'] + config['DATABASE_MAX_OVERFLOW'],
+  }
+
+async def connect():
+  """Opens the database connection pool"""
+  if sharding.shard_keys(flask_app):
+    raise RuntimeError("Shards are not supported by the ASGI service")
+  uri = flask_app.config['SQLALCHEMY_DATABASE_URI']
+  app.state.database = Database(uri, **_database_options(uri))
+  await app.state.database.connect()
+
+async def disconnect():
+  """Closes the database connection pool"""
+  await app.state.database.disconnect()
+
+def _db(request) -> Database:
+  return request.app.state.database
+
+def _dialect(database) -> str:
+  return "postgresql" if database.url.dialect.startswith("postgres") else database.url.dialect
+
+async def _record(database, entity:str, action:str, entity_id:int, wishlist_id:int,
+  user_id:int=None):
+  """Writes a change to the outbox, call it in the transaction of the change"""
+  await database.execute(outbox.insert_changes(_dialect(database), entity, action,
+    [(entity_id, wishlist_id)], user_id))
+
+async def _record_matching(database, table, action:str, where):
+  """Writes the changes of the rows matching where, before deleting them"""
+  await database.execute(outbox.insert_matching(_dialect(database), table, action, where))
+
+async def _find_wishlist(database, wishlist_id:int):
+  row = await database.fetch_one(WISHLISTS.select().where(WISHLISTS.c.id == wishlist_id))
+  return Wishlist(**dict(row)) if row else None
+
+async def _find_product(database, wishlist_id:int, product_id:int):
+  row = await database.fetch_one(PRODUCTS.select().where(and_(
+    PRODUCTS.c.wishlist_id == wishlist_id, PRODUCTS.c.id == product_id)))
+  return Product(**dict(row)) if row else None
+
+async def _read_wishlists(database, query) -> list:
+  """Returns the serialized wishlists of a query with their products"""
+  wishlists = [Wishlist(**dict(row)) for row in await database.fetch_all(query)]
+  products = {wishlist.id: [] for wishlist in wishlists}
+  if products:
+    rows = await database.fetch_all(PRODUCTS.select()
+      .where(PRODUCTS.c.wishlist_id.in_(list(products))).order_by(asc(PRODUCTS.c.id)))
+    for row in rows:
+      products[row['wishlist_id']].append(Product(**dict(row)))
+  return [WishlistVo(w, products[w.id]).serialize() for w in wishlists]
+
+######################################################################
+# REQUEST HELPERS
+######################################################################
+def _ids(request, *names) -> list:
+  values = [request.path_params[name] for name in names]
+  if not all(value.isdigit() for value in values):
+    if len(names) == 1:
+      raise HTTPException(status.HTTP_400_BAD_REQUEST,
+        "Integer value expected for field: Wishlist ID")
+    raise HTTPException(status.HTTP_400_BAD_REQUEST,
+      "Integer field expected for fields: Wishlist ID and Product ID")
+  return [int(value) for value in values]
+
+async def _payload(request) -> dict:
+  if request.headers.get("Content-Type") != "application/json":
+    raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+      "Unsupported media type : application/json expected")
+  try:
+    data = await request.json()
+  except ValueError:
+    data = None
+  if not isinstance(data, dict):
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, "Expected a json request body")
+  return data
+
+def _enum(request, name:str, enum):
+  value = request.query_params.get(name)
+  if value is not None and value not in enum.__members__:
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid {0}: {1}".format(name, value))
+  return enum[value] if value is not None else None
+
+def _json(data, model, status_code=status.HTTP_200_OK, headers=None):
+  return JSONResponse(marshal(data, model), status_code=status_code, headers=headers)
+
+def _no_content():
+  return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+######################################################################
+# GET HEALTH CHECK
+######################################################################
+async def info(request):
+  """ API info"""
+  return JSONResponse({"name": "Wishlists REST API Service", "version": "1.0"})
+
+######################################################################
+#  PATH: /wishlists
+######################################################################
+async def list_wishlists(request):
+  """List on Wishlists, optionally filtered by user_id or ids"""
+  query = WISHLISTS.select().order_by(asc(WISHLISTS.c.id))
+  user_id = request.query_params.get("user_id")
+  ids = request.query_params.get("ids")
+  if ids is not None:
+    query = query.where(WISHLISTS.c.id.in_(parse_ids(ids)))
+  elif user_id:
+    try:
+      query = query.where(WISHLISTS.c.user_id == int(user_id))
+    except ValueError:
+      raise HTTPException(status.HTTP_400_BAD_REQUEST, "Integer value expected for user_id")
+  return _json(await _read_wishlists(_db(request), query), wishlist_vo)
+
+async def create_wishlist(request):
+  """Create on Wishlists"""
+  data = await _payload(request)
+  wishlist = Wishlist()
+  wishlist.deserialize(data)
+  database = _db(request)
+  async with database.transaction():
+    wishlist.id = await database.execute(
+      WISHLISTS.insert().values(name=wishlist.name, user_id=wishlist.user_id,
+        updated_at=datetime.utcnow()))
+    await _record(database, outbox.WISHLIST, outbox.CREATED, wishlist.id, wishlist.id,
+      wishlist.user_id)
+  location_url = request.url_for("wishlist", wishlist_id=wishlist.id)
+  return _json(wishlist.serialize(), full_wishlist_model, status.HTTP_201_CREATED,
+    {"Location": location_url})
+
+######################################################################
+#  PATH: /wishlists/{wishlist_id}
+######################################################################
+async def get_wishlist(request):
+  """Read on Wishlists"""
+  wishlist_id, = _ids(request, "wishlist_id")
+  res = await _read_wishlists(_db(request),
+    WISHLISTS.select().where(WISHLISTS.c.id == wishlist_id))
+  if not res:
+    raise HTTPException(status.HTTP_404_NOT_FOUND,
+      "Wishlist with id {} was not found".format(wishlist_id))
+  return _json(res[0], wishlist_vo)
+
+async def rename_wishlist(request):
+  """Update on Wishlists"""
+  data = await _payload(request)
+  wishlist_id, = _ids(request, "wishlist_id")
+  database = _db(request)
+  async with database.transaction():
+    wishlist = await _find_wishlist(database, wishlist_id)
+    if not wishlist:
+      raise HTTPException(status.HTTP_404_NOT_FOUND,
+        "Wishlist with id '{}' was not found.".format(wishlist_id))
+    if "name" not in data or not isinstance(data["name"], str):
+      raise HTTPException(status.HTTP_400_BAD_REQUEST, "name field is wrong")
+
+    taken = [row['name'] for row in await database.fetch_all(
+      WISHLISTS.select().where(WISHLISTS.c.user_id == wishlist.user_id))]
+    data['name'] = Wishlist.unique_name(data['name'], taken)
+    wishlist_fields = wishlist.serialize()
+    wishlist_fields.update(data)
+    wishlist.deserialize(wishlist_fields)
+    await database.execute(WISHLISTS.update().where(WISHLISTS.c.id == wishlist_id)
+      .values(name=wishlist.name, user_id=wishlist.user_id, updated_at=datetime.utcnow()))
+    await _record(database, outbox.WISHLIST, outbox.UPDATED, wishlist_id, wishlist_id,
+      wishlist.user_id)
+  return _json(wishlist.serialize(), full_wishlist_model)
+
+async def delete_wishlist(request):
+  """Delete on Wishlists"""
+  wishlist_id, = _ids(request, "wishlist_id")
+  database = _db(request)
+  async with database.transaction():
+    await _record_matching(database, PRODUCTS, outbox.DELETED,
+      PRODUCTS.c.wishlist_id == wishlist_id)
+    await database.execute(PRODUCTS.delete().where(PRODUCTS.c.wishlist_id == wishlist_id))
+    await _record_matching(database, WISHLISTS, outbox.DELETED, WISHLISTS.c.id == wishlist_id)
+    await database.execute(WISHLISTS.delete().where(WISHLISTS.c.id == wishlist_id))
+  return _no_content()
+
+######################################################################
+#  PATH: /wishlists/{wishlist_id}/products
+######################################################################
+async def list_wishlist_products(request):
+  """List on Products, sorted, filtered and paginated"""
+  wishlist_id, = _ids(request, "wishlist_id")
+  params = request.query_params
+  sort = params.get("sort", "id")
+  try:
+    limit = int(params.get("limit", DEFAULT_PAGE_SIZE))
+  except ValueError:
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, "Integer value expected for limit")
+  query = Product.page_statement(wishlist_id, sort, params.get("after"), limit,
+    _enum(request, "status", Availability), _enum(request, "in_cart_status", InCartStatus))
+  database = _db(request)
+  if await _find_wishlist(database, wishlist_id) is None:
+    raise HTTPException(status.HTTP_404_NOT_FOUND,
+      "Wishlist with id {} was not found".format(wishlist_id))
+  products, cursor = Product.page_of(await database.fetch_all(query), sort, limit)
+  return _json({"products": [product.serialize() for product in products], "next": cursor},
+    product_page_model)
+
+async def create_product(request):
+  """Create on Products"""
+  data = await _payload(request)
+  wishlist_id, = _ids(request, "wishlist_id")
+  data['wishlist_id'] = wishlist_id
+  try:
+    upsert = inputs.boolean(request.query_params.get("upsert", "false"))
+  except ValueError as error:
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, str(error))
+  product = Product()
+  product.deserialize(data)
+  product.in_cart_status = InCartStatus.DEFAULT
+  values = {field: getattr(product, field) for field in PRODUCT_FIELDS}
+  values.update(in_cart_status=product.in_cart_status, updated_at=datetime.utcnow())
+  database = _db(request)
+  async with database.transaction():
+    if upsert:
+      product, created = await _upsert_product(database, values)
+    else:
+      product.id, created = await database.execute(PRODUCTS.insert().values(**values)), True
+    await _record(database, outbox.PRODUCT, outbox.CREATED if created else outbox.UPDATED,
+      product.id, wishlist_id)
+  location_url = request.url_for("product", wishlist_id=wishlist_id, product_id=product.id)
+  return _json(product.serialize(), full_product_model,
+    status.HTTP_201_CREATED if created else status.HTTP_200_OK, {"Location": location_url})
+
+async def _upsert_product(database, values:dict) -> tuple:
+  """Inserts or overwrites the product of a wishlist, returns it and whether it was created"""
+  if database.url.dialect.startswith("postgres"):
+    row = dict(await database.fetch_one(Product.upsert_statement(values)))
+    created = row.pop("created")
+    return Product(**row), created
+  # the UPDATE takes the write lock first, nothing is inserted in between
+  match = Product.upsert_match(values)
+  await database.execute(PRODUCTS.update().where(match)
+    .values({name: values[name] for name in UPSERT_FIELDS}))
+  row = await database.fetch_one(PRODUCTS.select().where(match))
+  created = row is None
+  if created:
+    await database.execute(PRODUCTS.insert().values(**values))
+    row = await database.fetch_one(PRODUCTS.select().where(match))
+  return Product(**dict(row)), created
+
+async def delete_products(request):
+  """Action "Delete All" on Products"""
+  wishlist_id, = _ids(request, "wishlist_id")
+  database = _db(request)
+  async with database.transaction():
+    await _record_matching(database, PRODUCTS, outbox.DELETED,
+      PRODUCTS.c.wishlist_id == wishlist_id)
+    await database.execute(PRODUCTS.delete().where(PRODUCTS.c.wishlist_id == wishlist_id))
+  return _no_content()
+
+######################################################################
+#  PATH: /wishlists/{wishlist_id}/products/{product_id}
+######################################################################
+async def get_product(request):
+  """Read on Products"""
+  wishlist_id, product_id = _ids(request, "wishlist_id", "product_id")
+  product = await _find_product(_db(request), wishlist_id, product_id)
+  if not product:
+    raise HTTPException(status.HTTP_404_NOT_FOUND, f"Product with wishlist_id {wishlist_id} "\
+      f"and id {product_id} was not found in Product db")
+  return _json(product.serialize(), full_product_model)
+
+async def update_product(request):
+  """Update on Products"""
+  wishlist_id, product_id = _ids(request, "wishlist_id", "product_id")
+  data = await _payload(request)
+  database = _db(request)
+  async with database.transaction():
+    product = await _find_product(database, wishlist_id, product_id)
+    if not product:
+      raise HTTPException(status.HTTP_404_NOT_FOUND, f"Product with id {product_id} not found")
+    product_fields = product.serialize()
+    product_fields.update(data)
+    product.deserialize(product_fields)
+    await database.execute(PRODUCTS.update().where(PRODUCTS.c.id == product_id)
+      .values({field: getattr(product, field) for field in PRODUCT_FIELDS},
+        updated_at=datetime.utcnow()))
+    await _record(database, outbox.PRODUCT, outbox.UPDATED, product_id, product.wishlist_id)
+  return _json(product.serialize(), full_product_model)
+
+async def patch_product(request):
+  """Partial update on Products"""
+  wishlist_id, product_id = _ids(request, "wishlist_id", "product_id")
+  values = Product.validate_patch(await _payload(request))
+  database = _db(request)
+  match = and_(PRODUCTS.c.wishlist_id == wishlist_id, PRODUCTS.c.id == product_id)
+  update = PRODUCTS.update().where(match).values(updated_at=datetime.utcnow(), **values)
+  async with database.transaction():
+    if database.url.dialect.startswith("postgres"):
+      row = await database.fetch_one(update.returning(*PRODUCTS.c))
+    else:
+      await database.execute(update)
+      row = await database.fetch_one(PRODUCTS.select().where(match))
+    if row:
+      await _record(database, outbox.PRODUCT, outbox.UPDATED, product_id, wishlist_id)
+  if not row:
+    raise HTTPException(status.HTTP_404_NOT_FOUND, f"Product with id {product_id} not found")
+  return _json(Product(**dict(row)).serialize(), full_product_model)
+
+async def delete_product(request):
+  """Delete on Products"""
+  wishlist_id, product_id = _ids(request, "wishlist_id", "product_id")
+  database = _db(request)
+  match = and_(PRODUCTS.c.wishlist_id == wishlist_id, PRODUCTS.c.id == product_id)
+  async with database.transaction():
+    await _record_matching(database, PRODUCTS, outbox.DELETED, match)
+    await database.execute(PRODUCTS.delete().where(match))
+  return _no_content()
+
+async def add_to_cart(request):
+  """Action "Move" on Products"""
+  wishlist_id, product_id = _ids(request, "wishlist_id", "product_id")
+  database = _db(request)
+  async with database.transaction():
+    product = await _find_product(database, wishlist_id, product_id)
+    if not product:
+      raise HTTPException(status.HTTP_404_NOT_FOUND,
+        f"Product with id {product_id} was not found in wishlist with id {wishlist_id}")
+    product.in_cart_status = InCartStatus.IN_CART
+    await database.execute(PRODUCTS.update().where(PRODUCTS.c.id == product_id)
+      .values(in_cart_status=product.in_cart_status, updated_at=datetime.utcnow()))
+    await _record(database, outbox.PRODUCT, outbox.UPDATED, product_id, wishlist_id)
+  return _json(product.serialize(), full_product_model)
+
+######################################################################
+#  PATH: /products
+######################################################################
+async def list_products(request):
+  """Read on many Products"""
+  query = PRODUCTS.select().where(
+    PRODUCTS.c.id.in_(parse_ids(request.query_params.get("ids", "")))).order_by(asc(PRODUCTS.c.id))
+  availability = _enum(request, "status", Availability)
+  if availability is not None:
+    query = query.where(PRODUCTS.c.status == availability)
+  rows = await _db(request).fetch_all(query)
+  return _json([Product(**dict(row)).serialize() for row in rows], full_product_model)
+
+######################################################################
+# ERROR HANDLERS
+######################################################################
+async def handle_http_exception(request, error):
+  return JSONResponse({"message": error.detail}, status_code=error.status_code)
+
+async def handle_bad_request(request, error):
+  return JSONResponse({"message": error.args[0]}, status_code=status.HTTP_400_BAD_REQUEST)
+
+async def handle_conflict(request, error):
+  return JSONResponse({"message": conflict_message(error)}, status_code=status.HTTP_409_CONFLICT)
+
+app = Starlette(
+  routes=[
+    Route("/info", info),
+    Route("/wishlists", list_wishlists, methods=["GET"]),
+    Route("/wishlists", create_wishlist, methods=["POST"]),
+    Route("/wishlists/{wishlist_id}", get_wishlist, methods=["GET"], name="wishlist"),
+    Route("/wishlists/{wishlist_id}", rename_wishlist, methods=["PUT"]),
+    Route("/wishlists/{wishlist_id}", delete_wishlist, methods=["DELETE"]),
+    Route("/wishlists/{wishlist_id}/products", list_wishlist_products, methods=["GET"]),
+    Route("/wishlists/{wishlist_id}/products", create_product, methods=["POST"]),
+    Route("/wishlists/{wishlist_id}/products", delete_products, methods=["DELETE"]),
+    Route("/wishlists/{wishlist_id}/products/{product_id}", get_product, methods=["GET"],
+      name="product"),
+    Route("/wishlists/{wishlist_id}/products/{product_id}", update_product, methods=["PUT"]),
+    Route("/wishlists/{wishlist_id}/products/{product_id}", patch_product, methods=["PATCH"]),
+    Route("/wishlists/{wishlist_id}/products/{product_id}", delete_product,
+      methods=["DELETE"]),
+    Route("/wishlists/{wishlist_id}/products/{product_id}/add-to-cart", add_to_cart,
+      methods=["PUT"]),
+    Route("/products", list_products, methods=["GET"]),
+  ],
+  exception_handlers={
+    HTTPException: handle_http_exception,
+    DataValidationError: handle_bad_request,
+    TypeError: handle_bad_request,
+    IntegrityConstraintViolationError: handle_conflict,
+    sqlite3.IntegrityError: handle_conflict,
+  },
+  on_startup=[connect],
+  on_shutdown=[disconnect],
+)
@@ -0,0 +1,198 @@
+"""
+Flask CLI commands for the Wishlists Service
+
+Commands:
+
+flask create-db -- Create the database tables, columns and indexes, on every shard too
+flask seed -- Bulk load a synthetic dataset of wishlists and products
+flask rebalance-shards -- Move wishlists to the shard owning their user
+flask refresh-inventory -- Refresh the status and price of products from the inventory
+flask compact-changes -- Drop superseded and expired changes from the change feed
+flask prune-idempotency-keys -- Drop expired and surplus idempotency keys
+"""
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, exists, inspect
+
+from service.models import idempotency, outbox, sharding
+from service.models.model_utils import db
+from service.models.seeding import SeedOptions, bulk_seed, DEFAULT_BATCH_SIZE, \
+  DEFAULT_CHUNK_SIZE
+
+######################################################################
+# CREATE THE DATABASE
+######################################################################
+def drop_duplicates(engine, index) -> int:
+  """Drops the rows a unique index would reject, keeps the newest of each, returns the number
+
+  Dropped wishlists and products are recorded in the change feed.
+  """
+  table = index.table
+  newer = table.alias("newer")
+  duplicate = exists().where(and_(newer.c.id > table.c.id,
+    *[newer.c[column.name] == column for column in index.columns]))
+  with engine.begin() as connection:
+    if table.name in (outbox.WISHLIST, outbox.PRODUCT):
+      connection.execute(outbox.insert_matching(engine.dialect.name, table, outbox.DELETED,
+        duplicate))
+    return connection.execute(table.delete().where(duplicate)).rowcount
+
+def create_indexes(engine) -> int:
+  """Creates the indexes added to the models after their tables were created
+
+  Returns the number of duplicate rows dropped to create the unique ones.
+  """
+  inspector = inspect(engine)
+  dropped = 0
+  for table in db.Model.metadata.sorted_tables:
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+      if index.name not in existing:
+        if index.unique:
+          dropped += drop_duplicates(engine, index)
+        index.create(bind=engine)
+  return dropped
+
+def create_columns(engine):
+  """Adds the nullable columns added to the models after their tables were created"""
+  inspector = inspect(engine)
+  preparer = engine.dialect.identifier_preparer
+  for table in db.Model.metadata.sorted_tables:
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+      if column.name not in existing:
+        engine.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(preparer.format_table(table),
+          preparer.format_column(column), column.type.compile(dialect=engine.dialect)))
+
+def create_tables() -> int:
+  """Creates the tables, the columns and the indexes that do not exist yet
+
+  Returns the number of duplicate rows dropped to create the unique indexes.
+  """
+  db.create_all()
+  sharding.create_all(db)
+  dropped = 0
+  for engine in [db.engine] + [sharding.shard_engine(key) for key in sharding.shard_keys()]:
+    create_columns(engine)
+    dropped += create_indexes(engine)
+  return dropped
+
+@click.command("create-db")
+@with_appcontext
+def create_db_command():
+  """Create the database tables, on every shard too"""
+  dropped = create_tables()
+  if dropped:
+    click.echo("Dropped {0} duplicate rows, keeping the newest of each".format(dropped))
+  click.echo("Database tables created")
+
+######################################################################
+# SEED THE DATABASE
+######################################################################
+@click.command("seed")
+@click.option("--wishlists", default=1000, show_default=True,
+  help="Number of wishlists to create.")
+@click.option("--users", default=None, type=int,
+  help="Number of distinct user ids [default: wishlists / 3].")
+@click.option("--avg-products", default=8.0, show_default=True,
+  help="Average number of products per wishlist (Pareto distributed).")
+@click.option("--max-products", default=500, show_default=True,
+  help="Upper bound of products in one wishlist.")
+@click.option("--catalog-size", default=100000, show_default=True,
+  help="Number of distinct inventory_product_ids (Zipf distributed popularity).")
+@click.option("--seed", default=0, show_default=True,
+  help="Random seed, the same seed always produces the same dataset.")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True,
+  help="Number of processes generating data.")
+@click.option("--chunk-size", default=DEFAULT_CHUNK_SIZE, show_default=True,
+  help="Wishlists generated per work item.")
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True,
+  help="Rows per INSERT statement when COPY is not available.")
+@with_appcontext
+def seed_command(wishlists, users, avg_products, max_products, catalog_size, seed,\
+  workers, chunk_size, batch_size):
+  """Bulk load a synthetic dataset of wishlists and products"""
+  create_tables()
+  options = SeedOptions(wishlists, users=users, seed=seed, avg_products=avg_products,
+    max_products=max_products, catalog_size=catalog_size, chunk_size=chunk_size)
+  start = time.perf_counter()
+  wishlist_cnt, product_cnt = bulk_seed(options, workers=workers, batch_size=batch_size)
+  elapsed = time.perf_counter() - start
+  click.echo("Created {0} wishlists and {1} products in {2:.1f}s ({3:.0f} rows/s)".format(
+    wishlist_cnt, product_cnt, elapsed, (wishlist_cnt + product_cnt) / max(elapsed, 1e-9)))
+
+######################################################################
+# REBALANCE SHARDS
+######################################################################
+@click.command("rebalance-shards")
+@with_appcontext
+def rebalance_shards_command():
+  """Move wishlists to the shard owning their user after adding shards"""
+  if not sharding.shard_keys():
+    raise click.ClickException("No shards configured, set DATABASE_SHARD_URIS")
+  sharding.create_all(db)
+  moved = sharding.rebalance()
+  click.echo("Moved {0} wishlists".format(moved))
+
+######################################################################
+# REFRESH THE INVENTORY
+######################################################################
+@click.command("refresh-inventory")
+@click.option("--interval", default=0.0, show_default=True,
+  help="Seconds between two refreshes, refresh once if 0.")
+@with_appcontext
+def refresh_inventory_command(interval):
+  """Refresh the status and price of products from the inventory service"""
+  if not current_app.config.get("INVENTORY_URL"):
+    raise click.ClickException("No inventory service configured, set INVENTORY_URL")
+  # imported here, the app does not load requests unless it refreshes
+  from service import refresher
+  client = refresher.client_for(current_app)
+  try:
+    while True:
+      start = time.perf_counter()
+      result = refresher.refresh(client, batch_size=current_app.config["INVENTORY_BATCH_SIZE"],
+        concurrency=current_app.config["INVENTORY_CONCURRENCY"])
+      elapsed = time.perf_counter() - start
+      click.echo("Checked {items} inventory products in {batches} batches, {failed} failed,"
+        " updated {updated} products in {0:.1f}s".format(elapsed, **result))
+      if not interval:
+        break
+      time.sleep(max(interval - elapsed, 0))
+  finally:
+    client.close()
+
+######################################################################
+# COMPACT THE CHANGE FEED
+######################################################################
+@click.command("compact-changes")
+@with_appcontext
+def compact_changes_command():
+  """Drop superseded and expired changes from the change feed"""
+  dropped = outbox.compact(current_app.config["CHANGES_COMPACT_AFTER"],
+    current_app.config["CHANGES_RETENTION"])
+  click.echo("Dropped {0} changes".format(dropped))
+
+######################################################################
+# PRUNE THE IDEMPOTENCY KEYS
+######################################################################
+@click.command("prune-idempotency-keys")
+@with_appcontext
+def prune_idempotency_keys_command():
+  """Drop expired idempotency keys and the oldest ones past the maximum"""
+  dropped = idempotency.prune(current_app.config["IDEMPOTENCY_KEY_TTL"],
+    current_app.config["IDEMPOTENCY_MAX_KEYS"])
+  click.echo("Dropped {0} idempotency keys".format(dropped))
+
+######################################################################
+# REGISTER THE COMMANDS
+######################################################################
+def init_app(app):
+  """Registers the commands on an app"""
+  for command in (create_db_command, seed_command, rebalance_shards_command,
+    refresh_inventory_command, compact_changes_command, prune_idempotency_keys_command):
+    app.cli.add_command(command)
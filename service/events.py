@@ -0,0 +1,241 @@
+"""
+Server-Sent Events streams of wishlist changes
+
+GET /events?wishlist_id=3 and GET /events?user_id=7 keep the response open
+and push a notification whenever the wishlist, or one of the user's
+wishlists, or one of their products changes:
+
+  event: change
+  data: {"entity": "product", "id": 12, "wishlist_id": 3, "action": "updated", ...}
+
+Every worker process runs a single poller thread. It reads the change
+feed (see models/outbox.py) every EVENTS_POLL_INTERVAL seconds and fans
+the changes out to the streams of the process, so the database serves one
+query per worker and interval whatever the number of subscribers. The
+poller starts with the first stream of the process and stops with the
+last one. Each change is encoded once and queued to the streams following
+its wishlist.
+
+A stream sends a comment every EVENTS_HEARTBEAT seconds when idle, which
+also finds out closed connections. A stream whose client falls more than
+EVENTS_QUEUE_SIZE notifications behind is closed, and the client
+reconnects. Streams start at the time they connect, clients fetch the
+current state after connecting and on every notification.
+
+A sync worker serves one request at a time, a stream would hold it until
+the worker timeout kills it. Streams are therefore refused with a 503
+unless the WSGI server runs requests concurrently (wsgi.multithread), as
+the gevent and gthread workers do.
+"""
+
+import json
+import os
+import queue
+import threading
+from collections import defaultdict
+
+from flask import current_app
+
+from service.models import outbox
+from service.models.model_utils import db
+from service.models.wishlist import Wishlist
+
+# milliseconds a client waits before reconnecting
+RETRY_MS = 3000
+HEARTBEAT = b": keep-alive\n\n"
+
+class SubscriberLimitError(Exception):
+  """Raised when a worker already serves EVENTS_MAX_SUBSCRIBERS streams"""
+
+def frame(change) -> bytes:
+  """Returns the event of a change, as sent on the streams"""
+  return "event: change\ndata: {0}\n\n".format(json.dumps(change.serialize())).encode()
+
+class Subscription:
+  """The notifications of one stream, queued by the poller until the stream sends them"""
+
+  def __init__(self, hub, user_id:int=None, size:int=100) -> None:
+    self.hub = hub
+    self.user_id = user_id
+    self.wishlist_ids = set()
+    self.size = size
+    # one more slot for the None closing an overflowing stream
+    self.queue = queue.Queue(size + 1)
+
+  def push(self, data:bytes) -> bool:
+    """Queues a notification, closes the stream and returns False once it is full"""
+    # the poller is the only producer, the size cannot grow in between
+    if self.queue.qsize() >= self.size:
+      self.queue.put_nowait(None)
+      return False
+    self.queue.put_nowait(data)
+    return True
+
+  def stream(self, heartbeat:float):
+    """Yields the notifications as they come, until closed"""
+    try:
+      yield "retry: {0}\n\n".format(RETRY_MS).encode()
+      while True:
+        try:
+          data = self.queue.get(timeout=heartbeat)
+        except queue.Empty:
+          yield HEARTBEAT
+          continue
+        if data is None:
+          return
+        yield data
+    finally:
+      self.hub.unsubscribe(self)
+
+class Hub:
+  """Follows the change feed for the streams of a process"""
+
+  def __init__(self, app) -> None:
+    self.app = app
+    self._reset()
+
+  def _reset(self):
+    # created again in every process, once gevent patched the threading module
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+    self._by_wishlist = defaultdict(set)
+    self._by_user = defaultdict(set)
+    self._subscriptions = set()
+    self._cursor = None
+    self._poller = None
+    self._stopping = threading.Event()
+
+  def __len__(self) -> int:
+    return len(self._subscriptions)
+
+  def subscribe(self, wishlist_ids:list=(), user_id:int=None) -> Subscription:
+    """Registers a stream following wishlists, or the wishlists of a user"""
+    if self._pid != os.getpid():
+      self._reset()
+    config = self.app.config
+    subscription = Subscription(self, user_id, config['EVENTS_QUEUE_SIZE'])
+    with self._lock:
+      if len(self._subscriptions) >= config['EVENTS_MAX_SUBSCRIBERS']:
+        raise SubscriberLimitError("Too many event streams, try again later")
+      self._subscriptions.add(subscription)
+      if user_id is not None:
+        self._by_user[user_id].add(subscription)
+      self._watch(subscription, wishlist_ids)
+      if self._cursor is None:
+        self._cursor = outbox.latest_cursor()
+      if self._poller is None:
+        self._stopping.clear()
+        self._poller = threading.Thread(target=self._run, name="events-poller", daemon=True)
+        self._poller.start()
+    return subscription
+
+  def watch(self, subscription:Subscription, wishlist_ids:list):
+    """Adds wishlists to the ones a stream follows"""
+    with self._lock:
+      if subscription in self._subscriptions:
+        self._watch(subscription, wishlist_ids)
+
+  def _watch(self, subscription:Subscription, wishlist_ids:list):
+    for wishlist_id in wishlist_ids:
+      subscription.wishlist_ids.add(wishlist_id)
+      self._by_wishlist[wishlist_id].add(subscription)
+
+  def unsubscribe(self, subscription:Subscription):
+    """Removes a stream, the poller stops with the last one"""
+    with self._lock:
+      self._remove(subscription)
+
+  def _remove(self, subscription:Subscription):
+    self._subscriptions.discard(subscription)
+    for wishlist_id in subscription.wishlist_ids:
+      followers = self._by_wishlist.get(wishlist_id)
+      if followers is not None:
+        followers.discard(subscription)
+        if not followers:
+          del self._by_wishlist[wishlist_id]
+    followers = self._by_user.get(subscription.user_id)
+    if followers is not None:
+      followers.discard(subscription)
+      if not followers:
+        del self._by_user[subscription.user_id]
+
+  def poll(self) -> int:
+    """Notifies the streams of the changes committed since the last poll, returns their number"""
+    read = 0
+    while True:
+      changes, self._cursor = outbox.read(self._cursor, outbox.MAX_LIMIT)
+      self._dispatch(changes)
+      read += len(changes)
+      if len(changes) < outbox.MAX_LIMIT:
+        return read
+
+  def _owners(self, changes:list) -> dict:
+    """Returns the user of every wishlist created in changes, if a user's stream may follow it"""
+    if not self._by_user:
+      return {}
+    created = [change.entity_id for change in changes
+      if change.entity == outbox.WISHLIST and change.action == outbox.CREATED]
+    if not created:
+      return {}
+    return {wishlist.id: wishlist.user_id for wishlist in Wishlist.find_all_by_ids(created)}
+
+  def _dispatch(self, changes:list):
+    owners = self._owners(changes)
+    with self._lock:
+      full = set()
+      for change in changes:
+        if change.wishlist_id in owners:
+          for subscription in self._by_user.get(owners[change.wishlist_id], ()):
+            self._watch(subscription, [change.wishlist_id])
+        followers = self._by_wishlist.get(change.wishlist_id)
+        if not followers:
+          continue
+        data = frame(change)
+        for subscription in followers - full:
+          if not subscription.push(data):
+            full.add(subscription)
+      for subscription in full:
+        current_app.logger.warning("Closing an event stream %s notifications behind",
+          subscription.size)
+        self._remove(subscription)
+
+  def _run(self):
+    interval = self.app.config['EVENTS_POLL_INTERVAL']
+    while not self._stopping.wait(interval):
+      with self._lock:
+        if not self._subscriptions:
+          # the next stream starts from the changes committed by then
+          self._cursor = None
+          self._poller = None
+          return
+      with self.app.app_context():
+        try:
+          self.poll()
+        except Exception: # pylint: disable=broad-except
+          current_app.logger.exception("Polling the change feed failed")
+        finally:
+          db.session.remove()
+
+  def stop(self):
+    """Stops the poller and closes every stream"""
+    self._stopping.set()
+    poller = self._poller
+    if poller is not None and poller is not threading.current_thread():
+      poller.join()
+    with self._lock:
+      for subscription in list(self._subscriptions):
+        try:
+          subscription.queue.put_nowait(None)
+        except queue.Full:
+          pass
+        self._remove(subscription)
+      self._cursor = None
+      self._poller = None
+
+def hub() -> Hub:
+  """Returns the hub of the current app"""
+  return current_app.extensions['events']
+
+def init_app(app):
+  """Gives an app its hub"""
+  app.extensions['events'] = Hub(app)
@@ -0,0 +1,132 @@
+"""
+Liveness and readiness probes
+
+GET /healthz -- the process is up and serving
+GET /readyz -- the service can take traffic: the database answers, the
+               connection pool is not exhausted and the cache is usable
+
+Probes are answered by a WSGI middleware in front of the Flask app, so they
+never push a request context, run the REST stack or open a session. The
+database ping runs on its own pooled connection at most once every
+HEALTH_CHECK_TTL seconds per process, probes in between reuse its result.
+"""
+
+import json
+import threading
+import time
+
+from sqlalchemy import text
+
+from . import status  # HTTP Status Codes
+from service.models.model_utils import db
+from service.models.pool import pool_stats
+
+HEALTHZ_PATH = "/healthz"
+READYZ_PATH = "/readyz"
+PROBE_METHODS = ("GET", "HEAD")
+REASONS = {
+  status.HTTP_200_OK: "OK",
+  status.HTTP_503_SERVICE_UNAVAILABLE: "Service Unavailable",
+}
+
+def pool_saturation(stats:dict) -> float:
+  """Returns the share of the pool's connections (overflow included) checked out"""
+  if "size" not in stats:
+    # pools that do not limit connections never saturate
+    return 0.0
+  capacity = stats["size"] + max(stats["max_overflow"], 0)
+  if stats["max_overflow"] < 0 or capacity == 0:
+    return 0.0
+  return round(stats["checked_out"] / capacity, 3)
+
+class DatabasePing:
+  """Pings the database, caching the outcome for ttl seconds"""
+
+  def __init__(self, ttl:float):
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._checked_at = None
+    self._result = None
+
+  def __call__(self, engine) -> dict:
+    now = time.monotonic()
+    if self._is_fresh(now):
+      return self._result
+    # only the first ping makes other probes wait, later ones get the last result
+    if not self._lock.acquire(blocking=self._result is None):
+      return self._result
+    try:
+      if not self._is_fresh(now):
+        self._result = self._ping(engine)
+        self._checked_at = time.monotonic()
+      return self._result
+    finally:
+      self._lock.release()
+
+  def _is_fresh(self, now:float) -> bool:
+    return self._checked_at is not None and now - self._checked_at < self.ttl
+
+  @staticmethod
+  def _ping(engine) -> dict:
+    start = time.perf_counter()
+    try:
+      with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    except Exception as error: # pylint: disable=broad-except
+      return {"status": "down", "error": type(error).__name__}
+    return {"status": "up", "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+class HealthMiddleware:
+  """Answers the probes before the request reaches the Flask app"""
+
+  def __init__(self, wsgi_app, app):
+    self.wsgi_app = wsgi_app
+    self.app = app
+    self.ping = DatabasePing(app.config.get("HEALTH_CHECK_TTL", 5))
+
+  def __call__(self, environ, start_response):
+    if environ.get("REQUEST_METHOD") in PROBE_METHODS:
+      path = environ.get("PATH_INFO")
+      if path == HEALTHZ_PATH:
+        return self._respond(environ, start_response, status.HTTP_200_OK, {"status": "ok"})
+      if path == READYZ_PATH:
+        ready, checks = self.readiness()
+        return self._respond(environ, start_response,
+          status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+          {"status": "ok" if ready else "unavailable", "checks": checks})
+    return self.wsgi_app(environ, start_response)
+
+  def readiness(self):
+    """Returns whether the service is ready and the outcome of every check"""
+    engine = db.get_engine(self.app)
+    stats = pool_stats(engine)
+    saturation = pool_saturation(stats)
+    pool = {"status": "up", "saturation": saturation}
+    if saturation >= self.app.config.get("HEALTH_MAX_POOL_SATURATION", 1.0):
+      # a ping would wait for a connection, the pool itself is the answer
+      pool["status"] = "saturated"
+      database = {"status": "unknown"}
+    else:
+      database = self.ping(engine)
+    checks = {
+      "database": database,
+      "pool": pool,
+      # the service has no cache backend yet
+      "cache": {"status": "not configured"},
+    }
+    ready = all(check["status"] in ("up", "not configured") for check in checks.values())
+    return ready, checks
+
+  @staticmethod
+  def _respond(environ, start_response, status_code:int, body:dict):
+    payload = json.dumps(body).encode("utf-8")
+    start_response("{0} {1}".format(status_code, REASONS[status_code]), [
+      ("Content-Type", "application/json"),
+      ("Content-Length", str(len(payload))),
+      ("Cache-Control", "no-store"),
+    ])
+    return [] if environ["REQUEST_METHOD"] == "HEAD" else [payload]
+
+def init_app(app):
+  """Puts the probes in front of an app"""
+  app.wsgi_app = HealthMiddleware(app.wsgi_app, app)
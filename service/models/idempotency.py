@@ -0,0 +1,171 @@
+"""
+Idempotency keys
+
+A client retrying a POST sends the Idempotency-Key header of its first
+attempt. The first attempt stores its response under the key, in the
+transaction of its writes, and the retries get that response back instead
+of writing again:
+
+  POST /wishlists
+  Idempotency-Key: 5b0e6c3a-8f1d-4a7e-9c2b-0d4f3e2a1b6c
+
+Only successful responses are stored. A request that fails commits
+nothing, its key neither, so a retry runs again. A retry sent while the
+first attempt is still running waits for it on the primary key of the
+key, then replays its response, or reserves the key again if it failed. A
+key reused for another request (method, path or payload) is refused.
+
+Keys expire after IDEMPOTENCY_KEY_TTL seconds and at most
+IDEMPOTENCY_MAX_KEYS are kept: every worker prunes the store once every
+PRUNE_EVERY keys it stores, flask prune-idempotency-keys prunes it on
+demand.
+"""
+
+import hashlib
+import itertools
+from datetime import datetime, timedelta
+
+from flask import current_app, jsonify, request
+from sqlalchemy import and_, desc, select
+from sqlalchemy.exc import IntegrityError
+
+from .. import status  # HTTP Status Codes
+from .model_utils import db, logger
+from .unit_of_work import unit_of_work
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+PRUNE_EVERY = 1000
+# the key reserved by the request, kept on the request like its unit of work
+REQUEST_KEY = "service.idempotency_key"
+
+_stored = itertools.count(1)
+
+class KeyInUseError(Exception):
+  """Raised when a key cannot be reserved, nor its stored response read"""
+
+class IdempotencyKey(db.Model):
+  """The response of a request sent with an Idempotency-Key"""
+  __tablename__ = 'idempotency_key'
+
+  key = db.Column(db.String(MAX_KEY_LENGTH), primary_key=True)
+  # hash of the method, the path and the payload of the request
+  fingerprint = db.Column(db.String(64), nullable=False)
+  # set before the transaction reserving the key commits
+  status = db.Column(db.Integer, nullable=True)
+  mimetype = db.Column(db.String(64), nullable=True)
+  location = db.Column(db.String(2048), nullable=True)
+  body = db.Column(db.Text, nullable=True)
+  created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+def fingerprint(method:str, path:str, payload:bytes) -> str:
+  """Returns the hash telling requests sent with the same key apart"""
+  digest = hashlib.sha256()
+  for part in (method.encode(), path.encode(), payload):
+    digest.update(part)
+    digest.update(b"\0")
+  return digest.hexdigest()
+
+def reserve(key:str, request_fingerprint:str, ttl:float):
+  """Reserves a key in the session's transaction, returns its stored response if it has one
+
+  Call it before any other write of the transaction: when the key is taken
+  meanwhile, the transaction is rolled back to read it. When it is gone by
+  then, the key is reserved again, once, before raising KeyInUseError.
+  """
+  table = IdempotencyKey.__table__
+  now = datetime.utcnow()
+  stored = IdempotencyKey.query.get(key)
+  if stored is not None and stored.created_at >= now - timedelta(seconds=ttl):
+    return stored
+  if stored is not None:
+    # expired, the key is free again
+    db.session.execute(table.delete().where(and_(table.c.key == key,
+      table.c.created_at < now - timedelta(seconds=ttl))), mapper=IdempotencyKey.__mapper__)
+    db.session.expunge(stored)
+  for _ in range(2):
+    try:
+      db.session.execute(table.insert().values(key=key, fingerprint=request_fingerprint,
+        created_at=now), mapper=IdempotencyKey.__mapper__)
+      return None
+    except IntegrityError:
+      # stored by a request that committed while this one waited on the key
+      db.session.rollback()
+      stored = IdempotencyKey.query.get(key)
+      if stored is not None:
+        return stored
+  raise KeyInUseError("{0} {1} is used by another request, retry later".format(HEADER, key))
+
+def store(key:str, response):
+  """Stores the response of the request that reserved a key, in its transaction"""
+  table = IdempotencyKey.__table__
+  db.session.execute(table.update().where(table.c.key == key).values(
+    status=response.status_code, mimetype=response.mimetype,
+    location=response.headers.get("Location"), body=response.get_data(as_text=True)),
+    mapper=IdempotencyKey.__mapper__)
+
+def replay(stored:IdempotencyKey):
+  """Returns the stored response of a key"""
+  response = current_app.response_class(stored.body, status=stored.status,
+    mimetype=stored.mimetype)
+  if stored.location:
+    response.headers["Location"] = stored.location
+  response.headers[REPLAYED_HEADER] = "true"
+  return response
+
+def prune(ttl:float, max_keys:int) -> int:
+  """Drops the expired keys and the oldest ones past max_keys, returns the number dropped"""
+  table = IdempotencyKey.__table__
+  now = datetime.utcnow()
+  with unit_of_work():
+    dropped = db.session.execute(table.delete().where(
+      table.c.created_at < now - timedelta(seconds=ttl)),
+      mapper=IdempotencyKey.__mapper__).rowcount
+    newest_dropped = db.session.execute(select([table.c.created_at])
+      .order_by(desc(table.c.created_at)).offset(max_keys).limit(1),
+      mapper=IdempotencyKey.__mapper__).scalar()
+    if newest_dropped is not None:
+      dropped += db.session.execute(table.delete().where(
+        table.c.created_at <= newest_dropped), mapper=IdempotencyKey.__mapper__).rowcount
+  logger.info("Idempotency: pruned %s keys", dropped)
+  return dropped
+
+def _begin_request():
+  key = request.headers.get(HEADER)
+  if key is None or request.method != "POST":
+    return None
+  if not key or len(key) > MAX_KEY_LENGTH:
+    return jsonify(message="{0} should have 1 to {1} characters".format(HEADER,
+      MAX_KEY_LENGTH)), status.HTTP_400_BAD_REQUEST
+  request_fingerprint = fingerprint(request.method, request.full_path, request.get_data())
+  try:
+    stored = reserve(key, request_fingerprint, current_app.config['IDEMPOTENCY_KEY_TTL'])
+  except KeyInUseError as error:
+    return jsonify(message=str(error)), status.HTTP_409_CONFLICT
+  if stored is None:
+    request.environ[REQUEST_KEY] = key
+    return None
+  if stored.fingerprint != request_fingerprint:
+    return jsonify(message="{0} {1} was used for another request".format(HEADER, key)), \
+      status.HTTP_422_UNPROCESSABLE_ENTITY
+  current_app.logger.info("Replaying the response of %s %s", HEADER, key)
+  return replay(stored)
+
+def _end_request(response):
+  key = request.environ.pop(REQUEST_KEY, None)
+  if key is not None and response.status_code < 400:
+    store(key, response)
+    if next(_stored) % PRUNE_EVERY == 0:
+      config = current_app.config
+      prune(config['IDEMPOTENCY_KEY_TTL'], config['IDEMPOTENCY_MAX_KEYS'])
+  return response
+
+def init_app(app):
+  """Makes POST requests with an Idempotency-Key replay the response of the first one
+
+  Call it after unit_of_work.init_app, the key is stored before the request
+  commits.
+  """
+  app.before_request(_begin_request)
+  app.after_request(_end_request)
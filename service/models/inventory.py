@@ -0,0 +1,130 @@
+"""
+Inventory events
+
+The inventory reports stock and price changes of its items as events like
+{"inventory_product_id": 7, "status": "UNAVAILABLE", "price": 9.5}, where
+status and price are each optional. apply_events() coalesces a batch (the
+last event of an item wins, field by field) and applies it to the products
+of every wishlist with set-based statements, one per chunk of items:
+
+  UPDATE product SET status = CASE inventory_product_id WHEN ... END,
+    price = CASE inventory_product_id WHEN ... END
+  WHERE inventory_product_id IN (...)
+    AND (status != CASE ... END OR price != CASE ... END)
+
+which find the products through the index on product.inventory_product_id.
+Products already matching their item are left alone: their updated_at is
+kept and no change is recorded for them.
+stale_items() narrows a batch down to the items that change some product.
+"""
+
+from decimal import Decimal
+
+from sqlalchemy import and_, case, literal, or_
+
+from .model_utils import db, logger, DataValidationError
+from .product import Product
+from .sharding import shard_keys, use_shard
+from .unit_of_work import unit_of_work
+from . import outbox
+
+# fields of a product an inventory event may change
+EVENT_FIELDS = ('status', 'price')
+# items per UPDATE, each item takes up to three bound parameters
+ITEMS_PER_STATEMENT = 300
+
+def parse_event(data) -> tuple:
+  """Validates an event, returns its inventory_product_id and the values it sets"""
+  if not isinstance(data, dict):
+    raise DataValidationError("Expected an inventory event object")
+  inventory_product_id = data.get('inventory_product_id')
+  if not isinstance(inventory_product_id, int) or isinstance(inventory_product_id, bool):
+    raise DataValidationError("Integer value expected for field: inventory_product_id")
+  unknown = set(data) - set(EVENT_FIELDS) - {'inventory_product_id'}
+  if unknown:
+    raise DataValidationError("Invalid fields for an inventory event: {0}".format(
+      ", ".join(sorted(unknown))))
+  values = Product.validate_patch({key: data[key] for key in EVENT_FIELDS if key in data})
+  return inventory_product_id, values
+
+def coalesce(events:list) -> dict:
+  """Merges the events of a batch by item, later events override earlier ones"""
+  items = {}
+  for event in events:
+    inventory_product_id, values = parse_event(event)
+    items.setdefault(inventory_product_id, {}).update(values)
+  return items
+
+def _update_values(items:dict) -> tuple:
+  """Returns the new values of the products of items and the condition of the ones they change"""
+  table = Product.__table__
+  values = {}
+  for field in EVENT_FIELDS:
+    column = table.c[field]
+    whens = {inventory_product_id: literal(item[field], column.type)
+      for inventory_product_id, item in items.items() if field in item}
+    if whens:
+      values[field] = case(whens, value=table.c.inventory_product_id, else_=column)
+  changed = or_(*[table.c[field] != value for field, value in values.items()])
+  return values, and_(table.c.inventory_product_id.in_(list(items)), changed)
+
+def inventory_product_ids() -> list:
+  """Returns the inventory_product_ids found in the wishlists, on every shard"""
+  column = Product.__table__.c.inventory_product_id
+  found = set()
+  for key in shard_keys() or [None]:
+    with use_shard(key):
+      found.update(row[0] for row in db.session.execute(
+        db.select([column]).distinct(), mapper=Product.__mapper__))
+  return sorted(found)
+
+def stale_items(items:dict) -> dict:
+  """Returns the coalesced items some product of the wishlists disagrees with"""
+  table = Product.__table__
+  query = db.select([table.c.inventory_product_id, table.c.status, table.c.price]) \
+    .distinct().where(table.c.inventory_product_id.in_(list(items)))
+  stale = {}
+  for key in shard_keys() or [None]:
+    with use_shard(key):
+      for row in db.session.execute(query, mapper=Product.__mapper__):
+        item = items[row.inventory_product_id]
+        if any(_differs(row[field], value) for field, value in item.items()):
+          stale[row.inventory_product_id] = item
+  return stale
+
+def _differs(stored, value) -> bool:
+  if isinstance(value, float):
+    # prices are stored as decimals, 9.99 is not exactly representable as a float
+    value = Decimal(str(value))
+  return stored != value
+
+def apply_items(items:dict) -> int:
+  """Applies coalesced items to the products of every wishlist, returns the number updated"""
+  item_ids = list(items)
+  updated = 0
+  with unit_of_work():
+    # an item can be in the wishlists of any shard
+    for key in shard_keys() or [None]:
+      with use_shard(key):
+        for start in range(0, len(item_ids), ITEMS_PER_STATEMENT):
+          chunk = {item_id: items[item_id]
+            for item_id in item_ids[start:start + ITEMS_PER_STATEMENT]}
+          values, changed = _update_values(chunk)
+          # recorded first, the products changed no longer match once updated
+          outbox.record_matching(Product.__table__, outbox.UPDATED, changed)
+          updated += db.session.execute(Product.__table__.update().where(changed)
+            .values(**values), mapper=Product.__mapper__).rowcount
+    # copies loaded before may be stale now
+    for instance in list(db.session.identity_map.values()):
+      if isinstance(instance, Product):
+        db.session.expire(instance)
+  return updated
+
+def apply_events(events:list) -> dict:
+  """Applies a batch of inventory events to the products of every wishlist
+
+  Returns the number of events received, of items they changed and of products updated.
+  """
+  items = coalesce(events)
+  logger.info("Inventory: applying %s events on %s items ...", len(events), len(items))
+  return {"received": len(events), "coalesced": len(items), "updated": apply_items(items)}
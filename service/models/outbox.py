@@ -0,0 +1,237 @@
+"""
+Outbox of wishlist and product changes
+
+Every change of a wishlist or a product adds a row to the change table in
+the same transaction, so the change feed (GET /changes) lists exactly the
+changes that were committed:
+
+  {"entity": "product", "id": 12, "wishlist_id": 3, "action": "updated", ...}
+
+Consumers read the feed from a cursor and fetch the entities they care
+about, instead of scanning every wishlist. The cursor is the position of
+the last change read, or "shard_0:12,shard_1:40" when the tables are
+sharded, as every shard keeps its own outbox next to its rows.
+
+Ids are allocated when a change is written but become visible when its
+transaction commits, possibly after changes with greater ids. On
+PostgreSQL every change records its transaction id, the feed lists the
+changes in (transaction id, id) order, which is also the position in the
+cursor ("745.12"), and stops before the oldest transaction still running.
+No change is ever added before that point, so a consumer never moves its
+cursor past a change that is not committed yet.
+
+compact() keeps only the latest change of every entity once changes are
+older than CHANGES_COMPACT_AFTER, and drops deletions older than
+CHANGES_RETENTION. A consumer reading at least once per retention period
+never misses the latest state of an entity.
+"""
+
+import heapq
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, asc, exists, func, literal, select, tuple_
+
+from .model_utils import db, logger, DataValidationError
+from .sharding import instance_shard, shard_keys, use_shard
+from .unit_of_work import unit_of_work
+
+WISHLIST = "wishlist"
+PRODUCT = "product"
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+class Change(db.Model):
+  """A change of a wishlist or a product, in the order it was written"""
+  __tablename__ = 'change'
+
+  id = db.Column(db.Integer, primary_key=True)
+  entity = db.Column(db.String(16), nullable=False)
+  entity_id = db.Column(db.Integer, nullable=False)
+  # the wishlist itself for a wishlist change
+  wishlist_id = db.Column(db.Integer, nullable=False)
+  action = db.Column(db.String(16), nullable=False)
+  # owner of the wishlist for a wishlist change, so that deletions can be found by user
+  user_id = db.Column(db.Integer, nullable=True)
+  # transaction that wrote the change, on PostgreSQL only
+  txid = db.Column(db.BigInteger, nullable=True)
+  created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+  __table_args__ = (db.Index('ix_change_entity', 'entity', 'entity_id'),)
+
+  def serialize(self) -> dict:
+    """Turns a change into a dictionary, as listed by the change feed"""
+    return {
+      "entity": self.entity,
+      "id": self.entity_id,
+      "wishlist_id": self.wishlist_id,
+      "action": self.action,
+      "created_at": self.created_at.isoformat(),
+    }
+
+def _txid(dialect:str):
+  return func.txid_current() if dialect == 'postgresql' else None
+
+def insert_changes(dialect:str, entity:str, action:str, rows:list, user_id:int=None):
+  """Returns the INSERT of the changes of rows, a list of (entity_id, wishlist_id)"""
+  now = datetime.utcnow()
+  return Change.__table__.insert().values([{"entity": entity, "entity_id": entity_id,
+    "wishlist_id": wishlist_id, "user_id": user_id, "action": action,
+    "txid": _txid(dialect), "created_at": now} for entity_id, wishlist_id in rows])
+
+def insert_matching(dialect:str, table, action:str, where):
+  """Returns an INSERT ... SELECT of the changes of the rows of table matching where
+
+  table is the wishlist or the product table. Run it before a DELETE and
+  after an UPDATE with the same condition.
+  """
+  # labelled, a select drops a column listed twice
+  wishlist_id = (table.c.id if table.name == WISHLIST else table.c.wishlist_id).label("wishlist_id")
+  columns = [literal(table.name), table.c.id, wishlist_id, literal(action),
+    literal(datetime.utcnow(), Change.__table__.c.created_at.type)]
+  names = ["entity", "entity_id", "wishlist_id", "action", "created_at"]
+  if table.name == WISHLIST:
+    columns.append(table.c.user_id)
+    names.append("user_id")
+  txid = _txid(dialect)
+  if txid is not None:
+    columns.append(txid)
+    names.append("txid")
+  return Change.__table__.insert().from_select(names, select(columns).where(where))
+
+def _dialect() -> str:
+  return db.session.get_bind(Change.__mapper__).dialect.name
+
+def record(entity:str, action:str, rows:list, user_id:int=None):
+  """Writes the changes of rows, (entity_id, wishlist_id) pairs, in the session's transaction"""
+  if rows:
+    db.session.execute(insert_changes(_dialect(), entity, action, rows, user_id),
+      mapper=Change.__mapper__)
+
+def record_instance(instance, action:str):
+  """Writes the change of a wishlist or a product, on its shard"""
+  entity = instance.__tablename__
+  if entity == WISHLIST:
+    wishlist_id, user_id = instance.id, instance.user_id
+  else:
+    wishlist_id, user_id = instance.wishlist_id, None
+  with use_shard(instance_shard(instance)):
+    record(entity, action, [(instance.id, wishlist_id)], user_id)
+
+def record_matching(table, action:str, where):
+  """Writes the changes of the rows of table matching where, in the session's transaction"""
+  db.session.execute(insert_matching(_dialect(), table, action, where),
+    mapper=Change.__mapper__)
+
+######################################################################
+# CHANGE FEED
+######################################################################
+def _parse_position(position:str) -> tuple:
+  txid, _, last = position.rpartition(".")
+  return int(txid or 0), int(last)
+
+def _format_position(position:tuple) -> str:
+  txid, last = position
+  return "{0}.{1}".format(txid, last) if txid else str(last)
+
+def parse_cursor(cursor:str) -> dict:
+  """Returns the position of the last change read on every shard, from a cursor"""
+  if not cursor:
+    return {}
+  try:
+    if ":" not in cursor:
+      return {None: _parse_position(cursor)}
+    return {key: _parse_position(position)
+      for key, position in (part.split(":") for part in cursor.split(","))}
+  except ValueError:
+    raise DataValidationError("Invalid cursor: {0}".format(cursor))
+
+def format_cursor(positions:dict) -> str:
+  """Returns the cursor of the last change read on every shard"""
+  if list(positions) == [None]:
+    return _format_position(positions[None])
+  return ",".join("{0}:{1}".format(key, _format_position(position))
+    for key, position in sorted(positions.items()))
+
+def _committed(after:tuple):
+  """Returns the changes committed after a position, in feed order"""
+  if _dialect() != 'postgresql':
+    # writers are serialized, ids are committed in order
+    return Change.query.filter(Change.id > after[1]).order_by(asc(Change.id))
+  # transactions older than the oldest one running are over, none of them adds
+  # a change anymore: the feed is in transaction order up to there
+  return Change.query.filter(
+    tuple_(Change.txid, Change.id) > tuple_(*after),
+    Change.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()),
+  ).order_by(asc(Change.txid), asc(Change.id))
+
+def _position(change) -> tuple:
+  return change.txid or 0, change.id
+
+def _shard_keys(positions:dict, cursor:str) -> list:
+  keys = shard_keys() or [None]
+  if any(key not in keys for key in positions):
+    raise DataValidationError("Invalid cursor: {0}".format(cursor))
+  return keys
+
+def read(cursor:str=None, limit:int=DEFAULT_LIMIT) -> tuple:
+  """Returns up to limit changes committed after cursor, and the cursor after them"""
+  positions = parse_cursor(cursor)
+  limit = min(max(int(limit), 1), MAX_LIMIT)
+  keys = _shard_keys(positions, cursor)
+  positions = {key: positions.get(key, (0, 0)) for key in keys}
+  pages = []
+  for key in keys:
+    with use_shard(key):
+      pages.append([(key, change) for change in _committed(positions[key]).limit(limit)])
+  changes = []
+  # the merge takes a prefix of every shard's page, so no change is skipped
+  for key, change in heapq.merge(*pages, key=lambda page: page[1].created_at):
+    if len(changes) == limit:
+      break
+    changes.append(change)
+    positions[key] = _position(change)
+  return changes, format_cursor(positions)
+
+def latest_cursor() -> str:
+  """Returns the cursor after the last change committed, to follow the feed from now on"""
+  positions = {}
+  for key in shard_keys() or [None]:
+    with use_shard(key):
+      if _dialect() != 'postgresql':
+        last = Change.query.order_by(Change.id.desc()).first()
+      else:
+        last = Change.query.filter(
+          Change.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()),
+        ).order_by(Change.txid.desc(), Change.id.desc()).first()
+      positions[key] = _position(last) if last is not None else (0, 0)
+  return format_cursor(positions)
+
+######################################################################
+# COMPACTION
+######################################################################
+def compact(compact_after:float, retention:float) -> int:
+  """Drops superseded changes and old deletions, returns the number of changes dropped
+
+  compact_after and retention are in seconds.
+  """
+  table = Change.__table__
+  newer = table.alias("newer")
+  superseded = exists().where(and_(newer.c.entity == table.c.entity,
+    newer.c.entity_id == table.c.entity_id, newer.c.id > table.c.id))
+  now = datetime.utcnow()
+  dropped = 0
+  with unit_of_work():
+    for key in shard_keys() or [None]:
+      with use_shard(key):
+        dropped += db.session.execute(table.delete().where(and_(
+          table.c.created_at < now - timedelta(seconds=compact_after), superseded)),
+          mapper=Change.__mapper__).rowcount
+        dropped += db.session.execute(table.delete().where(and_(
+          table.c.created_at < now - timedelta(seconds=retention),
+          table.c.action == DELETED)), mapper=Change.__mapper__).rowcount
+  logger.info("Outbox: compacted %s changes", dropped)
+  return dropped
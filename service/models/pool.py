@@ -0,0 +1,132 @@
+"""
+Connection pool configuration and instrumentation
+
+The engine is created with the DATABASE_POOL_* settings from config.py.
+Checkout waits are measured by InstrumentedQueuePool and reported by
+pool_stats(). Engines are made fork safe: a child process never reuses a
+connection opened by its parent, and gets a fresh pool right after fork.
+Under gevent workers psycopg2 waits cooperatively, so one greenlet waiting
+on PostgreSQL does not block the others.
+"""
+
+import os
+import sys
+import time
+import threading
+import weakref
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+_engines = weakref.WeakSet()
+# pools inherited from the parent process, kept referenced so that their
+# connections are never closed (and the parent's sessions terminated) by the child
+_inherited_pools = []
+
+class InstrumentedQueuePool(QueuePool):
+  """QueuePool that records how long checkouts wait for a connection"""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._stats_lock = threading.Lock()
+    self.checkouts = 0
+    self.timeouts = 0
+    self.wait_time_total = 0.0
+    self.wait_time_max = 0.0
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super()._do_get()
+    except exc.TimeoutError:
+      with self._stats_lock:
+        self.timeouts += 1
+      raise
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._stats_lock:
+        self.checkouts += 1
+        self.wait_time_total += elapsed
+        self.wait_time_max = max(self.wait_time_max, elapsed)
+
+def pool_stats(engine) -> dict:
+  """Returns a dictionary describing the state of the engine's connection pool"""
+  pool = engine.pool
+  stats = {"pool_class": type(pool).__name__}
+  if isinstance(pool, QueuePool):
+    stats.update({
+      "size": pool.size(),
+      "checked_in": pool.checkedin(),
+      "checked_out": pool.checkedout(),
+      "overflow": max(pool.overflow(), 0),
+      "max_overflow": pool._max_overflow,
+    })
+  if isinstance(pool, InstrumentedQueuePool):
+    stats.update({
+      "checkouts": pool.checkouts,
+      "timeouts": pool.timeouts,
+      "wait_time_total": round(pool.wait_time_total, 6),
+      "wait_time_max": round(pool.wait_time_max, 6),
+    })
+  return stats
+
+def install_fork_guard(engine):
+  """Never hand out a connection that was opened by another process"""
+
+  @event.listens_for(engine, "connect")
+  def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+  @event.listens_for(engine, "checkout")
+  def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+      # drop the connection without closing it, it still belongs to the parent
+      connection_record.connection = connection_proxy.connection = None
+      raise exc.DisconnectionError(
+        "Connection record belongs to pid {0}, attempting to check out in pid {1}"\
+        .format(connection_record.info['pid'], pid)
+      )
+
+  _engines.add(engine)
+
+def reset_after_fork():
+  """Give every engine a new, empty pool in a freshly forked child process"""
+  for engine in list(_engines):
+    _inherited_pools.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=reset_after_fork)
+
+def cooperate_with_gevent(sa_url) -> bool:
+  """Lets psycopg2 yield to other greenlets while waiting, if gevent patched the process"""
+  monkey = sys.modules.get('gevent.monkey')
+  if monkey is None or not monkey.is_module_patched('socket') \
+    or not sa_url.drivername.startswith('postgres'):
+    return False
+  from psycogreen.gevent import patch_psycopg
+  patch_psycopg()
+  return True
+
+class PooledSQLAlchemy(SQLAlchemy):
+  """SQLAlchemy extension creating fork safe engines with a tunable pool"""
+
+  def apply_driver_hacks(self, app, sa_url, options):
+    super().apply_driver_hacks(app, sa_url, options)
+    if sa_url.drivername.startswith('sqlite'):
+      # SQLite connections are not pooled
+      return
+    options.setdefault('poolclass', InstrumentedQueuePool)
+    options.setdefault('pool_size', app.config.get('DATABASE_POOL_SIZE', 5))
+    options.setdefault('max_overflow', app.config.get('DATABASE_MAX_OVERFLOW', 10))
+    options.setdefault('pool_recycle', app.config.get('DATABASE_POOL_RECYCLE', -1))
+    options.setdefault('pool_timeout', app.config.get('DATABASE_POOL_TIMEOUT', 30))
+    options.setdefault('pool_pre_ping', app.config.get('DATABASE_POOL_PRE_PING', False))
+
+  def create_engine(self, sa_url, engine_opts):
+    cooperate_with_gevent(sa_url)
+    engine = super().create_engine(sa_url, engine_opts)
+    install_fork_guard(engine)
+    return engine
@@ -15,11 +15,61 @@ pic_url
 short_desc
 inventory_product_id
 wishlist_id
+updated_at
 """
 
-from sqlalchemy import asc
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import abort
+from sqlalchemy import and_, asc, cast, desc, func, literal, literal_column, select, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm.util import identity_key
 from .model_utils import MAX_NAME_LENGTH, db, logger, \
   Availability, InCartStatus, DataValidationError, get_non_null_product_fields
+from .sharding import allocate_id, by_id, by_wishlist, current_shard, scattered, \
+  shard_for_wishlist, shard_keys
+from .unit_of_work import unit_of_work
+from . import outbox
+
+# fields a partial update may change, wishlist_id and in_cart_status have their own routes
+PATCHABLE_FIELDS = ('name', 'price', 'status', 'pic_url', 'short_desc', 'inventory_product_id')
+# cart statuses a product may be moved from, by the status it is moved to
+CART_TRANSITIONS = {
+  InCartStatus.IN_CART: (InCartStatus.DEFAULT,),
+  InCartStatus.ORDERED: (InCartStatus.IN_CART,),
+}
+# fields an upsert overwrites on the product already in the wishlist, its cart status is kept
+UPSERT_FIELDS = ('name', 'price', 'status', 'pic_url', 'short_desc', 'updated_at')
+# fields a copy of a product keeps, it is out of the cart
+COPIED_FIELDS = ('name', 'price', 'status', 'pic_url', 'short_desc', 'inventory_product_id')
+# fields the products of a wishlist are listed by, each has an index on (wishlist_id, field, id)
+SORT_FIELDS = ('id', 'name', 'price')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def format_page_cursor(sort:str, row) -> str:
+  """Returns the cursor of the page after a row, the position of the row in the sort order"""
+  value = row[sort.lstrip('-')]
+  position = [str(value) if isinstance(value, Decimal) else value, row['id']]
+  return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def parse_page_cursor(sort:str, cursor:str) -> tuple:
+  """Returns the position of the last row of the previous page, from a cursor"""
+  field = sort.lstrip('-')
+  try:
+    value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if field == 'price':
+      value = Decimal(value)
+    if not isinstance(last_id, int) or \
+      not isinstance(value, {'id': int, 'name': str, 'price': Decimal}[field]):
+      raise ValueError(cursor)
+  except (binascii.Error, InvalidOperation, TypeError, ValueError):
+    raise DataValidationError("Invalid cursor: {0}".format(cursor))
+  return value, last_id
 
 class Product(db.Model):
 
@@ -32,42 +82,70 @@ class Product(db.Model):
   pic_url = db.Column(db.Text,nullable=True)
   short_desc = db.Column(db.Text,nullable=True)
   # corresponds to real product in inventory
-  inventory_product_id = db.Column(db.Integer,nullable=False)
+  inventory_product_id = db.Column(db.Integer,nullable=False,index=True)
   # wishlist id it belongs to
   wishlist_id = db.Column(db.Integer,db.ForeignKey("wishlist.id"),nullable=False)
   in_cart_status = db.Column(db.Enum(InCartStatus),nullable=False,default=InCartStatus.DEFAULT)
+  # last write, also set by bulk updates; NULL for rows written before it was tracked
+  updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+    onupdate=datetime.utcnow)
+
+  __table_args__ = (
+    db.Index('ix_product_wishlist_id_updated_at', 'wishlist_id', 'updated_at'),
+    # a wishlist holds an inventory product once, POST ?upsert=true updates it
+    db.Index('uq_product_wishlist_id_inventory_product_id', 'wishlist_id',
+      'inventory_product_id', unique=True),
+    # pages of GET /wishlists/{id}/products, in every sort order (see SORT_FIELDS)
+    db.Index('ix_product_wishlist_id_id', 'wishlist_id', 'id'),
+    db.Index('ix_product_wishlist_id_name_id', 'wishlist_id', 'name', 'id'),
+    db.Index('ix_product_wishlist_id_price_id', 'wishlist_id', 'price', 'id'),
+    # the products in the cart are few, their pages should not walk the whole wishlist
+    db.Index('ix_product_wishlist_id_in_cart_status_id', 'wishlist_id', 'in_cart_status', 'id'),
+  )
 
   def create(self):
     """Create Product instance in database"""
     logger.info("Creating %s ...", self.name)
     self.id = None
     self.in_cart_status = InCartStatus.DEFAULT #ensure default value upon creation
-    db.session.add(self)
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
-
+    if shard_keys():
+      self._shard = shard_for_wishlist(self.wishlist_id)
+    with unit_of_work():
+      db.session.add(self)
+      db.session.flush()
+      outbox.record_instance(self, outbox.CREATED)
     return self.id
 
+  def upsert(self) -> bool:
+    """Create Product instance, or update the product of its wishlist with its inventory_product_id
+
+    Returns True when the product was created.
+    """
+    logger.info("Upserting %s ...", self.name)
+    values = {name: getattr(self, name) for name in ('name', 'price', 'status', 'pic_url',
+      'short_desc', 'inventory_product_id', 'wishlist_id')}
+    values.update(in_cart_status=InCartStatus.DEFAULT, updated_at=datetime.utcnow())
+    row, created = Product._upsert(self.wishlist_id, values)
+    for key, value in row.items():
+      setattr(self, key, value)
+    return created
+
   def update(self):
     """Update Product instance in database"""
     logger.info("Updating %s ...", self.name)
     if not self.id:
       raise DataValidationError("Update called with empty ID field")
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
+    with unit_of_work():
+      db.session.flush()
+      outbox.record_instance(self, outbox.UPDATED)
 
   def delete(self):
     """Delete Product instance in database"""
     logger.info("Deleting %s ...", self.name)
-    db.session.delete(self)
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
+    with unit_of_work():
+      db.session.delete(self)
+      db.session.flush()
+      outbox.record_instance(self, outbox.DELETED)
 
   def serialize(self) -> dict:
     """serialize a Product into a dictionary"""
@@ -107,21 +185,7 @@ class Product(db.Model):
       self.name = data.get('name')
       self.price = float(data.get('price'))
 
-      status_candidate = data.get('status')
-      if isinstance(status_candidate,Availability) and \
-        status_candidate in [Availability.AVAILABLE, Availability.UNAVAILABLE]:
-        self.status = status_candidate
-      elif isinstance(status_candidate, str):
-        if status_candidate == "1" or status_candidate == "0":
-          self.status = int(status_candidate)
-        else:
-          self.status = getattr(Availability, status_candidate.upper())
-      elif isinstance(status_candidate, int):
-        self.status = Availability(status_candidate)
-      else:
-        raise DataValidationError(
-          "Invalid type for field \'status\', expected 1/0, or available/unavailable"
-        )
+      self.status = Product.parse_status(data.get('status'))
       self.pic_url = data.get('pic_url')
       self.short_desc = data.get('short_desc')
       self.inventory_product_id = int(data.get('inventory_product_id'))
@@ -131,19 +195,261 @@ class Product(db.Model):
       raise DataValidationError(error.args[0])
     return self
 
+  @staticmethod
+  def parse_status(status_candidate):
+    """Returns the availability status given as an Availability, a name or 1/0"""
+    if isinstance(status_candidate,Availability) and \
+      status_candidate in [Availability.AVAILABLE, Availability.UNAVAILABLE]:
+      return status_candidate
+    if isinstance(status_candidate, str):
+      if status_candidate == "1" or status_candidate == "0":
+        return int(status_candidate)
+      return getattr(Availability, status_candidate.upper())
+    if isinstance(status_candidate, int):
+      return Availability(status_candidate)
+    raise DataValidationError(
+      "Invalid type for field \'status\', expected 1/0, or available/unavailable"
+    )
+
+  @staticmethod
+  def validate_patch(data:dict) -> dict:
+    """Validates only the supplied fields of a partial update, returns the column values"""
+    if not data:
+      raise DataValidationError("Expected at least one field to update")
+    values = {}
+    try:
+      for key, value in data.items():
+        if key not in PATCHABLE_FIELDS:
+          raise DataValidationError("Field {0} cannot be updated with PATCH".format(key))
+        if value is None and key in get_non_null_product_fields():
+          raise DataValidationError("Field {0} cannot be null".format(key))
+        if key == 'name':
+          if not isinstance(value, str):
+            raise DataValidationError("Field name should be a string")
+          if len(value) > MAX_NAME_LENGTH:
+            raise DataValidationError(
+              f"Name field should be shorter than {MAX_NAME_LENGTH} characters")
+          values[key] = value
+        elif key == 'price':
+          if isinstance(value, bool):
+            raise DataValidationError("Field price should be a number")
+          values[key] = float(value)
+        elif key == 'status':
+          status = Product.parse_status(value)
+          values[key] = status if isinstance(status, Availability) else Availability(status)
+        elif key == 'inventory_product_id':
+          if not isinstance(value, int) or isinstance(value, bool):
+            raise DataValidationError("Field inventory_product_id should be an integer")
+          values[key] = value
+        elif value is None or isinstance(value, str):
+          values[key] = value
+        else:
+          raise DataValidationError("Field {0} should be a string".format(key))
+    except DataValidationError:
+      raise
+    except (AttributeError, TypeError, ValueError) as error:
+      raise DataValidationError("Invalid value for field {0}: {1}".format(key, error))
+    return values
+
+  @classmethod
+  @by_wishlist
+  def patch(cls, wishlist_id:int, product_id:int, data:dict):
+    """Updates the supplied fields of a product in one statement, without loading it first
+
+    Returns the updated product, or None if the wishlist has no such product.
+    """
+    logger.info("Patching product %s of wishlist %s with %s ...", product_id, wishlist_id,
+      list(data))
+    values = cls.validate_patch(data)
+    table = cls.__table__
+    match = and_(table.c.wishlist_id == int(wishlist_id), table.c.id == int(product_id))
+    products = cls._update_returning(match, values)
+    return products[0] if products else None
+
+  @classmethod
+  @by_wishlist
+  def move_to_cart_status(cls, wishlist_id:int, to_status:InCartStatus, product_ids:list=None) \
+    -> list:
+    """Moves products of a wishlist to another cart status in one statement
+
+    Only products allowed to make the transition are moved (see CART_TRANSITIONS): when
+    product_ids is None, all of them, and all AVAILABLE ones when moving to the cart.
+    Returns the products moved.
+    """
+    logger.info("Products: moving products %s of wishlist %s to %s ...",
+      "all" if product_ids is None else product_ids, wishlist_id, to_status.name)
+    table = cls.__table__
+    conditions = [table.c.wishlist_id == int(wishlist_id),
+      table.c.in_cart_status.in_(CART_TRANSITIONS[to_status])]
+    if product_ids is not None:
+      conditions.append(table.c.id.in_([int(pid) for pid in product_ids]))
+    elif to_status == InCartStatus.IN_CART:
+      conditions.append(table.c.status == Availability.AVAILABLE)
+    return cls._update_returning(and_(*conditions), {"in_cart_status": to_status})
+
+  @classmethod
+  def _update_returning(cls, match, values:dict) -> list:
+    """Updates the rows matching a condition in one statement, returns the updated products"""
+    table = cls.__table__
+    mapper = cls.__mapper__
+    with unit_of_work():
+      if db.session.get_bind(mapper).dialect.implicit_returning:
+        rows = db.session.execute(table.update().where(match).values(**values)
+          .returning(*table.c), mapper=mapper).fetchall()
+      else:
+        # no UPDATE ... RETURNING on this database, read the rows in the same transaction
+        rows = db.session.execute(table.select().where(match).order_by(asc(table.c.id)),
+          mapper=mapper).fetchall()
+        if rows:
+          db.session.execute(table.update().where(
+            and_(table.c.id.in_([row['id'] for row in rows]), match)).values(**values),
+            mapper=mapper)
+        rows = [dict(row, **values) for row in rows]
+      rows = sorted(rows, key=lambda row: row['id'])
+      outbox.record(outbox.PRODUCT, outbox.UPDATED,
+        [(row['id'], row['wishlist_id']) for row in rows])
+    products = []
+    for row in rows:
+      # the session may hold a copy loaded before the update
+      loaded = cls._loaded(row['id'])
+      if loaded is not None:
+        db.session.expire(loaded)
+      products.append(cls(**dict(row)))
+    return products
+
+  @classmethod
+  def upsert_statement(cls, values:dict):
+    """Returns the INSERT ... ON CONFLICT DO UPDATE of a product, on PostgreSQL
+
+    It returns the row written, with created true when it was inserted.
+    """
+    table = cls.__table__
+    insert = postgresql.insert(table).values(**values)
+    upsert = insert.on_conflict_do_update(
+      index_elements=[table.c.wishlist_id, table.c.inventory_product_id],
+      set_={name: insert.excluded[name] for name in UPSERT_FIELDS})
+    # xmax is 0 on an inserted row, an updated one is locked by the statement's transaction
+    return upsert.returning(*table.c, literal_column("xmax = 0").label("created"))
+
+  @classmethod
+  def upsert_match(cls, values:dict):
+    """Returns the condition matching the product an upsert of values overwrites"""
+    table = cls.__table__
+    return and_(table.c.wishlist_id == values['wishlist_id'],
+      table.c.inventory_product_id == values['inventory_product_id'])
+
   @classmethod
+  @by_wishlist
+  def _upsert(cls, wishlist_id:int, values:dict) -> tuple:
+    """Inserts or overwrites a product of a wishlist, returns its row and whether it was created
+
+    wishlist_id is values['wishlist_id'], passed apart for by_wishlist to pick its shard.
+    """
+    table = cls.__table__
+    mapper = cls.__mapper__
+    with unit_of_work():
+      key = current_shard()
+      if key is not None:
+        values = dict(values, id=allocate_id(db.session.connection(mapper), table, key))
+      if db.session.get_bind(mapper).dialect.name == 'postgresql':
+        row = dict(db.session.execute(cls.upsert_statement(values), mapper=mapper).first())
+        created = row.pop('created')
+      else:
+        # no ON CONFLICT here: writers are serialized, nothing is inserted in between
+        match = cls.upsert_match(values)
+        created = not db.session.execute(table.update().where(match)
+          .values({name: values[name] for name in UPSERT_FIELDS}), mapper=mapper).rowcount
+        if created:
+          db.session.execute(table.insert().values(**values), mapper=mapper)
+        row = dict(db.session.execute(table.select().where(match), mapper=mapper).first())
+      outbox.record(outbox.PRODUCT, outbox.CREATED if created else outbox.UPDATED,
+        [(row['id'], row['wishlist_id'])])
+    loaded = cls._loaded(row['id'])
+    if loaded is not None:
+      # the session may hold a copy loaded before the upsert
+      db.session.expire(loaded)
+    return row, created
+
+  @classmethod
+  @by_wishlist
+  def copy_all(cls, wishlist_id:int, to_wishlist_id:int) -> int:
+    """Copies the products of a wishlist to another one of its shard, returns the number copied
+
+    Runs one INSERT ... SELECT, one INSERT per product on shards. The copies are out
+    of the cart.
+    """
+    logger.info("Products: copying the products of wishlist %s to %s ...", wishlist_id,
+      to_wishlist_id)
+    table = cls.__table__
+    mapper = cls.__mapper__
+    now = datetime.utcnow()
+    copied = [table.c[name] for name in COPIED_FIELDS]
+    names = list(COPIED_FIELDS) + ['wishlist_id', 'in_cart_status', 'updated_at']
+    with unit_of_work():
+      key = current_shard()
+      if key is None:
+        rows = select(copied + [literal(int(to_wishlist_id)),
+          cast(literal(InCartStatus.DEFAULT.name), table.c.in_cart_status.type),
+          literal(now, table.c.updated_at.type)]) \
+          .where(table.c.wishlist_id == int(wishlist_id)).order_by(asc(table.c.id))
+        count = db.session.execute(table.insert().from_select(names, rows),
+          mapper=mapper).rowcount
+      else:
+        # shard unique ids are allocated one by one, each copy is inserted with its own
+        rows = db.session.execute(select(copied).where(table.c.wishlist_id == int(wishlist_id))
+          .order_by(asc(table.c.id)), mapper=mapper).fetchall()
+        connection = db.session.connection(mapper)
+        for row in rows:
+          db.session.execute(table.insert().values(dict(row,
+            id=allocate_id(connection, table, key), wishlist_id=int(to_wishlist_id),
+            in_cart_status=InCartStatus.DEFAULT, updated_at=now)), mapper=mapper)
+        count = len(rows)
+      if count:
+        outbox.record_matching(table, outbox.CREATED, table.c.wishlist_id == int(to_wishlist_id))
+    return count
+
+  @classmethod
+  @by_wishlist
+  def move_all(cls, wishlist_id:int, to_wishlist_id:int) -> list:
+    """Moves the products of a wishlist to another one of its shard, returns the products moved
+
+    Runs one UPDATE ... SET wishlist_id. The products of inventory items the other
+    wishlist already holds are deleted instead, the other wishlist keeps its own.
+    """
+    logger.info("Products: moving the products of wishlist %s to %s ...", wishlist_id,
+      to_wishlist_id)
+    table = cls.__table__
+    mapper = cls.__mapper__
+    held = table.alias("held")
+    duplicates = and_(table.c.wishlist_id == int(wishlist_id), table.c.inventory_product_id.in_(
+      select([held.c.inventory_product_id]).where(held.c.wishlist_id == int(to_wishlist_id))))
+    with unit_of_work():
+      outbox.record_matching(table, outbox.DELETED, duplicates)
+      db.session.execute(table.delete().where(duplicates), mapper=mapper)
+      return cls._update_returning(table.c.wishlist_id == int(wishlist_id),
+        {"wishlist_id": int(to_wishlist_id)})
+
+  @classmethod
+  def _loaded(cls, product_id):
+    """Returns the copy of a product held by the session, if any"""
+    return db.session.identity_map.get(identity_key(cls, int(product_id)))
+
+  @classmethod
+  @scattered
   def find_all(cls)->list:
     """ Finds all Products in database """
     logger.info("Products: processing all products")
     return list(cls.query.all())
 
   @classmethod
+  @by_id
   def find_by_id(cls, product_id:int):
     """ Find a Product by its id """
     logger.info('Products: processing product lookup for id %s ...', product_id)
     return cls.query.get(product_id)
 
   @classmethod
+  @by_id
   def find_by_id_and_status(cls, product_id:int, status:Availability):
     """ Find a Product by its id and availability status"""
     logger.info('Products: processing product lookup for id' \
@@ -159,9 +465,13 @@ class Product(db.Model):
   def find_or_404(cls,product_id:int):
     """ Find a Product by its id. Returns a product or a 404"""
     logger.info("Products: processing lookup or 404 for id %s ...", product_id)
-    return cls.query.get_or_404(product_id)
+    product = cls.find_by_id(product_id)
+    if product is None:
+      abort(404)
+    return product
 
   @classmethod
+  @scattered
   def find_all_by_ids(cls, product_ids:list) -> list:
     """Find a product by id"""
     logger.info("Products: processing lookup for ids in %s ...", product_ids)
@@ -169,6 +479,7 @@ class Product(db.Model):
     return list(res)
 
   @classmethod
+  @scattered
   def find_all_by_ids_and_status \
     (cls, product_ids:list, status:Availability=Availability.AVAILABLE) -> list:
     """Find products by id and its status"""
@@ -178,18 +489,129 @@ class Product(db.Model):
     return list(res)
 
   @classmethod
+  @scattered
+  def find_all_by_wishlist_ids(cls, wishlist_ids:list) -> list:
+    """Find the products of many wishlists"""
+    logger.info("Products: processing lookup for %s wishlists ...", len(wishlist_ids))
+    return list(cls.query.filter(cls.wishlist_id.in_(wishlist_ids)).order_by(asc(Product.id)))
+
+  @classmethod
+  @scattered
   def find_by_name(cls,name:str)->list:
     """Find a product by its name"""
     logger.info("Products: processing name query for %s ...", name)
     return list(cls.query.filter(cls.name == name).order_by(asc(Product.id)))
 
   @classmethod
+  @by_wishlist
   def find_all_by_wishlist_id(cls,wishlist_id:int)->list:
     """Find products by wishlist id they belong to"""
     logger.info("Products: processing name query for %s ...", wishlist_id)
     return list(cls.query.filter(cls.wishlist_id == wishlist_id).order_by(asc(Product.id)))
 
   @classmethod
+  def page_statement(cls, wishlist_id:int, sort:str='id', after:str=None,
+    limit:int=DEFAULT_PAGE_SIZE, status:Availability=None, in_cart_status:InCartStatus=None):
+    """Returns the SELECT of a page of the products of a wishlist, and of the first row after it
+
+    sort is one of SORT_FIELDS, prefixed with - for the descending order. after is
+    the cursor of the previous page. The page starts right after the row of the
+    cursor, whatever was written since, and is read from the index of the sort
+    order instead of skipping the rows of the previous pages.
+    """
+    field = sort.lstrip('-')
+    if field not in SORT_FIELDS or sort.count('-') > 1:
+      raise DataValidationError("sort should be one of {0}, - first for the descending order"
+        .format(", ".join(SORT_FIELDS)))
+    table = cls.__table__
+    order = desc if sort.startswith('-') else asc
+    conditions = [table.c.wishlist_id == int(wishlist_id)]
+    if status is not None:
+      conditions.append(table.c.status == status)
+    if in_cart_status is not None:
+      conditions.append(table.c.in_cart_status == in_cart_status)
+    if after:
+      value, last_id = parse_page_cursor(sort, after)
+      position, last = table.c.id, literal(last_id)
+      if field != 'id':
+        position = tuple_(table.c[field], table.c.id)
+        last = tuple_(literal(value, table.c[field].type), last)
+      conditions.append(position < last if order is desc else position > last)
+    columns = [table.c.id] if field == 'id' else [table.c[field], table.c.id]
+    return table.select().where(and_(*conditions)) \
+      .order_by(*[order(column) for column in columns]).limit(cls.page_size(limit) + 1)
+
+  @staticmethod
+  def page_size(limit:int) -> int:
+    """Returns the number of products of a page, limit kept within 1 and MAX_PAGE_SIZE"""
+    return min(max(int(limit), 1), MAX_PAGE_SIZE)
+
+  @classmethod
+  def page_of(cls, rows:list, sort:str, limit:int) -> tuple:
+    """Returns the products of the rows of page_statement and the cursor of the next page
+
+    The cursor is None on the last page.
+    """
+    limit = cls.page_size(limit)
+    products = [cls(**dict(row)) for row in rows[:limit]]
+    cursor = format_page_cursor(sort, rows[limit - 1]) if len(rows) > limit else None
+    return products, cursor
+
+  @classmethod
+  @by_wishlist
+  def find_page_by_wishlist_id(cls, wishlist_id:int, sort:str='id', after:str=None,
+    limit:int=DEFAULT_PAGE_SIZE, status:Availability=None, in_cart_status:InCartStatus=None) \
+    -> tuple:
+    """Finds a page of the products of a wishlist, returns them and the cursor of the next page"""
+    logger.info("Products: processing page query for wishlist %s by %s after %s ...",
+      wishlist_id, sort, after)
+    rows = db.session.execute(cls.page_statement(wishlist_id, sort, after, limit, status,
+      in_cart_status), mapper=cls.__mapper__).fetchall()
+    return cls.page_of(rows, sort, limit)
+
+  @classmethod
+  def summarize(cls, match, source=None) -> dict:
+    """Returns the counts and prices of the products matching a condition
+
+    One GROUP BY query counts the products and sums their prices by status and
+    cart status, the most expensive one is read from the top of the price order
+    when there is one. No other product is loaded.
+
+    source is a LEFT JOIN from the wishlist summarized to its products, match a
+    condition on the wishlist. The wishlist's existence is then read by the same
+    GROUP BY, and None is returned when it does not exist.
+    """
+    table = cls.__table__
+    mapper = cls.__mapper__
+    groups = db.session.execute(select([table.c.status, table.c.in_cart_status,
+      func.count(table.c.id).label('count'), func.sum(table.c.price).label('total')])
+      .select_from(table if source is None else source).where(match)
+      .group_by(table.c.status, table.c.in_cart_status), mapper=mapper).fetchall()
+    if source is not None and not groups:
+      return None
+    # a wishlist without products joins a single row of NULLs
+    groups = [row for row in groups if row['count']]
+    top = db.session.execute(select(table.c).select_from(table if source is None else source)
+      .where(match).order_by(desc(table.c.price), desc(table.c.id)).limit(1),
+      mapper=mapper).first() if groups else None
+    count = sum(row['count'] for row in groups)
+    total = sum((Decimal(row['total']) for row in groups), Decimal(0))
+    by_status = {availability.name: 0 for availability in Availability}
+    by_in_cart_status = {cart_status.name: 0 for cart_status in InCartStatus}
+    for row in groups:
+      by_status[row['status'].name] += row['count']
+      by_in_cart_status[row['in_cart_status'].name] += row['count']
+    return {
+      "item_count": count,
+      "total_price": total,
+      "average_price": total / count if count else None,
+      "by_status": by_status,
+      "by_in_cart_status": by_in_cart_status,
+      "most_expensive": cls(**dict(top)).serialize() if top else None,
+    }
+
+  @classmethod
+  @by_wishlist
   def find_by_wishlist_id_and_product_id(cls,wishlist_id:int,product_id:int)->list:
     """Find products by wishlist id they belong to and product id"""
     logger.info("Products: processing name query for wishlist %s and product %s...",\
@@ -202,13 +624,26 @@ class Product(db.Model):
     return res[0]
 
   @classmethod
+  @by_wishlist
   def delete_by_wishlist_id_and_product_id(cls, wishlist_id:int, pid:int) -> int:
-    """Delete products by wishlist id they belong to and product id"""
+    """Delete a product by wishlist id it belongs to and product id, in one statement
+
+    Returns the number of products deleted, 0 or 1.
+    """
     logger.info("Products: processing deletion for wishlist_id %s"\
       "and product_id %s ...", wishlist_id, pid)
-    entity = Product.find_by_wishlist_id_and_product_id(wishlist_id, pid)
-    if entity is not None:
-      entity.delete()
+    table = cls.__table__
+    delete = table.delete().where(
+      and_(table.c.wishlist_id == int(wishlist_id), table.c.id == int(pid)))
+    with unit_of_work():
+      cnt = db.session.execute(delete, mapper=cls.__mapper__).rowcount
+      if cnt:
+        outbox.record(outbox.PRODUCT, outbox.DELETED, [(int(pid), int(wishlist_id))])
+      loaded = cls._loaded(pid)
+      if cnt and loaded is not None:
+        # detach the session's copy before the commit expires it, like an ORM delete
+        db.session.expunge(loaded)
+    return cnt
 
   @classmethod
   def delete_all_by_wishlist_id(cls, wishlist_id:int):
@@ -216,7 +651,7 @@ class Product(db.Model):
     logger.info("Product: processing deletion for wishlist_id %s ...", wishlist_id)
     entities = Product.find_all_by_wishlist_id(wishlist_id)
     cnt = 0
-    if len(entities) != 0:
+    with unit_of_work():
       for entity in entities:
         cnt += 1
         entity.delete()
@@ -0,0 +1,106 @@
+"""
+Read replica and shard routing
+
+Replicas are configured as SQLALCHEMY_BINDS named replica_0, replica_1, ...
+Queries issued by views decorated with @read_only are sent to a random
+replica, everything else (and every flush) goes to the primary. A client
+that wrote recently keeps reading from the primary for REPLICA_LAG_WINDOW
+seconds, so it always sees its own writes.
+
+When shards are configured (see sharding.py) queries go to the shard
+selected for the current block and flushes to the shard of each instance.
+"""
+
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import BaseQuery, SignallingSession, get_state
+from sqlalchemy import orm
+
+from .pool import PooledSQLAlchemy
+from .sharding import current_shard, instance_shard, shard_engine, shard_keys, use_shard
+
+REPLICA_BIND_PREFIX = "replica_"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+def replica_binds(uris:list) -> dict:
+  """Returns SQLALCHEMY_BINDS entries for a list of replica URIs"""
+  return {"{0}{1}".format(REPLICA_BIND_PREFIX, i): uri for i, uri in enumerate(uris)}
+
+def read_only(func):
+  """Marks a view as read-only, its queries may be served by a replica"""
+  @wraps(func)
+  def wrapper(*args, **kwargs):
+    g.read_only = True
+    try:
+      return func(*args, **kwargs)
+    finally:
+      g.read_only = False
+  return wrapper
+
+def _replica_keys(app) -> list:
+  binds = app.config.get('SQLALCHEMY_BINDS') or {}
+  return [key for key in binds if key.startswith(REPLICA_BIND_PREFIX)]
+
+def _wrote_recently(app) -> bool:
+  last_write = session.get('last_write_at')
+  return last_write is not None and \
+    time.time() - last_write < app.config.get('REPLICA_LAG_WINDOW', 0)
+
+def remember_write(response):
+  """Records when a client last wrote, to route its next reads to the primary"""
+  if request.method not in SAFE_METHODS and response.status_code < 400 \
+    and _replica_keys(current_app):
+    session['last_write_at'] = time.time()
+  return response
+
+class RoutingSession(SignallingSession):
+  """Session routing queries to the current shard, or reads of read-only views to a replica"""
+
+  def __init__(self, db, **options):
+    super().__init__(db, **options)
+    if shard_keys(self.app):
+      # flush every instance to its own shard
+      self.connection_callable = self._instance_connection
+
+  def _instance_connection(self, mapper=None, instance=None, **kwargs):
+    key = instance_shard(instance)
+    if key is None:
+      return self.connection(mapper, **kwargs)
+    return self.connection(mapper, bind=shard_engine(key, self.app), **kwargs)
+
+  def _replica_engine(self):
+    if self._flushing or not has_request_context() or not g.get('read_only'):
+      return None
+    keys = _replica_keys(self.app)
+    if not keys or _wrote_recently(self.app):
+      return None
+    return get_state(self.app).db.get_engine(self.app, bind=random.choice(keys))
+
+  def get_bind(self, mapper=None, clause=None):
+    key = current_shard()
+    if key is not None:
+      return shard_engine(key, self.app)
+    return self._replica_engine() or super().get_bind(mapper, clause)
+
+class RoutingQuery(BaseQuery):
+  """Query refreshing expired instances from the shard they belong to"""
+
+  def _connection_from_session(self, **kw):
+    instance = self._refresh_state.obj() if self._refresh_state is not None else None
+    key = getattr(instance, '_shard', None)
+    if key is None:
+      return super()._connection_from_session(**kw)
+    with use_shard(key):
+      return super()._connection_from_session(**kw)
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+  """SQLAlchemy extension using the replica and shard aware RoutingSession"""
+
+  def __init__(self, *args, query_class=RoutingQuery, **kwargs):
+    super().__init__(*args, query_class=query_class, **kwargs)
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,255 @@
+"""
+Bulk seeding of synthetic Wishlist and Product data
+
+Data is generated in fixed-size chunks. Every chunk gets its own random
+generator derived from the seed and the chunk index, so the generated rows
+only depend on the seed and the chunk size - never on how many worker
+processes produced them. Chunks are generated in a process pool and loaded
+in order, with PostgreSQL COPY when available and batched multi-row INSERTs
+otherwise.
+
+On shards, the rows of every chunk are loaded on the shard of their user,
+with ids allocated on that shard, so the generated wishlist ids are
+replaced. Seeded rows get the load time as updated_at, so delta syncs see
+them. They are not written to the change feed.
+"""
+
+import csv
+import io
+import random
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, islice
+
+from sqlalchemy import func
+
+from .model_utils import db, logger, Availability, InCartStatus
+from .sharding import allocate_ids, shard_engine, shard_for_user, shard_keys
+from .wishlist import Wishlist
+from .product import Product
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_BATCH_SIZE = 5000
+
+WISHLIST_COLUMNS = ('id', 'name', 'user_id', 'updated_at')
+PRODUCT_COLUMNS = ('name', 'price', 'status', 'pic_url', 'short_desc',
+  'inventory_product_id', 'wishlist_id', 'in_cart_status', 'updated_at')
+# products get shard unique ids on shards, instead of the database's
+SHARD_PRODUCT_COLUMNS = ('id',) + PRODUCT_COLUMNS
+
+WISHLIST_THEMES = ['Birthday', 'Holidays', 'Kitchen', 'Books', 'Gaming', 'Garden',
+  'Wedding', 'Baby', 'Travel', 'Office', 'Fitness', 'Back to school']
+CATALOG_CATEGORIES = ['toy', 'book', 'tv', 'drink', 'bread', 'ball', 'lamp', 'mug',
+  'shirt', 'shoes', 'phone', 'chair']
+
+# (weight, value) pairs used to draw product states
+STATUS_WEIGHTS = [(90, Availability.AVAILABLE.name), (10, Availability.UNAVAILABLE.name)]
+IN_CART_WEIGHTS = [(85, InCartStatus.DEFAULT.name), (10, InCartStatus.IN_CART.name),
+  (5, InCartStatus.ORDERED.name)]
+
+_catalog_cache = {}
+
+class SeedOptions:
+  """Parameters describing the shape of a generated dataset"""
+  def __init__(self, wishlists:int, users:int=None, seed:int=0, avg_products:float=8.0,
+    max_products:int=500, catalog_size:int=100000, popularity:float=1.1,
+    chunk_size:int=DEFAULT_CHUNK_SIZE) -> None:
+    self.wishlists = wishlists
+    self.users = users or max(1, wishlists // 3)
+    self.seed = seed
+    self.avg_products = avg_products
+    self.max_products = max_products
+    self.catalog_size = catalog_size
+    self.popularity = popularity
+    self.chunk_size = chunk_size
+
+  def chunks(self, first_wishlist_id:int) -> list:
+    """Split the dataset into (options, chunk index, first id, size) work items"""
+    return [
+      (self, index, first_wishlist_id + start, min(self.chunk_size, self.wishlists - start))
+      for index, start in enumerate(range(0, self.wishlists, self.chunk_size))
+    ]
+
+def _catalog(options:SeedOptions):
+  """Build (and cache per process) the inventory catalog and its popularity weights"""
+  key = (options.seed, options.catalog_size, options.popularity)
+  if key not in _catalog_cache:
+    rng = random.Random("{0}:catalog".format(options.seed))
+    items = []
+    for inventory_id in range(1, options.catalog_size + 1):
+      category = rng.choice(CATALOG_CATEGORIES)
+      items.append((
+        "{0} {1}".format(category, inventory_id),
+        round(rng.lognormvariate(3.0, 1.0) + 0.5, 2),
+        "www.{0}.com/{1}.png".format(category, inventory_id),
+        "this is a {0}".format(category),
+      ))
+    # Zipf-like popularity: the item with rank k is drawn with weight 1 / k^s
+    weights = accumulate(1.0 / rank ** options.popularity
+      for rank in range(1, options.catalog_size + 1))
+    _catalog_cache[key] = (items, list(weights))
+  return _catalog_cache[key]
+
+def _weighted(rng:random.Random, pairs:list, k:int) -> list:
+  return rng.choices([value for _, value in pairs], weights=[w for w, _ in pairs], k=k)
+
+def generate_chunk(work_item:tuple) -> tuple:
+  """Generate the wishlist and product rows of one chunk
+
+  Products get no id, the database assigns them in load order. Rows get no
+  updated_at, it is set when they are loaded.
+  """
+  options, index, first_id, size = work_item
+  rng = random.Random("{0}:{1}:{2}".format(options.seed, options.chunk_size, index))
+  items, cum_weights = _catalog(options)
+  inventory_ids = range(1, options.catalog_size + 1)
+  alpha = 1.5
+  scale = options.avg_products * (alpha - 1) / alpha
+
+  wishlists = []
+  products = []
+  for wishlist_id in range(first_id, first_id + size):
+    wishlists.append((wishlist_id,
+      "{0} {1}".format(rng.choice(WISHLIST_THEMES), rng.randint(1, 99)),
+      rng.randint(1, options.users)))
+
+    # heavy-tailed number of products per wishlist (Pareto)
+    count = min(options.max_products, options.catalog_size, int(scale * rng.paretovariate(alpha)))
+    chosen = []
+    seen = set()
+    while len(chosen) < count:
+      for inventory_id in rng.choices(inventory_ids, cum_weights=cum_weights, k=count):
+        if inventory_id not in seen and len(chosen) < count:
+          seen.add(inventory_id)
+          chosen.append(inventory_id)
+
+    statuses = _weighted(rng, STATUS_WEIGHTS, count)
+    in_cart = _weighted(rng, IN_CART_WEIGHTS, count)
+    for i, inventory_id in enumerate(chosen):
+      name, price, pic_url, short_desc = items[inventory_id - 1]
+      products.append((name, price, statuses[i], pic_url, short_desc,
+        inventory_id, wishlist_id, in_cart[i]))
+
+  return wishlists, products
+
+def _copy_rows(connection, table:str, columns:tuple, rows:list):
+  """Load rows with PostgreSQL COPY"""
+  buffer = io.StringIO()
+  csv.writer(buffer).writerows(rows)
+  buffer.seek(0)
+  cursor = connection.cursor()
+  cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)"\
+    .format(table, ", ".join(columns)), buffer)
+  cursor.close()
+
+def _insert_rows(connection, table, columns:tuple, rows:list, batch_size:int):
+  """Load rows with batched multi-row INSERT statements"""
+  for start in range(0, len(rows), batch_size):
+    batch = [dict(zip(columns, row)) for row in rows[start:start + batch_size]]
+    connection.execute(table.insert(), batch)
+
+def _load_chunk(engine, wishlists:list, products:list, batch_size:int,
+  product_columns:tuple=PRODUCT_COLUMNS):
+  """Load one generated chunk in its own transaction"""
+  if engine.dialect.name == 'postgresql':
+    connection = engine.raw_connection()
+    try:
+      _copy_rows(connection, Wishlist.__tablename__, WISHLIST_COLUMNS, wishlists)
+      _copy_rows(connection, Product.__tablename__, product_columns, products)
+      connection.commit()
+    except Exception:
+      connection.rollback()
+      raise
+    finally:
+      connection.close()
+  else:
+    with engine.begin() as connection:
+      _insert_rows(connection, Wishlist.__table__, WISHLIST_COLUMNS, wishlists, batch_size)
+      _insert_rows(connection, Product.__table__, product_columns, products, batch_size)
+
+def _stamped(rows:list, updated_at:datetime) -> list:
+  return [row + (updated_at,) for row in rows]
+
+def _split_by_shard(wishlists:list, products:list) -> dict:
+  """Splits the rows of a chunk by the shard of their user, {shard: (wishlists, products)}"""
+  chunks = {}
+  shards = {}
+  for row in wishlists:
+    shards[row[0]] = shard_for_user(row[2])
+    chunks.setdefault(shards[row[0]], ([], []))[0].append(row)
+  position = PRODUCT_COLUMNS.index('wishlist_id')
+  for row in products:
+    chunks[shards[row[position]]][1].append(row)
+  return chunks
+
+def _with_shard_ids(engine, key:str, wishlists:list, products:list) -> tuple:
+  """Gives the rows of a shard ids allocated on it, products follow their wishlist"""
+  with engine.connect() as connection:
+    wishlist_ids = allocate_ids(connection, Wishlist.__table__, key, len(wishlists))
+    product_ids = allocate_ids(connection, Product.__table__, key, len(products))
+  new_ids = {row[0]: new_id for row, new_id in zip(wishlists, wishlist_ids)}
+  position = PRODUCT_COLUMNS.index('wishlist_id')
+  return [(new_id,) + row[1:] for row, new_id in zip(wishlists, wishlist_ids)], \
+    [(new_id,) + row[:position] + (new_ids[row[position]],) + row[position + 1:]
+      for row, new_id in zip(products, product_ids)]
+
+def _reset_sequences(engine):
+  """Move PostgreSQL id sequences past the explicitly inserted wishlist ids"""
+  if engine.dialect.name != 'postgresql':
+    return
+  with engine.begin() as connection:
+    connection.execute(
+      "SELECT setval(pg_get_serial_sequence('wishlist', 'id'), "\
+      "(SELECT COALESCE(MAX(id), 0) + 1 FROM wishlist), false)"
+    )
+
+def _generated_chunks(work:list, workers:int):
+  """Yield generated chunks in order, keeping at most 2 * workers chunks in flight"""
+  if workers <= 1:
+    for item in work:
+      yield generate_chunk(item)
+    return
+
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    items = iter(work)
+    pending = deque(executor.submit(generate_chunk, item)
+      for item in islice(items, 2 * workers))
+    while pending:
+      chunk = pending.popleft().result()
+      item = next(items, None)
+      if item is not None:
+        pending.append(executor.submit(generate_chunk, item))
+      yield chunk
+
+def bulk_seed(options:SeedOptions, workers:int=1, batch_size:int=DEFAULT_BATCH_SIZE) -> tuple:
+  """Generate and load a synthetic dataset, returns (wishlists, products) created"""
+  engine = db.engine
+  keys = shard_keys()
+  db.session.remove()
+  # on shards the generated ids are replaced by ids allocated on each shard
+  first_id = 1 if keys else (db.session.query(func.max(Wishlist.id)).scalar() or 0) + 1
+  db.session.remove()
+  logger.info("Seeding %s wishlists starting at id %s with %s workers ...",\
+    options.wishlists, first_id, workers)
+
+  updated_at = datetime.utcnow()
+  wishlist_cnt = 0
+  product_cnt = 0
+  for wishlists, products in _generated_chunks(options.chunks(first_id), workers):
+    wishlists, products = _stamped(wishlists, updated_at), _stamped(products, updated_at)
+    if not keys:
+      _load_chunk(engine, wishlists, products, batch_size)
+    else:
+      for key, (shard_wishlists, shard_products) in _split_by_shard(wishlists, products).items():
+        shard = shard_engine(key)
+        shard_wishlists, shard_products = _with_shard_ids(shard, key, shard_wishlists,
+          shard_products)
+        _load_chunk(shard, shard_wishlists, shard_products, batch_size, SHARD_PRODUCT_COLUMNS)
+    wishlist_cnt += len(wishlists)
+    product_cnt += len(products)
+    logger.info("Seeded %s wishlists and %s products so far", wishlist_cnt, product_cnt)
+
+  if not keys:
+    _reset_sequences(engine)
+  return wishlist_cnt, product_cnt
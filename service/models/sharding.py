@@ -0,0 +1,261 @@
+"""
+User id sharding
+
+Shards are configured as SQLALCHEMY_BINDS named shard_0, shard_1, ... and
+every shard holds the full schema. A consistent hash ring maps a user_id to
+its shard, so adding a shard only moves about 1/N of the users.
+
+Wishlist and Product ids are unique across shards: an id allocated on
+shard k is always k modulo SHARD_ID_STRIDE, which gives a cheap first guess
+of where an entity lives. Model finders pick their shard with the
+by_user / by_wishlist / by_id decorators, and queries without a shard key
+are scattered to every shard with scattered. Flushes go to the shard the
+instance was loaded from or created on. Without shard binds every decorator
+is a no-op and the default database is used.
+"""
+
+import bisect
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+
+from flask import current_app
+from flask_sqlalchemy import get_state
+from sqlalchemy import event
+from sqlalchemy.orm.util import identity_key
+
+SHARD_BIND_PREFIX = "shard_"
+# upper bound of the number of shards, ids encode their shard modulo this value
+SHARD_ID_STRIDE = 64
+VIRTUAL_NODES = 100
+
+_current_shard = ContextVar("current_shard", default=None)
+
+class HashRing:
+  """Consistent hash ring mapping keys to shard names"""
+
+  def __init__(self, shards:list, vnodes:int=VIRTUAL_NODES) -> None:
+    self.shards = list(shards)
+    points = sorted(
+      (self._hash("{0}#{1}".format(shard, i)), shard)
+      for shard in self.shards for i in range(vnodes)
+    )
+    self._hashes = [h for h, _ in points]
+    self._owners = [shard for _, shard in points]
+
+  @staticmethod
+  def _hash(value:str) -> int:
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+  def get(self, key) -> str:
+    """Returns the shard owning a key"""
+    index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+    return self._owners[index]
+
+@lru_cache(maxsize=8)
+def _ring(shards:tuple) -> HashRing:
+  return HashRing(shards)
+
+def shard_binds(uris:list) -> dict:
+  """Returns SQLALCHEMY_BINDS entries for a list of shard URIs"""
+  return {"{0}{1}".format(SHARD_BIND_PREFIX, i): uri for i, uri in enumerate(uris)}
+
+def shard_keys(app=None) -> list:
+  """Returns the configured shard binds, an empty list when sharding is disabled"""
+  binds = (app or current_app).config.get('SQLALCHEMY_BINDS') or {}
+  return sorted((key for key in binds if key.startswith(SHARD_BIND_PREFIX)), key=_index)
+
+def shard_engine(key:str, app=None):
+  """Returns the engine of a shard"""
+  app = app or current_app._get_current_object()
+  return get_state(app).db.get_engine(app, bind=key)
+
+def current_shard():
+  """Returns the shard the current queries are sent to"""
+  return _current_shard.get()
+
+@contextmanager
+def use_shard(key:str):
+  """Sends the queries of the block to a shard"""
+  token = _current_shard.set(key)
+  try:
+    yield key
+  finally:
+    _current_shard.reset(token)
+
+def _index(key:str) -> int:
+  return int(key[len(SHARD_BIND_PREFIX):])
+
+def shard_for_user(user_id:int) -> str:
+  """Returns the shard owning a user's data"""
+  return _ring(tuple(shard_keys())).get(int(user_id))
+
+def candidate_shards(entity_id) -> list:
+  """Returns all shards, starting with the one the id was allocated on"""
+  keys = shard_keys()
+  try:
+    hint = "{0}{1}".format(SHARD_BIND_PREFIX, int(entity_id) % SHARD_ID_STRIDE)
+  except (TypeError, ValueError):
+    return keys
+  return sorted(keys, key=lambda key: key != hint)
+
+def locate(model, entity_id):
+  """Returns the shard holding an entity, or None if it does not exist"""
+  try:
+    key = identity_key(model, int(entity_id))
+  except (TypeError, ValueError):
+    return None
+  loaded = get_state(current_app).db.session.identity_map.get(key)
+  if loaded is not None and getattr(loaded, '_shard', None):
+    return loaded._shard
+  for shard in candidate_shards(entity_id):
+    with use_shard(shard):
+      if model.query.with_entities(model.id).filter(model.id == entity_id).first():
+        return shard
+  return None
+
+def scattered(func):
+  """Runs a finder on every shard and merges the lists it returns by id"""
+  @wraps(func)
+  def wrapper(cls, *args, **kwargs):
+    keys = shard_keys()
+    if not keys:
+      return func(cls, *args, **kwargs)
+    res = []
+    for key in keys:
+      with use_shard(key):
+        res.extend(func(cls, *args, **kwargs))
+    return sorted(res, key=lambda entity: entity.id)
+  return wrapper
+
+def by_user(func):
+  """Runs a finder taking a user_id on the user's shard"""
+  @wraps(func)
+  def wrapper(cls, user_id, *args, **kwargs):
+    if not shard_keys():
+      return func(cls, user_id, *args, **kwargs)
+    with use_shard(shard_for_user(user_id)):
+      return func(cls, user_id, *args, **kwargs)
+  return wrapper
+
+def shard_for_wishlist(wishlist_id) -> str:
+  """Returns the shard holding a wishlist and its products"""
+  from .wishlist import Wishlist
+  return locate(Wishlist, wishlist_id) or candidate_shards(wishlist_id)[0]
+
+def by_wishlist(func):
+  """Runs a finder taking a wishlist_id on the wishlist's shard"""
+  @wraps(func)
+  def wrapper(cls, wishlist_id, *args, **kwargs):
+    if not shard_keys():
+      return func(cls, wishlist_id, *args, **kwargs)
+    with use_shard(shard_for_wishlist(wishlist_id)):
+      return func(cls, wishlist_id, *args, **kwargs)
+  return wrapper
+
+def by_id(func):
+  """Runs a finder taking an entity id on each candidate shard until it finds it"""
+  @wraps(func)
+  def wrapper(cls, entity_id, *args, **kwargs):
+    keys = shard_keys()
+    if not keys:
+      return func(cls, entity_id, *args, **kwargs)
+    for key in candidate_shards(entity_id):
+      with use_shard(key):
+        res = func(cls, entity_id, *args, **kwargs)
+      if res is not None:
+        return res
+    return None
+  return wrapper
+
+def instance_shard(instance):
+  """Returns the shard an instance belongs to"""
+  return getattr(instance, '_shard', None) or current_shard()
+
+def _next_id(connection, table) -> int:
+  """Allocates the next shard local id number"""
+  if connection.dialect.name == 'postgresql':
+    return connection.execute(
+      "SELECT nextval(pg_get_serial_sequence('{0}', 'id'))".format(table.name)).scalar()
+  last_id = connection.execute(
+    "SELECT COALESCE(MAX(id), 0) FROM {0}".format(table.name)).scalar()
+  return last_id // SHARD_ID_STRIDE + 1
+
+def allocate_id(connection, table, key:str) -> int:
+  """Allocates an id on a shard, for rows inserted without the ORM"""
+  return _next_id(connection, table) * SHARD_ID_STRIDE + _index(key)
+
+def allocate_ids(connection, table, key:str, count:int) -> list:
+  """Allocates count ids on a shard at once, for rows bulk loaded without the ORM
+
+  On SQLite the ids follow the largest one stored, insert the rows before
+  allocating more.
+  """
+  if connection.dialect.name == 'postgresql':
+    numbers = [row[0] for row in connection.execute(
+      "SELECT nextval(pg_get_serial_sequence('{0}', 'id')) FROM generate_series(1, {1})"
+      .format(table.name, int(count)))]
+  else:
+    first = _next_id(connection, table)
+    numbers = range(first, first + count)
+  return [number * SHARD_ID_STRIDE + _index(key) for number in numbers]
+
+def install(model_base):
+  """Tags loaded instances with their shard and allocates shard unique ids"""
+
+  @event.listens_for(model_base, "load", propagate=True)
+  def _tag_loaded(target, context):
+    key = current_shard()
+    if key is not None:
+      target._shard = key
+
+  @event.listens_for(model_base, "before_insert", propagate=True)
+  def _allocate_id(mapper, connection, target):
+    key = instance_shard(target)
+    if key is None or 'id' not in mapper.local_table.c or target.id is not None:
+      return
+    target._shard = key
+    target.id = allocate_id(connection, mapper.local_table, key)
+
+def create_all(db, app=None):
+  """Creates the tables on every shard"""
+  for key in shard_keys(app):
+    db.Model.metadata.create_all(bind=shard_engine(key, app))
+
+def drop_all(db, app=None):
+  """Drops the tables on every shard"""
+  for key in shard_keys(app):
+    db.Model.metadata.drop_all(bind=shard_engine(key, app))
+
+def rebalance(app=None) -> int:
+  """Moves the wishlists of users owned by another shard, returns the number moved
+
+  Run it after adding shards. Rows keep their ids, so they stay unique.
+  """
+  from .wishlist import Wishlist
+  from .product import Product
+  keys = shard_keys(app)
+  ring = _ring(tuple(keys))
+  wishlists, products = Wishlist.__table__, Product.__table__
+  moved = 0
+  for source in keys:
+    source_engine = shard_engine(source, app)
+    misplaced = {}
+    for row in source_engine.execute(wishlists.select()):
+      target = ring.get(row.user_id)
+      if target != source:
+        misplaced.setdefault(target, []).append(dict(row))
+    for target, rows in misplaced.items():
+      ids = [row['id'] for row in rows]
+      product_rows = [dict(row) for row in source_engine.execute(
+        products.select().where(products.c.wishlist_id.in_(ids)))]
+      with shard_engine(target, app).begin() as connection:
+        connection.execute(wishlists.insert(), rows)
+        if product_rows:
+          connection.execute(products.insert(), product_rows)
+      with source_engine.begin() as connection:
+        connection.execute(products.delete().where(products.c.wishlist_id.in_(ids)))
+        connection.execute(wishlists.delete().where(wishlists.c.id.in_(ids)))
+      moved += len(rows)
+  return moved
@@ -0,0 +1,88 @@
+"""
+Unit of work
+
+Model methods add, change and delete rows and flush them, and the unit of
+work they run in commits once when it ends, or rolls everything back if it
+fails. Every request that may write (POST, PUT, PATCH, DELETE) is a unit of
+work, so a request issues a single COMMIT however many models it touches.
+Batch operations outside a request open one explicitly:
+
+  with unit_of_work():
+    for product in products:
+      product.delete()
+
+Units of work nest, only the outermost one commits. A model method called
+outside of any unit of work is a unit of work of its own.
+"""
+
+from contextlib import contextmanager
+
+from flask import request
+
+from .routing import SAFE_METHODS
+
+DEPTH_KEY = "unit_of_work_depth"
+# kept on the request, not on g: the operations of POST /batch run in
+# request contexts of their own that share the app context of the batch
+REQUEST_KEY = "service.unit_of_work"
+
+def _session():
+  # imported here, the models themselves import this module
+  from .model_utils import db
+  return db.session
+
+def depth(session) -> int:
+  """Returns how many units of work are open on the session"""
+  return session.info.get(DEPTH_KEY, 0)
+
+def begin(session):
+  """Opens a unit of work on the session"""
+  session.info[DEPTH_KEY] = depth(session) + 1
+
+def end(session, success:bool=True):
+  """Closes a unit of work, the outermost one commits or rolls back the session"""
+  session.info[DEPTH_KEY] = depth(session) - 1
+  if depth(session) > 0:
+    return
+  if success:
+    try:
+      session.commit()
+    except Exception:
+      session.rollback()
+      raise
+  else:
+    session.rollback()
+
+@contextmanager
+def unit_of_work(session=None):
+  """Runs a block in a unit of work, committing once when the outermost block ends"""
+  if session is None:
+    session = _session()
+  begin(session)
+  try:
+    yield session
+  except BaseException:
+    end(session, success=False)
+    raise
+  end(session)
+
+def _begin_request():
+  if request.method not in SAFE_METHODS:
+    begin(_session())
+    request.environ[REQUEST_KEY] = True
+
+def _end_request(response):
+  if request.environ.pop(REQUEST_KEY, False):
+    end(_session(), success=response.status_code < 400)
+  return response
+
+def _abort_request(error):
+  if request.environ.pop(REQUEST_KEY, False):
+    # the view raised, nothing it did is committed
+    end(_session(), success=False)
+
+def init_app(app):
+  """Makes every request that may write a unit of work"""
+  app.before_request(_begin_request)
+  app.after_request(_end_request)
+  app.teardown_request(_abort_request)
@@ -10,15 +10,22 @@ Attributes:
 id
 user_id
 name
+updated_at
 
 """
 
+from collections import defaultdict
+from datetime import datetime
+
 from flask import Flask
-from sqlalchemy import asc
+from sqlalchemy import and_, asc, or_, select
 
 from service.models.product import Product
 from service.models.model_utils import MAX_NAME_LENGTH, EntityNotFoundError, db, \
   logger,DataValidationError
+from service.models.sharding import by_id, by_user, scattered, shard_for_user, shard_keys
+from service.models.unit_of_work import unit_of_work
+from service.models import outbox
 
 class Wishlist(db.Model):
   """Represents a Wishlist Model in the database."""
@@ -27,6 +34,11 @@ class Wishlist(db.Model):
   id = db.Column(db.Integer,primary_key = True)
   name = db.Column(db.String(64), nullable=False)
   user_id = db.Column(db.Integer, nullable=False)
+  # last write; NULL for rows written before it was tracked
+  updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+    onupdate=datetime.utcnow)
+
+  __table_args__ = (db.Index('ix_wishlist_user_id_updated_at', 'user_id', 'updated_at'),)
 
   def serialize(self)->dict:
     """Turns a Wishlist instance into a dictionary-like object"""
@@ -56,25 +68,35 @@ class Wishlist(db.Model):
       raise DataValidationError(error.args[0])
     return self
 
+  @staticmethod
+  def unique_name(name:str, taken:list) -> str:
+    """Returns name, suffixed with the first free number if a wishlist already uses it"""
+    if name not in taken:
+      return name
+    num = 1
+    while '{0} {1}'.format(name, num) in taken:
+      num += 1
+    return '{0} {1}'.format(name, num)
+
   def create(self):
     """Create Wishlist instance in database"""
     logger.info("Creating %s ...", self.name)
     self.id = None
-    db.session.add(self)
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
+    if shard_keys():
+      self._shard = shard_for_user(self.user_id)
+    with unit_of_work():
+      db.session.add(self)
+      db.session.flush()
+      outbox.record_instance(self, outbox.CREATED)
 
   def update(self):
     """Update Wishlist instance in database"""
     logger.info("Updating wishlist %s ...", self.name)
     if not self.id:
       raise DataValidationError("Update called with empty ID field")
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
+    with unit_of_work():
+      db.session.flush()
+      outbox.record_instance(self, outbox.UPDATED)
 
   def read(self):
     """Read Wishlist instance from database"""
@@ -91,11 +113,12 @@ class Wishlist(db.Model):
     logger.info("Wishlist: deleting products from wishlist with id %s. products are %s ...",\
       self.id,product_ids)
     cnt = 0
-    for pid in product_ids:
-      entity = Product.find_by_wishlist_id_and_product_id(self.id, pid)
-      if entity is not None:
-        cnt += 1
-        entity.delete()
+    with unit_of_work():
+      for pid in product_ids:
+        entity = Product.find_by_wishlist_id_and_product_id(self.id, pid)
+        if entity is not None:
+          cnt += 1
+          entity.delete()
     return cnt
 
   def delete(self):
@@ -109,27 +132,111 @@ class Wishlist(db.Model):
       logger.info("Wishlist: cannot find wishlist with id %s ...", self.id)
       return 0
 
-    Product.delete_all_by_wishlist_id(self.id)
     logger.info("Deleting wishlist %s", self.name)
-    db.session.delete(self)
-    try:
-      db.session.commit()
-    except:
-      db.session.rollback()
+    with unit_of_work():
+      Product.delete_all_by_wishlist_id(self.id)
+      db.session.delete(self)
+      db.session.flush()
+      outbox.record_instance(self, outbox.DELETED)
+
+  def clone(self, name:str=None) -> 'Wishlist':
+    """Copies the wishlist and its products for its user, returns the copy
+
+    The copy is named name, by default like the wishlist, suffixed with a number
+    when the user already has a wishlist of that name. Raises DataValidationError
+    when the suffixed name is too long.
+    """
+    logger.info("Wishlist: cloning wishlist with id %s ...", self.id)
+    taken = Wishlist.find_names_by_user_id(self.user_id)
+    name = Wishlist.unique_name(name or self.name, taken)
+    if len(name) > MAX_NAME_LENGTH:
+      raise DataValidationError(f"Name field should be shorter than {MAX_NAME_LENGTH} characters")
+    copy = Wishlist(name=name, user_id=self.user_id)
+    with unit_of_work():
+      copy.create()
+      Product.copy_all(self.id, copy.id)
+    return copy
+
+  def merge_into(self, target:'Wishlist') -> list:
+    """Moves the products of the wishlist to target and deletes it, returns the products moved
+
+    Both wishlists belong to the same user. Products of inventory items target
+    already holds are deleted with the wishlist.
+    """
+    if target.id == self.id or target.user_id != self.user_id:
+      raise DataValidationError("A wishlist is merged into another wishlist of its user")
+    logger.info("Wishlist: merging wishlist with id %s into %s ...", self.id, target.id)
+    with unit_of_work():
+      moved = Product.move_all(self.id, target.id)
+      self.delete()
+    return moved
 
   @classmethod
+  @scattered
   def find_all(cls):
     """ Finds all Wishlists in database """
     logger.info("Wishlist: processing lookup for all wishlists")
     return cls.query.all()
 
   @classmethod
+  @by_id
   def find_by_id(cls, wishlist_id:int):
     """ Finds a Wishlist by id in database """
     logger.info("Wishlist: processing deletion for id %s ...", wishlist_id)
     return cls.query.get(wishlist_id)
 
   @classmethod
+  @scattered
+  def find_all_by_ids(cls, wishlist_ids:list):
+    """ Finds the Wishlists with the given ids in database """
+    logger.info("Wishlist: processing lookup for %s ids", len(wishlist_ids))
+    return cls.query.filter(cls.id.in_(wishlist_ids)).all()
+
+  @classmethod
+  def read_all_by_ids(cls, wishlist_ids:list) -> list:
+    """ Reads the Wishlists with the given ids and their products, in two queries """
+    wishlists = cls.find_all_by_ids(wishlist_ids)
+    products = defaultdict(list)
+    if wishlists:
+      for product in Product.find_all_by_wishlist_ids([wishlist.id for wishlist in wishlists]):
+        products[product.wishlist_id].append(product)
+    return [WishlistVo(wishlist, products[wishlist.id]).serialize() for wishlist in wishlists]
+
+  @classmethod
+  @by_user
+  def find_ids_by_user_id(cls, user_id:int) -> list:
+    """ Finds the ids of the Wishlists that belong to user_id in database """
+    return [row.id for row in cls.query.with_entities(cls.id).filter(cls.user_id == user_id)]
+
+  @classmethod
+  @by_user
+  def find_names_by_user_id(cls, user_id:int) -> list:
+    """ Finds the names of the Wishlists that belong to user_id in database """
+    return [row.name for row in cls.query.with_entities(cls.name).filter(cls.user_id == user_id)]
+
+  @classmethod
+  @by_id
+  def summary_by_id(cls, wishlist_id:int) -> dict:
+    """ Returns the summary of the products of a Wishlist, None if it does not exist
+
+    One query counts the products and tells whether the Wishlist exists, a second one
+    reads the most expensive product, when there is one (see Product.summarize).
+    """
+    logger.info("Wishlist: processing summary for id %s ...", wishlist_id)
+    table, products = cls.__table__, Product.__table__
+    return Product.summarize(table.c.id == int(wishlist_id),
+      table.outerjoin(products, products.c.wishlist_id == table.c.id))
+
+  @classmethod
+  @by_user
+  def summary_by_user_id(cls, user_id:int) -> dict:
+    """ Returns the summary of the products of all the Wishlists of user_id """
+    logger.info("Wishlist: processing summary for user id %s ...", user_id)
+    return Product.summarize(Product.__table__.c.wishlist_id.in_(
+      select([cls.__table__.c.id]).where(cls.__table__.c.user_id == int(user_id))))
+
+  @classmethod
+  @by_user
   def find_all_by_user_id(cls,user_id:int)->list:
     """ Finds all Wishlist that belong to user_id in database """
     logger.info("Wishlist: porcessing lookup for user id: %s ...",\
@@ -146,6 +253,33 @@ class Wishlist(db.Model):
 
     return [vo.serialize() for vo in res]
 
+  @classmethod
+  @by_user
+  def find_changed_by_user_id(cls, user_id:int, since:datetime=None) -> dict:
+    """ Finds what changed in the Wishlists of user_id after since, everything if since is None
+
+    Deletions are read from the outbox, where they are kept for CHANGES_RETENTION.
+    """
+    logger.info("Wishlist: processing changes of user id %s since %s ...", user_id, since)
+    wishlists = cls.query.filter(cls.user_id == user_id)
+    products = Product.query.join(cls, Product.wishlist_id == cls.id) \
+      .filter(cls.user_id == user_id)
+    res = {"deleted_wishlists": [], "deleted_products": []}
+    if since is not None:
+      wishlists = wishlists.filter(cls.updated_at > since)
+      products = products.filter(Product.updated_at > since)
+      wishlist_ids = cls.query.with_entities(cls.id).filter(cls.user_id == user_id)
+      Change = outbox.Change
+      deleted = Change.query.with_entities(Change.entity, Change.entity_id).filter(
+        Change.action == outbox.DELETED, Change.created_at > since,
+        or_(and_(Change.entity == outbox.WISHLIST, Change.user_id == user_id),
+          and_(Change.entity == outbox.PRODUCT, Change.wishlist_id.in_(wishlist_ids))))
+      for entity, entity_id in deleted.order_by(asc(Change.id)):
+        res["deleted_{0}s".format(entity)].append(entity_id)
+    res["wishlists"] = [wishlist.serialize() for wishlist in wishlists.order_by(asc(cls.id))]
+    res["products"] = [product.serialize() for product in products.order_by(asc(Product.id))]
+    return res
+
 class WishlistVo:
   """Represents a full Wishlist Model with a list of Products that it includes."""
   def __init__(self,wishlist:Wishlist,products:list) -> None:
@@ -0,0 +1,111 @@
+"""
+Inventory refresher
+
+Checks the status and the price of the products in the wishlists against
+the inventory service and writes back the products that changed, so that
+stale AVAILABLE flags and prices do not wait for a user to edit them.
+
+The inventory is asked for INVENTORY_BATCH_SIZE items per request:
+
+  GET {INVENTORY_URL}/items?ids=1,2,3
+  [{"inventory_product_id": 1, "status": "AVAILABLE", "price": 9.5}, ...]
+
+Items it does not return anymore are marked UNAVAILABLE. Requests go
+through one requests.Session with a pool of INVENTORY_CONCURRENCY
+keep-alive connections, INVENTORY_CONCURRENCY of them in flight at a time,
+each bounded by INVENTORY_TIMEOUT seconds and retried INVENTORY_RETRIES
+times on connection errors and 5xx answers. The answers are compared with
+the products in one query per batch, and only the items that changed are
+applied as inventory events (see service/models/inventory.py), so a
+refresh that finds nothing new does not write at all.
+
+  flask refresh-inventory [--interval 300]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from service.models.inventory import apply_items, coalesce, inventory_product_ids, \
+  stale_items
+from service.models.model_utils import Availability, DataValidationError
+
+class InventoryClient:
+  """A pooled, retrying HTTP client of the inventory service"""
+
+  def __init__(self, url:str, timeout:float=5.0, retries:int=3, pool_size:int=4) -> None:
+    self.url = url.rstrip("/")
+    self.timeout = timeout
+    self.session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.1, status_forcelist=(500, 502, 503, 504),
+      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  def fetch(self, ids:list) -> list:
+    """Returns the items of the inventory with the given ids, as inventory events"""
+    resp = self.session.get(self.url + "/items", timeout=self.timeout,
+      params={"ids": ",".join(str(item_id) for item_id in ids)})
+    resp.raise_for_status()
+    return resp.json()
+
+  def close(self):
+    """Closes the pooled connections"""
+    self.session.close()
+
+def _events(ids:list, items:list) -> list:
+  """Returns the events of a batch, items missing from the inventory are unavailable"""
+  returned = {item.get("inventory_product_id") for item in items if isinstance(item, dict)}
+  return items + [{"inventory_product_id": item_id, "status": Availability.UNAVAILABLE.name}
+    for item_id in ids if item_id not in returned]
+
+def _write_back(events:list) -> int:
+  """Applies the events that change some product, returns the number of products updated"""
+  stale = stale_items(coalesce(events))
+  return apply_items(stale) if stale else 0
+
+def _fetcher(client:InventoryClient):
+  def fetch(batch):
+    # a failed batch is returned, not raised, so that the other batches still apply
+    try:
+      items = client.fetch(batch)
+    except (requests.RequestException, ValueError) as error:
+      return error
+    if not isinstance(items, list):
+      return DataValidationError("Expected a json list of inventory items")
+    return items
+  return fetch
+
+def refresh(client:InventoryClient, batch_size:int=500, concurrency:int=4) -> dict:
+  """Refreshes every product from the inventory, returns what was done
+
+  Requests run on concurrency threads, the database is written from the
+  calling thread as their answers come in.
+  """
+  ids = inventory_product_ids()
+  batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+  result = {"items": len(ids), "batches": len(batches), "failed": 0, "updated": 0}
+  current_app.logger.info("Refreshing %s inventory products in %s batches ...",
+    len(ids), len(batches))
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    for batch, answer in zip(batches, pool.map(_fetcher(client), batches)):
+      try:
+        if isinstance(answer, Exception):
+          raise answer
+        result["updated"] += _write_back(_events(batch, answer))
+      except (requests.RequestException, ValueError) as error:
+        current_app.logger.warning("Inventory batch of %s items failed: %r", len(batch), error)
+        result["failed"] += 1
+  current_app.logger.info("Refreshed inventory: %s", result)
+  return result
+
+def client_for(app) -> InventoryClient:
+  """Returns a client of the inventory service at the INVENTORY_URL of app"""
+  return InventoryClient(app.config["INVENTORY_URL"],
+    timeout=app.config.get("INVENTORY_TIMEOUT", 5.0),
+    retries=app.config.get("INVENTORY_RETRIES", 3),
+    pool_size=app.config.get("INVENTORY_CONCURRENCY", 4))
@@ -17,43 +17,89 @@ Wishlists Service
 
 Paths:
 
-GET /wishlists -- List on Wishlists
+GET /wishlists -- List on Wishlists, or what changed in a user's Wishlists since a watermark
+GET /wishlists?ids=1,2,3 -- Read on many Wishlists
 POST /wishlists -- Create on Wishlists
 GET /wishlists/{wishlist_id} -- Read on Wishlists
 DELETE /wishlists/{wishlist_id} -- Delete on Wishlists
 PUT /wishlists/{wishlist_id} -- Update on Wishlists
+POST /wishlists/{wishlist_id}/clone -- Action "Clone" on Wishlists
+POST /wishlists/{wishlist_id}/merge?into={wishlist_id} -- Action "Merge" on Wishlists
+GET /wishlists/{wishlist_id}/summary -- Counts and prices of the Products of a Wishlist
+GET /users/{user_id}/summary -- Counts and prices of the Products of a user's Wishlists
+GET /wishlists/{wishlist_id}/products -- List on Products, sorted, filtered and paginated
 DELETE /wishlists/{wishlist_id}/products -- Action "Delete All" on Products
-POST /wishlists/{wishlist_id}/products -- Create on products
+POST /wishlists/{wishlist_id}/products -- Create on products, or update with ?upsert=true
 GET /wishlists/{wishlist_id}/products/{product_id} -- Read on Products
+GET /products?ids=1,2,3 -- Read on many Products
 DELETE /wishlists/{wishlist_id}/products/{product_id} -- Delete on Products
 PUT /wishlists/{wishlist_id}/products/{product_id} -- Update on Products
+PATCH /wishlists/{wishlist_id}/products/{product_id} -- Partial update on Products
 PUT /wishlists/{wishlist_id}/products/{product_id}/add-to-cart -- Action "Move" on Products
+PUT /wishlists/{wishlist_id}/products/add-to-cart -- Action "Move" on many Products
+PUT /wishlists/{wishlist_id}/products/order -- Action "Order" on many Products
+POST /inventory/events -- Apply a batch of inventory events to the Products
+POST /batch -- Run many writes on Wishlists and Products in one transaction
+GET /changes -- Feed of the changes of Wishlists and Products (see models/outbox.py)
+GET /events -- Server-Sent Events stream of the changes of Wishlists (see events.py)
+GET /metrics -- Runtime metrics such as connection pool usage
+GET /healthz, GET /readyz -- Liveness and readiness probes (see health.py)
 
 """
 
-from flask import jsonify, request, abort
-from flask_restx import Api, Resource, fields, reqparse
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, Response, current_app, g, jsonify, request, abort
+from flask_restx import Api, Resource, fields, inputs, marshal, reqparse
+from sqlalchemy import orm
+from sqlalchemy.exc import IntegrityError
+from werkzeug.test import EnvironBuilder
 
-from . import app
 from . import status  # HTTP Status Codes
 
 # Import Flask application
 from service.models.wishlist import Wishlist, WishlistVo
-from service.models.product import Product
-from service.models.model_utils import db, DataValidationError, InCartStatus, Availability
+from service.models.product import Product, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, SORT_FIELDS
+from service.models.inventory import apply_events
+from service.models import outbox
+from service.models.model_utils import MAX_NAME_LENGTH, db, DataValidationError, InCartStatus, \
+  Availability
+from service.models.pool import pool_stats
+from service.models.routing import read_only, remember_write
+from service import events
+
+# Plain Flask routes, next to the REST API
+bp = Blueprint("service", __name__)
+
+# most ids a multi-get takes, they all go in one IN list
+MAX_IDS = 500
+
+def parse_ids(value:str) -> list:
+  """Returns the distinct ids of a comma separated list, as given to ?ids="""
+  try:
+    ids = sorted({int(part) for part in value.split(",")})
+  except ValueError:
+    raise DataValidationError("ids should be a comma separated list of integers")
+  if len(ids) > MAX_IDS:
+    raise DataValidationError("At most {0} ids are expected".format(MAX_IDS))
+  return ids
+
+# most operations a batch takes, they all run in one transaction
+MAX_OPERATIONS = 100
+BATCH_METHODS = ("POST", "PUT", "PATCH", "DELETE")
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/", strict_slashes=False)
+@bp.route("/", strict_slashes=False)
 def index():
   """ Serve static home page"""
-  return app.send_static_file("index.html")
+  return current_app.send_static_file("index.html")
 
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
-@app.route("/info")
+@bp.route("/info")
 def info():
   """ API info"""
   return (
@@ -64,10 +110,23 @@ def info():
     status.HTTP_200_OK,
   )
 
+######################################################################
+# GET METRICS
+######################################################################
+@bp.route("/metrics")
+def metrics():
+  """ Runtime metrics of the service"""
+  return (
+    jsonify(
+      pool=pool_stats(db.engine),
+    ),
+    status.HTTP_200_OK,
+  )
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
-api = Api(app,
+api = Api(
   version='1.0.0',
   title='Wishlists Service REST API',
   description='This is an API for Wishlists Service, NYU DevOps 2021.',
@@ -97,8 +156,22 @@ full_wishlist_model = api.inherit(
   }
 )
 
+clone_wishlist_model = api.model('Clone_Wishlist_Model', {
+  'name': fields.String(required=False,
+    description='The name of the copy, the name of the wishlist by default.')
+})
+
+merge_args = reqparse.RequestParser()
+merge_args.add_argument('into', type=int, location='args', required=True,
+  help='ID of the Wishlist of the same user receiving the products.')
+
 wishlist_args = reqparse.RequestParser()
 wishlist_args.add_argument('user_id', type=int, required=False, help='List Wishlists by user id.')
+wishlist_args.add_argument('since', type=str, required=False,
+  help='Watermark returned by the previous sync, an ISO 8601 time in UTC unless it has an '
+  'offset, 0 for everything. Needs a user_id.')
+wishlist_args.add_argument('ids', type=str, required=False,
+  help='Read the Wishlists with these comma separated ids, at most {0}.'.format(MAX_IDS))
 
 create_product_model = api.model('Create_Product_Model', {
   'name': fields.String(required=True,
@@ -140,6 +213,22 @@ update_product_model = api.model('Update_Product_Model', {
     description='Wishlist ID that this product belongs to.'),
 })
 
+patch_product_model = api.model('Patch_Product_Model', {
+  'name': fields.String(required=False,
+    description='The name of the product'),
+  'price': fields.Float(required=False,
+    description='Price of the product.'),
+  'status': fields.String(required=False,
+    description='Availability status.',
+    enum=Availability._member_names_),
+  'pic_url': fields.String(required=False,
+    description='URL for a picture of the product.'),
+  'short_desc': fields.String(required=False,
+    description='Short description of the product.'),
+  'inventory_product_id': fields.Integer(required=False,
+    description='ID of the product in inventory.'),
+})
+
 full_product_model = api.inherit(
   'Read_Product_Model',
   create_product_model,
@@ -149,6 +238,162 @@ full_product_model = api.inherit(
   }
 )
 
+product_page_model = api.model('Product_Page_Model', {
+  'products': fields.List(fields.Nested(full_product_model), readOnly=True,
+    description='Products of the page, in the sort order.'),
+  'next': fields.String(readOnly=True,
+    description='Cursor to pass as after to read the next page, null on the last page.'),
+})
+
+summary_model = api.model('Summary_Model', {
+  'item_count': fields.Integer(readOnly=True,
+    description='Number of products.'),
+  'total_price': fields.Float(readOnly=True,
+    description='Sum of the prices of the products.'),
+  'average_price': fields.Float(readOnly=True,
+    description='Average price of the products, null without products.'),
+  'by_status': fields.Nested(api.model('Availability_Counts_Model', {
+    availability.name: fields.Integer(readOnly=True) for availability in Availability}),
+    readOnly=True, description='Number of products by availability.'),
+  'by_in_cart_status': fields.Nested(api.model('In_Cart_Status_Counts_Model', {
+    cart_status.name: fields.Integer(readOnly=True) for cart_status in InCartStatus}),
+    readOnly=True, description='Number of products by cart status.'),
+  'most_expensive': fields.Nested(full_product_model, allow_null=True, readOnly=True,
+    description='The product with the highest price, null without products.'),
+})
+
+wishlist_summary_model = api.inherit('Wishlist_Summary_Model', summary_model, {
+  'wishlist_id': fields.Integer(readOnly=True,
+    description='The Wishlist summarized.'),
+})
+
+user_summary_model = api.inherit('User_Summary_Model', summary_model, {
+  'user_id': fields.Integer(readOnly=True,
+    description='The user whose Wishlists are summarized.'),
+})
+
+product_page_args = reqparse.RequestParser()
+product_page_args.add_argument('sort', type=str, required=False, default='id',
+  choices=[prefix + field for field in SORT_FIELDS for prefix in ('', '-')],
+  help='Field the Products are sorted by, - first for the descending order.')
+product_page_args.add_argument('after', type=str, required=False,
+  help='Cursor returned as next by the previous page, the first page if omitted.')
+product_page_args.add_argument('limit', type=int, required=False, default=DEFAULT_PAGE_SIZE,
+  help='Maximum number of Products to return, {0} by default and at most {1}.'.format(
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+product_page_args.add_argument('status', type=str, required=False,
+  choices=[availability.name for availability in Availability],
+  help='Only list the Products with this availability.')
+product_page_args.add_argument('in_cart_status', type=str, required=False,
+  choices=[cart_status.name for cart_status in InCartStatus],
+  help='Only list the Products with this cart status.')
+
+create_product_args = reqparse.RequestParser()
+create_product_args.add_argument('upsert', type=inputs.boolean, location='args', default=False,
+  help='Update the product of the wishlist with the same inventory_product_id, if any.')
+
+bulk_products_model = api.model('Bulk_Products_Model', {
+  'product_ids': fields.List(fields.Integer, required=False,
+    description='IDs of the products to move, all the products that can be moved if omitted.'),
+})
+
+inventory_event_model = api.model('Inventory_Event_Model', {
+  'inventory_product_id': fields.Integer(required=True,
+    description='ID of the product in inventory.'),
+  'status': fields.String(required=False,
+    description='New availability status of the product.',
+    enum=Availability._member_names_),
+  'price': fields.Float(required=False,
+    description='New price of the product.'),
+})
+
+inventory_result_model = api.model('Inventory_Result_Model', {
+  'received': fields.Integer(readOnly=True,
+    description='Number of events in the batch.'),
+  'coalesced': fields.Integer(readOnly=True,
+    description='Number of distinct inventory products in the batch, once coalesced.'),
+  'updated': fields.Integer(readOnly=True,
+    description='Number of wishlist products updated.'),
+})
+
+change_model = api.model('Change_Model', {
+  'entity': fields.String(readOnly=True,
+    description='What changed.', enum=[outbox.WISHLIST, outbox.PRODUCT]),
+  'id': fields.Integer(readOnly=True,
+    description='ID of the wishlist or the product that changed.'),
+  'wishlist_id': fields.Integer(readOnly=True,
+    description='Wishlist ID that changed, or that the product belongs to.'),
+  'action': fields.String(readOnly=True,
+    description='How it changed.', enum=[outbox.CREATED, outbox.UPDATED, outbox.DELETED]),
+  'created_at': fields.DateTime(readOnly=True,
+    description='When it changed, in UTC.'),
+})
+
+change_feed_model = api.model('Change_Feed_Model', {
+  'changes': fields.List(fields.Nested(change_model), readOnly=True,
+    description='Changes in the order they were committed.'),
+  'next': fields.String(readOnly=True,
+    description='Cursor to pass as after to read the following changes.'),
+})
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('after', type=str, required=False,
+  help='Cursor returned as next by the previous call, the oldest changes if omitted.')
+change_args.add_argument('limit', type=int, required=False,
+  help='Maximum number of changes to return, {0} by default and at most {1}.'.format(
+    outbox.DEFAULT_LIMIT, outbox.MAX_LIMIT))
+
+wishlist_delta_model = api.model('Wishlist_Delta_Model', {
+  'wishlists': fields.List(fields.Nested(full_wishlist_model), readOnly=True,
+    description='Wishlists created or changed since the watermark.'),
+  'products': fields.List(fields.Nested(full_product_model), readOnly=True,
+    description='Products created or changed since the watermark.'),
+  'deleted_wishlists': fields.List(fields.Integer, readOnly=True,
+    description='IDs of the wishlists deleted since the watermark.'),
+  'deleted_products': fields.List(fields.Integer, readOnly=True,
+    description='IDs of the products deleted since the watermark.'),
+  'watermark': fields.String(readOnly=True,
+    description='Watermark to pass as since on the next sync.'),
+  'full': fields.Boolean(readOnly=True,
+    description='True when everything is listed, what the client has should be replaced.'),
+})
+
+event_args = reqparse.RequestParser()
+event_args.add_argument('wishlist_id', type=int, required=False,
+  help='Wishlist to follow.')
+event_args.add_argument('user_id', type=int, required=False,
+  help='User whose wishlists to follow, the ones created later too.')
+
+product_args = reqparse.RequestParser()
+product_args.add_argument('ids', type=str, required=True,
+  help='Comma separated ids of the Products to read, at most {0}.'.format(MAX_IDS))
+product_args.add_argument('status', type=str, required=False,
+  choices=[availability.name for availability in Availability],
+  help='Only read the Products with this availability.')
+
+batch_operation_model = api.model('Batch_Operation_Model', {
+  'method': fields.String(required=True,
+    description='HTTP method of the operation.', enum=list(BATCH_METHODS)),
+  'path': fields.String(required=True,
+    description='Path of the operation, such as /wishlists/3/products.'),
+  'body': fields.Raw(required=False,
+    description='JSON payload of the operation, the one its path takes.'),
+})
+
+batch_result_model = api.model('Batch_Result_Model', {
+  'status': fields.Integer(readOnly=True,
+    description='HTTP status of the operation.'),
+  'body': fields.Raw(readOnly=True,
+    description='JSON response of the operation, null when it has none.'),
+})
+
+batch_model = api.model('Batch_Model', {
+  'results': fields.List(fields.Nested(batch_result_model), readOnly=True,
+    description='Results of the operations run, in order.'),
+  'failed': fields.Integer(readOnly=True,
+    description='Index of the operation that failed, nothing was committed.'),
+})
+
 wishlist_vo = api.inherit(
   'List_Wishlist/Product_Model',
   full_wishlist_model,
@@ -178,6 +423,7 @@ class WishlistResource(Resource):
   @api.response(400, 'Integer value expected for field: Wishlist ID')
   @api.response(404, 'Wishlist not found')
   @api.marshal_with(wishlist_vo)
+  @read_only
   def get(self, wishlist_id):
     """
     Read on Wishlists
@@ -185,7 +431,7 @@ class WishlistResource(Resource):
     """
     if not wishlist_id.isdigit():
       abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
-    app.logger.info("Request to list products in a wishlist")
+    current_app.logger.info("Request to list products in a wishlist")
     wishlist = Wishlist.find_by_id(wishlist_id)
     if not wishlist:
       abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} was not found".format(wishlist_id))
@@ -207,7 +453,7 @@ class WishlistResource(Resource):
     Update on Wishlists
     This endpoint will rename an existing wishlist.
     """
-    app.logger.info("Request to rename a wishlist")
+    current_app.logger.info("Request to rename a wishlist")
     if request.headers.get("Content-Type") != "application/json":
       return abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, \
@@ -221,33 +467,15 @@ class WishlistResource(Resource):
     if not wishlist:
       abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-    app.logger.info('Payload = %s', api.payload)
+    current_app.logger.info('Payload = %s', api.payload)
     data = api.payload
 
     if "name" not in data or not isinstance(data["name"], str):
       abort(status.HTTP_400_BAD_REQUEST, "name field is wrong")
 
-    query_res = Wishlist.find_all_by_user_id(wishlist.user_id)
-    res = []
-    for i in query_res:
-      res.append(i['name'])
-
-    num = 0
+    taken = Wishlist.find_names_by_user_id(wishlist.user_id)
+    data['name'] = Wishlist.unique_name(data['name'], taken)
     wishlist_fields = wishlist.serialize()
-
-    while 1:
-      if num == 0:
-        if data['name'] in res:
-          num += 1
-        else:
-          break
-      else:
-        if data['name'] + ' {0}'.format(num) in res:
-          num += 1
-        else:
-          data['name'] = data['name'] + ' {0}'.format(num)
-          break
-
     wishlist_fields.update(data)
     wishlist.deserialize(wishlist_fields)
     wishlist.update()
@@ -265,16 +493,165 @@ class WishlistResource(Resource):
     Delete on Wishlists
     This endpoint will delete a wishlist based the id specified in the URL.
     """
-    app.logger.info("Request to delete wishlist with id: %s", wishlist_id)
+    current_app.logger.info("Request to delete wishlist with id: %s", wishlist_id)
     if not wishlist_id.isdigit():
       abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
 
     wishlist = Wishlist.find_by_id(wishlist_id)
     if wishlist:
       wishlist.delete()
-      app.logger.info("Wishlist deleted")
+      current_app.logger.info("Wishlist deleted")
     return "", status.HTTP_204_NO_CONTENT
 
+######################################################################
+#  PATH: /wishlists/{id}/clone
+######################################################################
+@api.route('/wishlists/<wishlist_id>/clone')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class CloneResource(Resource):
+  """
+  CloneResource class
+
+  Allows to copy a wishlist with its products
+  POST - create a copy of the wishlist for its user
+  """
+
+  @api.doc('clone_wishlists')
+  @api.response(400, 'The posted data was not valid')
+  @api.response(404, 'Wishlist not found')
+  @api.response(415, 'Unsupported media type : application/json expected')
+  @api.expect(clone_wishlist_model)
+  @api.marshal_with(wishlist_vo, code=201)
+  def post(self, wishlist_id):
+    """
+    Action "Clone" on Wishlists
+    This endpoint will copy a wishlist and its products, out of the cart, in one
+    transaction and return the copy.
+    """
+    current_app.logger.info("Request to clone wishlist with id: %s", wishlist_id)
+    if request.get_data() and request.headers.get("Content-Type") != "application/json":
+      abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        "Unsupported media type : application/json expected")
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+
+    wishlist = Wishlist.find_by_id(wishlist_id)
+    if not wishlist:
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+    data = api.payload if request.get_data() else {}
+    name = data.get("name") if isinstance(data, dict) else None
+    if name is not None and (not isinstance(name, str) or not name
+      or len(name) > MAX_NAME_LENGTH):
+      abort(status.HTTP_400_BAD_REQUEST, "name field is wrong")
+
+    copy = wishlist.clone(name)
+    location_url = api.url_for(WishlistResource, wishlist_id=copy.id, _external=True)
+    return copy.read(), status.HTTP_201_CREATED, {'Location': location_url}
+
+######################################################################
+#  PATH: /wishlists/{id}/merge
+######################################################################
+@api.route('/wishlists/<wishlist_id>/merge')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class MergeResource(Resource):
+  """
+  MergeResource class
+
+  Allows to merge a wishlist into another one of its user
+  POST - move the products of the wishlist to the other one and delete it
+  """
+
+  @api.doc('merge_wishlists')
+  @api.response(400, 'The Wishlists cannot be merged')
+  @api.response(404, 'Wishlist not found')
+  @api.expect(merge_args, validate=True)
+  @api.marshal_with(wishlist_vo)
+  def post(self, wishlist_id):
+    """
+    Action "Merge" on Wishlists
+    This endpoint will move the products of a wishlist to the wishlist given by into,
+    in one transaction, delete the emptied wishlist and return the merged one. Products
+    of inventory items the merged wishlist already holds are deleted.
+    """
+    current_app.logger.info("Request to merge wishlist with id: %s", wishlist_id)
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+    args = merge_args.parse_args()
+
+    wishlist = Wishlist.find_by_id(wishlist_id)
+    target = Wishlist.find_by_id(args['into'])
+    if not wishlist or not target:
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(
+        args['into'] if wishlist else wishlist_id))
+
+    wishlist.merge_into(target)
+    return target.read(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /wishlists/{id}/summary
+######################################################################
+@api.route('/wishlists/<wishlist_id>/summary')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class WishlistSummaryResource(Resource):
+  """
+  WishlistSummaryResource class
+
+  Allows dashboards to read the figures of a wishlist without its products
+  GET - the counts and prices of the products of the wishlist
+  """
+
+  @api.doc('summarize_wishlists')
+  @api.response(400, 'Integer value expected for field: Wishlist ID')
+  @api.response(404, 'Wishlist not found')
+  @api.marshal_with(wishlist_summary_model)
+  @read_only
+  def get(self, wishlist_id):
+    """
+    Summary of a Wishlist
+    This endpoint will return the number of products of a wishlist, their total and
+    average price, their numbers by status and cart status and the most expensive one.
+    """
+    current_app.logger.info("Request for the summary of wishlist %s", wishlist_id)
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+    summary = Wishlist.summary_by_id(int(wishlist_id))
+    if summary is None:
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} was not found".format(wishlist_id))
+
+    return dict(summary, wishlist_id=int(wishlist_id)), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /users/{user_id}/summary
+######################################################################
+@api.route('/users/<user_id>/summary')
+@api.param('user_id', 'The user identifier')
+class UserSummaryResource(Resource):
+  """
+  UserSummaryResource class
+
+  Allows dashboards to read the figures of all the wishlists of a user
+  GET - the counts and prices of the products of the user's wishlists
+  """
+
+  @api.doc('summarize_users')
+  @api.response(400, 'Integer value expected for field: User ID')
+  @api.marshal_with(user_summary_model)
+  @read_only
+  def get(self, user_id):
+    """
+    Summary of a user's Wishlists
+    This endpoint will return the number of products in all the wishlists of a user,
+    their total and average price, their numbers by status and cart status and the
+    most expensive one.
+    """
+    current_app.logger.info("Request for the summary of user %s", user_id)
+    if not user_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: User ID")
+
+    summary = Wishlist.summary_by_user_id(int(user_id))
+    return dict(summary, user_id=int(user_id)), status.HTTP_200_OK
+
 ######################################################################
 #  PATH: /wishlists
 ######################################################################
@@ -292,37 +669,75 @@ class WishlistCollection(Resource):
   #------------------------------------------------------------------
   @api.doc('list_wishlists')
   @api.expect(wishlist_args, validate=True)
-  @api.marshal_list_with(wishlist_vo)
+  @api.response(200, 'Success', [wishlist_vo])
+  @api.response(400, 'Invalid watermark')
+  @read_only
   def get(self):
     """
     List on Wishlists
     This endpoint will return all wishlists in the database or wishlists with a specific user_id.
+    With ids, it returns the wishlists with these ids that exist, in id order.
+    With since, it returns what changed in the wishlists of user_id since the watermark
+    (see Wishlist_Delta_Model).
     """
     args = wishlist_args.parse_args()
     user_id = args['user_id']
+    if args['ids'] is not None:
+      current_app.logger.info("Request for wishlists with ids %s", args['ids'])
+      return marshal(Wishlist.read_all_by_ids(parse_ids(args['ids'])), wishlist_vo), \
+        status.HTTP_200_OK
+    if args['since'] is not None:
+      return marshal(self._changed(user_id, args['since']), wishlist_delta_model), \
+        status.HTTP_200_OK
 
     if not user_id:
-      app.logger.info("Request for all wishlists")
+      current_app.logger.info("Request for all wishlists")
       query_res = Wishlist.find_all()
       res = [r.read() for r in query_res]
-      app.logger.info(res)
+      current_app.logger.info(res)
 
       if not res:
         msg = "No wishlists found!"
       else:
         msg = "All the wishlists."
 
-      app.logger.info(msg)
-      return res, status.HTTP_200_OK
+      current_app.logger.info(msg)
+      return marshal(res, wishlist_vo), status.HTTP_200_OK
 
     user_id = int(user_id)
-    app.logger.info("Request for wishlists with user_id: %s", user_id)
+    current_app.logger.info("Request for wishlists with user_id: %s", user_id)
     res = Wishlist.find_all_by_user_id(user_id)
 
     if not res:
-      app.logger.info("No wishlists found for user_id '%s'." % user_id)
-
-    return res, status.HTTP_200_OK
+      current_app.logger.info("No wishlists found for user_id '%s'." % user_id)
+
+    return marshal(res, wishlist_vo), status.HTTP_200_OK
+
+  @staticmethod
+  def _changed(user_id, since:str) -> dict:
+    """Returns what changed in the wishlists of a user since a watermark, with the next one"""
+    if user_id is None:
+      abort(status.HTTP_400_BAD_REQUEST, "since needs a user_id")
+    try:
+      since = None if since == "0" else datetime.fromisoformat(since)
+    except ValueError:
+      abort(status.HTTP_400_BAD_REQUEST, "Invalid watermark: {0}".format(since))
+    if since is not None and since.tzinfo is not None:
+      # updated_at is stored as naive UTC
+      since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    current_app.logger.info("Request for the changes of user_id %s since %s", user_id, since)
+    config = current_app.config
+    now = datetime.utcnow()
+    # rows written by transactions still running may be older, the next sync reads them again
+    watermark = now - timedelta(seconds=config['SYNC_WATERMARK_LAG'])
+    if since is not None and since < now - timedelta(seconds=config['CHANGES_RETENTION']):
+      # deletions that old are compacted away, start over
+      since = None
+    # a replica may not have the changes up to the watermark yet
+    g.read_only = False
+    res = Wishlist.find_changed_by_user_id(user_id, since)
+    res.update(watermark=watermark.isoformat(), full=since is None)
+    return res
 
   #------------------------------------------------------------------
   # CREATE A NEW WISHLIST
@@ -337,7 +752,7 @@ class WishlistCollection(Resource):
     Create on Wishlists
     This endpoint will create a wishlist based the data in the body.
     """
-    app.logger.info("Request to create a wishlist")
+    current_app.logger.info("Request to create a wishlist")
     # Check for form submission data
     if request.headers.get("Content-Type") != "application/json":
       abort(
@@ -345,7 +760,7 @@ class WishlistCollection(Resource):
         "Unsupported media type : application/json expected"
       )
 
-    app.logger.info('Payload = %s', api.payload)
+    current_app.logger.info('Payload = %s', api.payload)
     data = api.payload
 
     if not isinstance(data, dict):
@@ -369,27 +784,59 @@ class ProductCollectionResource(Resource):
   ProductCollectionResource class
 
   Allows the manipulation on a collection of Products in a Wishlist
+  GET - List a page of the products of a wishlist
   POST - Create a product in a wishlist
   DELETE - Delete all products in a wishlist
   """
+  @api.doc('list_products_in_a_wishlist')
+  @api.response(400, 'Invalid sort, filter or cursor')
+  @api.response(404, 'Wishlist not found')
+  @api.expect(product_page_args, validate=True)
+  @api.marshal_with(product_page_model)
+  @read_only
+  def get(self, wishlist_id):
+    """
+    List on Products
+    This endpoint will return a page of the products of a wishlist, sorted by id, name or
+    price and optionally filtered by status and in_cart_status, with the cursor of the
+    next page.
+    """
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+    args = product_page_args.parse_args()
+    current_app.logger.info("Request for the products of wishlist %s by %s after %s",
+      wishlist_id, args['sort'], args['after'])
+    if not Wishlist.find_by_id(wishlist_id):
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} was not found".format(wishlist_id))
+
+    products, cursor = Product.find_page_by_wishlist_id(wishlist_id, args['sort'],
+      args['after'], args['limit'],
+      args['status'] and Availability[args['status']],
+      args['in_cart_status'] and InCartStatus[args['in_cart_status']])
+    return {"products": [product.serialize() for product in products], "next": cursor}, \
+      status.HTTP_200_OK
+
   @api.doc('create_a_product')
+  @api.response(200,"Product updated, with upsert")
   @api.response(400,"Expected a json request body")
+  @api.response(409,"The wishlist already has a product with this inventory_product_id")
   @api.response(415,"Unsupported media type : application/json expected")
-  @api.expect(create_product_model)
+  @api.expect(create_product_model, create_product_args)
   @api.marshal_with(full_product_model,201)
   def post(self,wishlist_id):
     """
     Create on Products
-    This endpoint will add a new product to a wishlist.
+    This endpoint will add a new product to a wishlist. With upsert, the product of the
+    wishlist with the same inventory_product_id is updated instead, if there is one.
     """
-    app.logger.info("Request to create a product")
+    current_app.logger.info("Request to create a product")
     if request.headers.get("Content-Type") != "application/json":
       abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, \
         "Unsupported media type : application/json expected"
       )
 
-    app.logger.info('Payload = %s', api.payload)
+    current_app.logger.info('Payload = %s', api.payload)
     data = api.payload
 
     if not isinstance(data, dict):
@@ -399,10 +846,15 @@ class ProductCollectionResource(Resource):
       abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
 
     data['wishlist_id'] = wishlist_id
+    upsert = create_product_args.parse_args()['upsert']
 
     product = Product()
     product.deserialize(data)
-    product.create()
+    if upsert:
+      created = product.upsert()
+    else:
+      product.create()
+      created = True
 
     location_url = api.url_for(
       ProductResource,
@@ -411,7 +863,8 @@ class ProductCollectionResource(Resource):
       _external=True
     )
 
-    return product.serialize(), status.HTTP_201_CREATED, {'Location':location_url}
+    code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+    return product.serialize(), code, {'Location':location_url}
 
   @api.doc('delete_all_products_from_a_wishlist')
   @api.response(204, "Products deleted")
@@ -429,7 +882,7 @@ class ProductCollectionResource(Resource):
     if wishlist:
       product_list = wishlist.read()['products']
       product_ids_list = [p["id"] for p in product_list]
-      app.logger.info(f"Request to delete all the products from wishlist {wishlist_id}")
+      current_app.logger.info(f"Request to delete all the products from wishlist {wishlist_id}")
 
       wishlist.delete_products(product_ids_list)
 
@@ -455,13 +908,14 @@ class ProductResource(Resource):
   @api.response(400, 'Integer value expected for fields: Wishlist ID and Product ID')
   @api.response(404, 'Product with id not found in wishlist with id')
   @api.marshal_with(full_product_model)
+  @read_only
   def get(self,wishlist_id,product_id):
     """
     Read on Products
     This endpoint will firstly look for a wishlist based on a wishlist_id
     Then look for a product based on a product_id.
     """
-    app.logger.info("Request to get a specific product in a wishlist")
+    current_app.logger.info("Request to get a specific product in a wishlist")
     if not wishlist_id.isdigit() or not product_id.isdigit():
       abort(
         status.HTTP_400_BAD_REQUEST,
@@ -485,16 +939,15 @@ class ProductResource(Resource):
     Delete on Products
     This endpoint will delete an existing product in a wishlist.
     """
-    app.logger.info(f"Request to delete products with id {product_id} from wishlist {wishlist_id}")
+    current_app.logger.info("Request to delete products with id %s from wishlist %s",
+      product_id, wishlist_id)
     if not wishlist_id.isdigit() or not product_id.isdigit():
       abort(
         status.HTTP_400_BAD_REQUEST,
         'Integer field expected for fields: Wishlist ID and Product ID'
       )
 
-    wishlist = Wishlist.find_by_id(wishlist_id)
-    if wishlist:
-      wishlist.delete_products([product_id])
+    Product.delete_by_wishlist_id_and_product_id(wishlist_id, product_id)
 
     return "", status.HTTP_204_NO_CONTENT
 
@@ -509,7 +962,7 @@ class ProductResource(Resource):
     Update on Products
     This endpoint will modify an existing product in a wishlist.
     """
-    app.logger.info("Request to update a product")
+    current_app.logger.info("Request to update a product")
     if not wishlist_id.isdigit() or not product_id.isdigit():
       abort(
         status.HTTP_400_BAD_REQUEST,
@@ -526,7 +979,7 @@ class ProductResource(Resource):
     if not product:
       abort(status.HTTP_404_NOT_FOUND, f"Product with id {product_id} not found")
 
-    app.logger.info('Payload = %s', api.payload)
+    current_app.logger.info('Payload = %s', api.payload)
     data = api.payload
     if not isinstance(data, dict):
       abort( status.HTTP_400_BAD_REQUEST, "Expected a json request body")
@@ -538,6 +991,39 @@ class ProductResource(Resource):
 
     return product.serialize(), status.HTTP_200_OK
 
+  @api.doc('patch_a_product')
+  @api.response(400, "The posted fields were not valid")
+  @api.response(404, "Product not found")
+  @api.response(415, "Unsupported media type : application/json expected")
+  @api.expect(patch_product_model)
+  @api.marshal_with(full_product_model)
+  def patch(self, wishlist_id, product_id):
+    """
+    Partial update on Products
+    This endpoint will change only the given fields of a product in a wishlist.
+    """
+    current_app.logger.info("Request to patch a product")
+    if not wishlist_id.isdigit() or not product_id.isdigit():
+      abort(
+        status.HTTP_400_BAD_REQUEST,
+        'Integer field expected for fields: Wishlist ID and Product ID'
+      )
+    if request.headers.get("Content-Type") != "application/json":
+      abort(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, \
+        "Unsupported media type : application/json expected"
+      )
+
+    data = api.payload
+    if not isinstance(data, dict):
+      abort(status.HTTP_400_BAD_REQUEST, "Expected a json request body")
+
+    product = Product.patch(wishlist_id, product_id, data)
+    if not product:
+      abort(status.HTTP_404_NOT_FOUND, f"Product with id {product_id} not found")
+
+    return product.serialize(), status.HTTP_200_OK
+
 @api.route('/wishlists/<wishlist_id>/products/<product_id>/add-to-cart')
 @api.param('wishlist_id', 'The Wishlist identifier')
 @api.param('product_id', 'The Product identifier')
@@ -558,7 +1044,7 @@ class AddToCartResource(Resource):
     Action "Move" on Products
     This endpoint will move an existing product in a wishlist to a shopping cart.
     """
-    app.logger.info("Request to place a product in wishlist to cart")
+    current_app.logger.info("Request to place a product in wishlist to cart")
     if not wishlist_id.isdigit() or not product_id.isdigit():
       abort(
         status.HTTP_400_BAD_REQUEST,
@@ -579,6 +1065,300 @@ class AddToCartResource(Resource):
     return product.serialize(),status.HTTP_200_OK
 
 
+def bulk_product_ids():
+  """Returns the product_ids of a bulk request body, None when it names no products
+
+  Only an empty body or one without product_ids names no products, a body that is
+  not json is refused instead of moving every product.
+  """
+  if not request.get_data():
+    return None
+  if request.headers.get("Content-Type") != "application/json":
+    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+      "Unsupported media type : application/json expected")
+  # a malformed body is a 400
+  data = request.get_json()
+  if not isinstance(data, dict):
+    abort(status.HTTP_400_BAD_REQUEST, "Expected a json request body")
+  product_ids = data.get('product_ids')
+  if product_ids is None:
+    return None
+  if not isinstance(product_ids, list) or \
+    not all(isinstance(pid, int) and not isinstance(pid, bool) for pid in product_ids):
+    abort(status.HTTP_400_BAD_REQUEST, "product_ids should be a list of integers")
+  return product_ids
+
+@api.route('/wishlists/<wishlist_id>/products/add-to-cart')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class BulkAddToCartResource(Resource):
+  """
+  BulkAddToCartResource class
+
+  Allows to place many products of a wishlist in the cart at once
+  PUT - place the given products, or all the available ones, in the cart
+  """
+
+  @api.doc('place_products_to_shopping_cart')
+  @api.response(400, "Integer values expected for Wishlist ID and product_ids")
+  @api.response(404, 'Wishlist not found')
+  @api.response(415, 'Unsupported media type : application/json expected')
+  @api.expect(bulk_products_model)
+  @api.marshal_list_with(full_product_model)
+  def put(self, wishlist_id):
+    """
+    Action "Move" on many Products
+    This endpoint will move the given products of a wishlist, or all its available
+    products, to a shopping cart, and return the products moved.
+    """
+    current_app.logger.info("Request to place products in wishlist to cart")
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+    if not Wishlist.find_by_id(wishlist_id):
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+    products = Product.move_to_cart_status(wishlist_id, InCartStatus.IN_CART,
+      bulk_product_ids())
+    return [product.serialize() for product in products], status.HTTP_200_OK
+
+@api.route('/wishlists/<wishlist_id>/products/order')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class OrderResource(Resource):
+  """
+  OrderResource class
+
+  Allows to check out the products of a wishlist placed in the cart
+  PUT - mark the given products, or all the ones in the cart, as ordered
+  """
+
+  @api.doc('order_products')
+  @api.response(400, "Integer values expected for Wishlist ID and product_ids")
+  @api.response(404, 'Wishlist not found')
+  @api.response(415, 'Unsupported media type : application/json expected')
+  @api.expect(bulk_products_model)
+  @api.marshal_list_with(full_product_model)
+  def put(self, wishlist_id):
+    """
+    Action "Order" on many Products
+    This endpoint will mark the given products of a wishlist in the cart, or all of them,
+    as ordered, and return the products ordered.
+    """
+    current_app.logger.info("Request to order products in cart")
+    if not wishlist_id.isdigit():
+      abort(status.HTTP_400_BAD_REQUEST, "Integer value expected for field: Wishlist ID")
+    if not Wishlist.find_by_id(wishlist_id):
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+    products = Product.move_to_cart_status(wishlist_id, InCartStatus.ORDERED,
+      bulk_product_ids())
+    return [product.serialize() for product in products], status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products
+######################################################################
+@api.route('/products')
+class ProductListResource(Resource):
+  """
+  ProductListResource class
+
+  Allows to read many products of any wishlists at once
+  GET - the products with the given ids
+  """
+
+  @api.doc('list_products')
+  @api.response(400, 'A comma separated list of integer ids is expected')
+  @api.expect(product_args, validate=True)
+  @api.marshal_list_with(full_product_model)
+  @read_only
+  def get(self):
+    """
+    Read on many Products
+    This endpoint will return the products with these ids that exist, in id order.
+    """
+    args = product_args.parse_args()
+    current_app.logger.info("Request for products with ids %s", args['ids'])
+    product_ids = parse_ids(args['ids'])
+    if args['status'] is None:
+      products = Product.find_all_by_ids(product_ids)
+    else:
+      products = Product.find_all_by_ids_and_status(product_ids, Availability[args['status']])
+    return [product.serialize() for product in products], status.HTTP_200_OK
+
+@api.route('/inventory/events')
+class InventoryEventsResource(Resource):
+  """
+  InventoryEventsResource class
+
+  Allows the inventory to report stock and price changes
+  POST - apply a batch of inventory events to the products of every wishlist
+  """
+
+  @api.doc('apply_inventory_events')
+  @api.response(400, 'The posted events are not valid')
+  @api.response(415, 'Unsupported media type : application/json expected')
+  @api.expect([inventory_event_model])
+  @api.marshal_with(inventory_result_model)
+  def post(self):
+    """
+    Apply a batch of inventory events
+    This endpoint will set the status and the price of every product of every wishlist
+    with the inventory_product_id of an event, the last event of a product wins.
+    """
+    current_app.logger.info("Request to apply inventory events")
+    if request.headers.get("Content-Type") != "application/json":
+      abort(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, \
+        "Unsupported media type : application/json expected"
+      )
+    payload = api.payload
+    if not isinstance(payload, list):
+      abort(status.HTTP_400_BAD_REQUEST, "Expected a json list of inventory events")
+    return apply_events(payload), status.HTTP_200_OK
+
+@api.route('/changes')
+class ChangeFeedResource(Resource):
+  """
+  ChangeFeedResource class
+
+  Allows consumers to follow the changes of wishlists and products
+  GET - the changes committed after a cursor
+  """
+
+  @api.doc('list_changes')
+  @api.response(400, 'Invalid cursor')
+  @api.expect(change_args, validate=True)
+  @api.marshal_with(change_feed_model)
+  def get(self):
+    """
+    List changes
+    This endpoint will return the changes committed after the cursor, oldest first,
+    with the cursor to read the next ones.
+    """
+    args = change_args.parse_args()
+    current_app.logger.info("Request for changes after %s", args['after'])
+    changes, cursor = outbox.read(args['after'], args['limit'] or outbox.DEFAULT_LIMIT)
+    return {"changes": [change.serialize() for change in changes], "next": cursor}, \
+      status.HTTP_200_OK
+
+
+@api.route('/events')
+class EventStreamResource(Resource):
+  """
+  EventStreamResource class
+
+  Allows clients to be notified of the changes of wishlists as they happen
+  GET - a text/event-stream of the changes of a wishlist or of a user's wishlists
+  """
+
+  @api.doc('stream_events', produces=['text/event-stream'])
+  @api.response(400, 'Either a wishlist_id or a user_id is expected')
+  @api.response(404, 'Wishlist not found')
+  @api.response(503, 'The worker serves too many streams, or cannot serve streams')
+  @api.expect(event_args, validate=True)
+  def get(self):
+    """
+    Stream changes
+    This endpoint will keep the response open and send an event for every change of the
+    wishlist, or of the wishlists of the user, and of their products.
+    """
+    args = event_args.parse_args()
+    wishlist_id, user_id = args['wishlist_id'], args['user_id']
+    if (wishlist_id is None) == (user_id is None):
+      abort(status.HTTP_400_BAD_REQUEST, "Either a wishlist_id or a user_id is expected")
+    # a sync worker serves one request at a time, a stream would hold it until the timeout
+    if not request.environ.get("wsgi.multithread"):
+      abort(status.HTTP_503_SERVICE_UNAVAILABLE,
+        "Event streams are only served by gevent or threaded workers")
+    current_app.logger.info("Request for the events of wishlist %s, user %s",
+      wishlist_id, user_id)
+    if wishlist_id is not None and Wishlist.find_by_id(wishlist_id) is None:
+      abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    hub = events.hub()
+    try:
+      subscription = hub.subscribe([wishlist_id] if wishlist_id is not None else [], user_id)
+    except events.SubscriberLimitError as error:
+      return {"message": str(error)}, status.HTTP_503_SERVICE_UNAVAILABLE, \
+        {"Retry-After": str(events.RETRY_MS // 1000)}
+    if user_id is not None:
+      # after subscribing, so that a wishlist created meanwhile is not missed
+      hub.watch(subscription, Wishlist.find_ids_by_user_id(user_id))
+    return Response(subscription.stream(current_app.config['EVENTS_HEARTBEAT']),
+      mimetype="text/event-stream", headers={"Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"})
+
+
+######################################################################
+#  PATH: /batch
+######################################################################
+def batch_operations() -> list:
+  """Returns the operations of a batch, as posted to POST /batch"""
+  operations = api.payload
+  if not isinstance(operations, list):
+    raise DataValidationError("Expected a json list of operations")
+  if len(operations) > MAX_OPERATIONS:
+    raise DataValidationError("At most {0} operations are expected".format(MAX_OPERATIONS))
+  for operation in operations:
+    if not isinstance(operation, dict) or operation.get("method") not in BATCH_METHODS:
+      raise DataValidationError("Every operation needs a method among {0}".format(
+        ", ".join(BATCH_METHODS)))
+    path = operation.get("path")
+    if not isinstance(path, str) or not path.startswith("/") or path.startswith("/batch"):
+      raise DataValidationError("Every operation needs the path of a route other than /batch")
+  return operations
+
+def run_operation(operation:dict) -> tuple:
+  """Runs an operation of a batch through its route, returns its status and JSON body
+
+  The route runs in the unit of work of the batch, the request hooks of the
+  app run for the batch only.
+  """
+  environ = EnvironBuilder(path=operation["path"], method=operation["method"],
+    base_url=request.url_root, json=operation.get("body")).get_environ()
+  with current_app.request_context(environ):
+    try:
+      response = current_app.dispatch_request()
+    except Exception as error: # pylint: disable=broad-except
+      response = current_app.handle_user_exception(error)
+    response = current_app.make_response(response)
+    return response.status_code, response.get_json(silent=True)
+
+@api.route('/batch')
+class BatchResource(Resource):
+  """
+  BatchResource class
+
+  Allows clients to send many writes at once
+  POST - run a list of operations in one transaction
+  """
+
+  @api.doc('run_batch')
+  @api.response(400, 'The posted operations are not valid')
+  @api.response(415, 'Unsupported media type : application/json expected')
+  @api.expect([batch_operation_model])
+  @api.marshal_with(batch_model)
+  def post(self):
+    """
+    Run a batch
+    This endpoint will run the operations in order, each like a request to its path, and
+    commit them at once. The batch stops at the first operation that fails, answers with
+    its status and commits nothing.
+    """
+    if request.headers.get("Content-Type") != "application/json":
+      abort(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, \
+        "Unsupported media type : application/json expected"
+      )
+    operations = batch_operations()
+    current_app.logger.info("Request to run a batch of %s operations", len(operations))
+    results = []
+    for position, operation in enumerate(operations):
+      code, body = run_operation(operation)
+      results.append({"status": code, "body": body})
+      if code >= 400:
+        # the batch request fails, its unit of work rolls every operation back
+        return {"results": results, "failed": position}, code
+    return {"results": results, "failed": None}, status.HTTP_200_OK
+
+
 @api.errorhandler(DataValidationError)
 def handle_data_validation_error(error):
   return {"message":error.args[0]}, status.HTTP_400_BAD_REQUEST
@@ -587,11 +1367,43 @@ def handle_data_validation_error(error):
 def handle_type_error(error):
   return {"message":error.args[0]}, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(IntegrityError)
+def handle_integrity_error(error):
+  # the unit of work of the request rolls the failed statement back
+  return {"message":conflict_message(error.orig)}, status.HTTP_409_CONFLICT
+
+def conflict_message(error) -> str:
+  """Returns the message answering a constraint violation of the database driver"""
+  if "inventory_product_id" in str(error):
+    return "The wishlist already has a product with this inventory_product_id," \
+      " post it with upsert=true to update it"
+  return "The request conflicts with the stored data"
+
+######################################################################
+# REGISTER THE ROUTES
+######################################################################
+def init_app(app):
+  """Registers the routes on an app, the Swagger spec is built on first use"""
+  app.register_blueprint(bp)
+  api.init_app(app)
+  # Reads of a client that just wrote are served by the primary
+  app.after_request(remember_write)
+
 ######################################################################
-# INITIALIZE DATABASE
+# WARM UP
 ######################################################################
-def init_db(app):
-  """Initlaize the model"""
-  db.init_app(app)
-  app.app_context().push()
-  db.create_all()
+def warm_up(app):
+  """Does the lazy work of the first requests up front, before workers fork
+
+  Builds the Swagger schema, compiles the Swagger UI templates and the URL
+  map, and configures the SQLAlchemy mappers, then closes the database
+  connections opened so far so that no worker inherits them.
+  """
+  orm.configure_mappers()
+  client = app.test_client()
+  for path in ("/swagger.json", "/apidocs/", "/info"):
+    client.get(path)
+  with app.app_context():
+    db.engine.dispose()
+    for key in app.config.get('SQLALCHEMY_BINDS') or {}:
+      db.get_engine(app, bind=key).dispose()
@@ -32,7 +32,8 @@ class ProductFactory(factory.Factory):
   pic_url = factory.LazyAttribute(lambda obj : 'www.%s.com/sth/1/png' % obj.name)
   short_desc = factory.lazy_attribute(lambda obj :\
     'this is a %s with price %s and status %s' % (obj.name , obj.price , obj.status))
-  inventory_product_id = FuzzyInteger(1, 400)
+  # distinct, a wishlist holds an inventory product once
+  inventory_product_id = factory.Sequence(lambda n : n + 1)
   in_cart_status = InCartStatus.DEFAULT
 
 class WishlistFactory(factory.Factory):
@@ -0,0 +1,114 @@
+"""
+Local stub of the inventory service
+
+Serves GET /items?ids=1,2,3 from an in-memory catalog, with HTTP/1.1
+keep-alive, for the refresher tests and benchmarks:
+
+  stub = InventoryStub({7: {"status": "AVAILABLE", "price": 9.5}}).start()
+  ...  # talk to stub.url
+  stub.stop()
+
+It can also be run on its own, with a catalog of random items:
+
+  python -m tests.inventory_stub --port 8081 --items 100000 --latency-ms 20
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class InventoryStub:
+  """An inventory service answering from a catalog of inventory_product_id -> item"""
+
+  def __init__(self, catalog:dict, latency:float=0.0, failures:int=0, port:int=0) -> None:
+    self.catalog = catalog
+    # seconds every answer is delayed by
+    self.latency = latency
+    # number of requests answered 503 before serving normally
+    self.failures = failures
+    self.requests = 0
+    self.connections = 0
+    self._lock = threading.Lock()
+    self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+    self.server.daemon_threads = True
+    self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+  def _handler(self):
+    stub = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      # headers and body are written apart, do not let the second wait for an ACK
+      disable_nagle_algorithm = True
+
+      def setup(self):
+        super().setup()
+        with stub._lock:
+          stub.connections += 1
+
+      def do_GET(self):
+        with stub._lock:
+          stub.requests += 1
+          failing = stub.failures > 0
+          stub.failures -= failing
+        if stub.latency:
+          time.sleep(stub.latency)
+        url = urlparse(self.path)
+        if url.path != "/items":
+          return self._send(404, {"message": "Not Found"})
+        if failing:
+          return self._send(503, {"message": "Service Unavailable"})
+        ids = parse_qs(url.query).get("ids", [""])[0]
+        try:
+          ids = [int(item_id) for item_id in ids.split(",") if item_id]
+        except ValueError:
+          return self._send(400, {"message": "ids should be integers"})
+        self._send(200, [dict(stub.catalog[item_id], inventory_product_id=item_id)
+          for item_id in ids if item_id in stub.catalog])
+
+      def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, *args):
+        pass
+
+    return Handler
+
+  def start(self):
+    """Serves requests in a background thread"""
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    """Stops serving and closes the socket"""
+    self.server.shutdown()
+    self.server.server_close()
+
+def random_catalog(items:int, seed:int=0) -> dict:
+  """Returns a catalog of items with random statuses and prices"""
+  rand = random.Random(seed)
+  return {item_id: {"status": rand.choice(("AVAILABLE", "UNAVAILABLE")),
+    "price": round(rand.uniform(1, 500), 2)} for item_id in range(1, items + 1)}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--port", type=int, default=8081)
+  parser.add_argument("--items", type=int, default=100000)
+  parser.add_argument("--latency-ms", type=float, default=0)
+  options = parser.parse_args()
+  stub = InventoryStub(random_catalog(options.items), latency=options.latency_ms / 1000,
+    port=options.port)
+  print("Serving {0} items on {1}".format(options.items, stub.url))
+  stub.server.serve_forever()
+
+if __name__ == "__main__":
+  main()
@@ -28,14 +28,16 @@ class TestModelUtils(unittest.TestCase):
     app.config["DEBUG"] = False
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
     app.logger.setLevel(logging.CRITICAL)
-    with app.app_context():
-      db.drop_all()
-      db.create_all()
+    cls.app_context = app.app_context()
+    cls.app_context.push()
+    db.drop_all()
+    db.create_all()
 
   @classmethod
   def tearDownClass(cls):
     """This runs once after the entire test suite"""
     db.session.close()
+    cls.app_context.pop()
 
   def setUp(self):
     """This runs before each test"""
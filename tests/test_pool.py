@@ -0,0 +1,122 @@
+"""
+Test cases for connection pool configuration and instrumentation
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import psycopg2.extensions
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+from service.models.pool import InstrumentedQueuePool, PooledSQLAlchemy, pool_stats, \
+  install_fork_guard, reset_after_fork, cooperate_with_gevent
+from service import app
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestPool(unittest.TestCase):
+  """Test Cases for the connection pool"""
+
+  def setUp(self):
+    """This runs before each test"""
+    self.db_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    self.engine = create_engine("sqlite:///" + self.db_file.name,
+      poolclass=InstrumentedQueuePool, pool_size=2, max_overflow=1, pool_timeout=0.05)
+    install_fork_guard(self.engine)
+
+  def tearDown(self):
+    """This runs after each test"""
+    self.engine.dispose()
+    os.unlink(self.db_file.name)
+
+  def test_pool_stats(self):
+    """Pool stats count checked out connections and overflow"""
+    stats = pool_stats(self.engine)
+    self.assertEqual(stats["pool_class"], "InstrumentedQueuePool")
+    self.assertEqual(stats["size"], 2)
+    self.assertEqual(stats["checked_out"], 0)
+    self.assertEqual(stats["checkouts"], 0)
+
+    conns = [self.engine.connect() for _ in range(3)]
+    stats = pool_stats(self.engine)
+    self.assertEqual(stats["checked_out"], 3)
+    self.assertEqual(stats["overflow"], 1)
+    self.assertEqual(stats["checkouts"], 3)
+
+    # the pool is exhausted, the next checkout times out
+    self.assertRaises(exc.TimeoutError, self.engine.connect)
+    stats = pool_stats(self.engine)
+    self.assertEqual(stats["timeouts"], 1)
+    self.assertGreaterEqual(stats["wait_time_max"], 0.05)
+
+    for conn in conns:
+      conn.close()
+    stats = pool_stats(self.engine)
+    self.assertEqual(stats["checked_out"], 0)
+    self.assertEqual(stats["checked_in"], 2)
+
+  def test_fork_guard(self):
+    """Connections opened by another process are never reused"""
+    conn = self.engine.connect()
+    parent_connection = conn.connection.connection
+    conn.close()
+
+    with mock.patch("service.models.pool.os.getpid", return_value=-1):
+      conn = self.engine.connect()
+      self.assertIsNot(conn.connection.connection, parent_connection)
+      conn.close()
+
+  def test_reset_after_fork(self):
+    """Engines get a fresh pool of the same kind after fork"""
+    conn = self.engine.connect()
+    conn.close()
+    old_pool = self.engine.pool
+    reset_after_fork()
+    self.assertIsNot(self.engine.pool, old_pool)
+    self.assertIsInstance(self.engine.pool, InstrumentedQueuePool)
+    self.assertEqual(self.engine.pool.size(), 2)
+    self.assertEqual(self.engine.pool.checkedin(), 0)
+
+  def test_pool_options(self):
+    """Pool settings come from the config, except for SQLite"""
+    ext = PooledSQLAlchemy()
+    config = {
+      "DATABASE_POOL_SIZE": 3,
+      "DATABASE_MAX_OVERFLOW": 4,
+      "DATABASE_POOL_RECYCLE": 60,
+      "DATABASE_POOL_TIMEOUT": 2,
+      "DATABASE_POOL_PRE_PING": True,
+    }
+    with mock.patch.dict(app.config, config):
+      options = {}
+      ext.apply_driver_hacks(app, make_url("postgresql://u:p@localhost/db"), options)
+      self.assertEqual(options["poolclass"], InstrumentedQueuePool)
+      self.assertEqual(options["pool_size"], 3)
+      self.assertEqual(options["max_overflow"], 4)
+      self.assertEqual(options["pool_recycle"], 60)
+      self.assertEqual(options["pool_timeout"], 2)
+      self.assertTrue(options["pool_pre_ping"])
+
+      options = {}
+      ext.apply_driver_hacks(app, make_url("sqlite:///local.db"), options)
+      self.assertNotIn("pool_size", options)
+
+  def test_cooperate_with_gevent(self):
+    """psycopg2 waits cooperatively only once gevent patched the process"""
+    postgres = make_url("postgresql://postgres@localhost/db")
+    with mock.patch.dict(sys.modules, {"gevent.monkey": None}):
+      self.assertFalse(cooperate_with_gevent(postgres))
+    monkey = mock.Mock(is_module_patched=lambda name: True)
+    with mock.patch.dict(sys.modules, {"gevent.monkey": monkey}):
+      self.assertFalse(cooperate_with_gevent(make_url("sqlite://")))
+      try:
+        self.assertTrue(cooperate_with_gevent(postgres))
+        self.assertIsNotNone(psycopg2.extensions.get_wait_callback())
+      finally:
+        psycopg2.extensions.set_wait_callback(None)
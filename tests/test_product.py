@@ -12,7 +12,7 @@ import json
 import logging
 import unittest
 from werkzeug.exceptions import NotFound
-from service.models.model_utils import Availability, DataValidationError, db
+from service.models.model_utils import Availability, DataValidationError, InCartStatus, db
 from service.models.product import Product
 from service.models.wishlist import Wishlist
 from service import app
@@ -39,14 +39,16 @@ class TestProductModel(unittest.TestCase):
     app.config["DEBUG"] = False
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
     app.logger.setLevel(logging.CRITICAL)
-    with app.app_context():
-      db.drop_all()
-      db.create_all()
+    cls.app_context = app.app_context()
+    cls.app_context.push()
+    db.drop_all()
+    db.create_all()
 
   @classmethod
   def tearDownClass(cls):
     """This runs once after the entire test suite"""
     db.session.close()
+    cls.app_context.pop()
 
   def setUp(self):
     """This runs before each test"""
@@ -131,6 +133,60 @@ class TestProductModel(unittest.TestCase):
     product_instance.id = None
     self.assertRaises(DataValidationError, product_instance.update)
 
+  def test_patch_a_product(self):
+    """Patch only some fields of a Product"""
+    product_instance = ProductFactory()
+    product_instance.wishlist_id = self.w_1.id
+    product_instance.create()
+    name = product_instance.name
+    wishlist_id = self.w_1.id
+
+    patched = Product.patch(wishlist_id, product_instance.id,
+      {"price": 3.5, "status": "unavailable"})
+    self.assertEqual(patched.id, product_instance.id)
+    self.assertEqual(patched.name, name)
+    self.assertEqual(patched.status, Availability.UNAVAILABLE)
+    # the loaded copy is refreshed
+    self.assertEqual(float(product_instance.price), 3.5)
+    db.session.remove()
+    self.assertEqual(float(Product.find_by_id(patched.id).price), 3.5)
+
+    self.assertIsNone(Product.patch(wishlist_id + 1, patched.id, {"price": 1}))
+    self.assertIsNone(Product.patch(wishlist_id, patched.id + 1, {"price": 1}))
+
+  def test_move_to_cart_status(self):
+    """Products move to the cart, then to ordered, in one statement each"""
+    products = ProductFactory.create_batch(3, wishlist_id=self.w_1.id,
+      status=Availability.AVAILABLE)
+    for product in products:
+      product.create()
+    product_ids = [product.id for product in products]
+    wishlist_id = self.w_1.id
+
+    moved = Product.move_to_cart_status(wishlist_id, InCartStatus.IN_CART, product_ids[:1])
+    self.assertEqual([p.id for p in moved], product_ids[:1])
+    self.assertEqual(moved[0].in_cart_status, InCartStatus.IN_CART)
+    self.assertEqual(products[0].in_cart_status, InCartStatus.IN_CART)
+    # only products in the cart can be ordered
+    moved = Product.move_to_cart_status(wishlist_id, InCartStatus.ORDERED, product_ids)
+    self.assertEqual([p.id for p in moved], product_ids[:1])
+    moved = Product.move_to_cart_status(wishlist_id, InCartStatus.IN_CART)
+    self.assertEqual([p.id for p in moved], product_ids[1:])
+    self.assertEqual(Product.move_to_cart_status(wishlist_id + 1, InCartStatus.ORDERED), [])
+
+  def test_validate_patch(self):
+    """Only the supplied fields of a patch are validated"""
+    self.assertEqual(Product.validate_patch({"price": "2", "status": 0, "pic_url": None}),
+      {"price": 2.0, "status": Availability.UNAVAILABLE, "pic_url": None})
+    self.assertEqual(Product.validate_patch({"status": "1"}),
+      {"status": Availability.AVAILABLE})
+    for data in ({}, {"id": 3}, {"wishlist_id": 3}, {"in_cart_status": "IN_CART"},
+      {"color": "red"}, {"name": None}, {"name": 3}, {"name": "x" * 65}, {"price": "x"},
+      {"status": "maybe"}, {"status": 1.5}, {"inventory_product_id": "a"},
+      {"short_desc": 3}, {"price": True}, {"inventory_product_id": 1.9},
+      {"inventory_product_id": False}):
+      self.assertRaises(DataValidationError, Product.validate_patch, data)
+
   def test_delete_a_product(self):
     """Delete a Product"""
     product_instance = ProductFactory()
@@ -162,10 +218,15 @@ class TestProductModel(unittest.TestCase):
       product.create()
 
     self.assertEqual(len(Product.find_all_by_wishlist_id(self.w_1.id)), 3)
-    Product.delete_by_wishlist_id_and_product_id(self.w_1.id, products[0].id)
+    cnt = Product.delete_by_wishlist_id_and_product_id(self.w_1.id, products[0].id)
+    self.assertEqual(cnt, 1)
 
     self.assertEqual(len(Product.find_all_by_wishlist_id(self.w_1.id)), 2)
     self.assertEqual(Product.find_by_id(products[0].id), None)
+    # a product of another wishlist is not deleted
+    cnt = Product.delete_by_wishlist_id_and_product_id(self.w_1.id + 1, products[1].id)
+    self.assertEqual(cnt, 0)
+    self.assertEqual(len(Product.find_all_by_wishlist_id(self.w_1.id)), 2)
 
   def test_serialize_a_product(self):
     """Test serialization of a Product"""
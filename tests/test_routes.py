@@ -26,11 +26,14 @@ import os
 import json
 import logging
 import unittest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event
 from service import status  # HTTP Status Codes
 from service.models.model_utils import db, Availability, InCartStatus
 from service.models.product import Product
 from service.models.wishlist import Wishlist
-from service.routes import app
+from service.routes import api, warm_up
+from service import app
 from .factories import WishlistFactory
 
 DATABASE_URI = os.getenv(
@@ -56,13 +59,15 @@ class TestWishlistsServer(unittest.TestCase):
     app.config["DEBUG"] = False
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
     app.logger.setLevel(logging.CRITICAL)
-    with app.app_context():
-      db.drop_all()
-      db.create_all()
+    cls.app_context = app.app_context()
+    cls.app_context.push()
+    db.drop_all()
+    db.create_all()
 
   @classmethod
   def tearDownClass(cls):
     db.session.close()
+    cls.app_context.pop()
 
   def setUp(self):
     """ Runs before each test """
@@ -82,6 +87,22 @@ class TestWishlistsServer(unittest.TestCase):
     self.assertEqual(data["name"], "Wishlists REST API Service")
     self.assertEqual(data["version"], "1.0")
 
+  def test_metrics(self):
+    """Test the metrics page"""
+    resp = self.app.get("/metrics")
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    data = resp.get_json()
+    self.assertIn("pool_class", data["pool"])
+
+  def test_warm_up(self):
+    """Warming up builds the Swagger schema and closes the connections"""
+    warm_up(app)
+    self.assertIn("/wishlists", api.__schema__["paths"])
+    resp = self.app.get("/swagger.json")
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    resp = self.app.get("/wishlists")
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
   def test_create_wishlist(self):
     """Create a wishlist"""
     new_wl = {"name": "test", "user_id": 1}
@@ -151,6 +172,109 @@ class TestWishlistsServer(unittest.TestCase):
     data = resp.get_json()
     self.assertEqual(len(data), 0)
 
+  def _selects(self, url):
+    statements = []
+    def record(conn, cursor, statement, *args):
+      if statement.startswith("SELECT"):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.get(url)
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    return resp.get_json(), len(statements)
+
+  def test_read_many_wishlists(self):
+    """Read many wishlists and their products in two queries"""
+    product = {"name": "mug", "price": 12.5, "status": "AVAILABLE", "inventory_product_id": 7}
+    ids = []
+    for name in ("first", "second", "third"):
+      ids.append(self.app.post(BASE_URL, json={"name": name, "user_id": 1}).get_json()["id"])
+      for inventory_product_id in (7, 8):
+        self.app.post("{0}/{1}/products".format(BASE_URL, ids[-1]),
+          json=dict(product, inventory_product_id=inventory_product_id))
+    data, selects = self._selects("{0}?ids={1},{2},100000".format(BASE_URL, ids[2], ids[0]))
+    self.assertEqual(selects, 2)
+    self.assertEqual(data, [self.app.get("{0}/{1}".format(BASE_URL, wishlist_id)).get_json()
+      for wishlist_id in (ids[0], ids[2])])
+    self.assertEqual([len(wishlist["products"]) for wishlist in data], [2, 2])
+
+    for ids in ("", "1,two", ",".join(str(i) for i in range(501))):
+      resp = self.app.get(BASE_URL, query_string={"ids": ids})
+      self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+  def test_read_many_products(self):
+    """Read many products of any wishlists in one query"""
+    product = {"name": "mug", "price": 12.5, "status": "AVAILABLE", "inventory_product_id": 7}
+    ids = []
+    for user_id, availability in ((1, "AVAILABLE"), (2, "UNAVAILABLE"), (3, "AVAILABLE")):
+      wishlist = self.app.post(BASE_URL, json={"name": "list", "user_id": user_id}).get_json()
+      ids.append(self.app.post("{0}/{1}/products".format(BASE_URL, wishlist["id"]),
+        json=dict(product, status=availability)).get_json()["id"])
+    data, selects = self._selects("/products?ids={0},{1},100000".format(ids[1], ids[0]))
+    self.assertEqual(selects, 1)
+    self.assertEqual([p["id"] for p in data], [ids[0], ids[1]])
+    data, _ = self._selects("/products?ids={0}&status=AVAILABLE".format(",".join(ids)))
+    self.assertEqual([p["id"] for p in data], [ids[0], ids[2]])
+
+    for args in ({}, {"ids": "1,two"}, {"ids": "1", "status": "SOLD"}):
+      resp = self.app.get("/products", query_string=args)
+      self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+  def test_sync_wishlists_by_userid(self):
+    """Sync the wishlists of a user from a watermark"""
+    lag = app.config["SYNC_WATERMARK_LAG"]
+    app.config["SYNC_WATERMARK_LAG"] = 0
+    self.addCleanup(app.config.update, SYNC_WATERMARK_LAG=lag)
+    product = {"name": "mug", "price": 12.5, "status": "AVAILABLE", "inventory_product_id": 7}
+    first = self.app.post(BASE_URL, json={"name": "first", "user_id": 1}).get_json()
+    second = self.app.post(BASE_URL, json={"name": "second", "user_id": 1}).get_json()
+    stranger = self.app.post(BASE_URL, json={"name": "stranger", "user_id": 2}).get_json()
+    kept, deleted = [self.app.post("{0}/{1}/products".format(BASE_URL, wishlist["id"]),
+      json=product).get_json()["id"] for wishlist in (first, second)]
+
+    resp = self.app.get(BASE_URL, query_string={"user_id": 1, "since": "0"})
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    data = resp.get_json()
+    self.assertTrue(data["full"])
+    self.assertEqual([w["id"] for w in data["wishlists"]], [first["id"], second["id"]])
+    self.assertEqual([p["id"] for p in data["products"]], [kept, deleted])
+
+    self.app.put("{0}/{1}".format(BASE_URL, first["id"]), json={"name": "renamed"})
+    added = self.app.post("{0}/{1}/products".format(BASE_URL, first["id"]),
+      json=dict(product, inventory_product_id=8)).get_json()["id"]
+    self.app.delete("{0}/{1}/products/{2}".format(BASE_URL, first["id"], kept))
+    self.app.delete("{0}/{1}".format(BASE_URL, second["id"]))
+    self.app.put("{0}/{1}".format(BASE_URL, stranger["id"]), json={"name": "renamed"})
+    resp = self.app.get(BASE_URL, query_string={"user_id": 1, "since": data["watermark"]})
+    data = resp.get_json()
+    self.assertFalse(data["full"])
+    self.assertEqual([(w["id"], w["name"]) for w in data["wishlists"]],
+      [(first["id"], "renamed")])
+    self.assertEqual([p["id"] for p in data["products"]], [added])
+    self.assertEqual(data["deleted_wishlists"], [second["id"]])
+    # the products of a deleted wishlist go with it
+    self.assertEqual(data["deleted_products"], [int(kept)])
+
+    resp = self.app.get(BASE_URL, query_string={"user_id": 1, "since": data["watermark"]})
+    data = resp.get_json()
+    self.assertEqual([data[key] for key in ("wishlists", "products", "deleted_wishlists",
+      "deleted_products")], [[], [], [], []])
+    # the same watermark with an offset
+    since = datetime.fromisoformat(data["watermark"]).replace(tzinfo=timezone.utc)
+    for since in (since, since.astimezone(timezone(timedelta(hours=2)))):
+      resp = self.app.get(BASE_URL, query_string={"user_id": 1, "since": since.isoformat()})
+      self.assertEqual(resp.status_code, status.HTTP_200_OK)
+      self.assertEqual(resp.get_json()["wishlists"], [])
+    # deletions older than the retention are gone, a sync that old lists everything
+    resp = self.app.get(BASE_URL, query_string={"user_id": 1, "since": "2020-01-01T00:00:00"})
+    self.assertTrue(resp.get_json()["full"])
+
+    for args in ({"user_id": 1, "since": "yesterday"}, {"since": "0"}):
+      resp = self.app.get(BASE_URL, query_string=args)
+      self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
   def test_delete_wishlist(self):
     """ Delete a Wishlist """
     w = WishlistFactory()
@@ -199,7 +323,7 @@ class TestWishlistsServer(unittest.TestCase):
     resp = self.app.delete("/wishlists/abc/products")
     self.assertEqual(resp.status_code,status.HTTP_400_BAD_REQUEST)
 
-    resp = self.app.get("/wishlists/1/products")
+    resp = self.app.put("/wishlists/1/products", json={})
     self.assertEqual(resp.status_code, 405)
 
   def test_delete_a_product_from_wishlist(self):
@@ -238,6 +362,23 @@ class TestWishlistsServer(unittest.TestCase):
     new_product_list = Product.find_all_by_wishlist_id(w_instance_1.id)
     self.assertEqual(len(new_product_list), 2)
 
+    # the product is deleted by a single statement, next to its change in the outbox
+    statements = []
+    def record(*args):
+      statements.append(args[2])
+    url = "/wishlists/{}/products/{}".format(w_instance_1.id, p_instance_2.id)
+    db.session.remove()
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.delete(url)
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+    self.assertEqual(len(statements), 2)
+    self.assertTrue(statements[0].startswith("DELETE FROM product"))
+    self.assertTrue(statements[1].startswith("INSERT INTO change"))
+    self.assertEqual(len(Product.find_all_by_wishlist_id(w_instance_1.id)), 1)
+
   def test_list_products_in_wishlist(self):
     """List all products in a wishlist"""
     resp = self.app.get(
@@ -286,6 +427,69 @@ class TestWishlistsServer(unittest.TestCase):
     resp_body = resp.get_json()
     self.assertEqual(len(resp_body["products"]), 0)
 
+  def _pages(self, url, **params):
+    """Returns the products of every page of a listing, page by page"""
+    pages = []
+    while True:
+      resp = self.app.get(url, query_string=params)
+      self.assertEqual(resp.status_code, status.HTTP_200_OK)
+      body = resp.get_json()
+      pages.append(body["products"])
+      if body["next"] is None:
+        return pages
+      params["after"] = body["next"]
+
+  def test_list_products_page(self):
+    """List the products of a wishlist page by page, sorted and filtered"""
+    wishlist = WishlistFactory()
+    wishlist.create()
+    url = "/wishlists/{0}/products".format(wishlist.id)
+    prices = [5, 3, 5, 1, 5, 4, 2]
+    names = ["mug", "book", "pen", "apple", "tea", "cup", "mug 2"]
+    for index, (name, price) in enumerate(zip(names, prices)):
+      Product(wishlist_id=wishlist.id, inventory_product_id=index + 1, name=name, price=price,
+        status=Availability.AVAILABLE if index % 3 else Availability.UNAVAILABLE).create()
+    other = WishlistFactory()
+    other.create()
+    Product(wishlist_id=other.id, inventory_product_id=1, name="toy", price=1,
+      status=Availability.AVAILABLE).create()
+    products = self.app.get("/wishlists/{0}".format(wishlist.id)).get_json()["products"]
+    ids = [p["id"] for p in products]
+    self.app.put("{0}/{1}/add-to-cart".format(url, ids[1]))
+    self.app.put("{0}/{1}/add-to-cart".format(url, ids[5]))
+
+    pages = self._pages(url, limit=3)
+    self.assertEqual([len(page) for page in pages], [3, 3, 1])
+    self.assertEqual([p["id"] for page in pages for p in page], ids)
+    # ties on the sort field are broken by id
+    by_price = [p["id"] for page in self._pages(url, sort="price", limit=2) for p in page]
+    self.assertEqual(by_price, [ids[3], ids[6], ids[1], ids[5], ids[0], ids[2], ids[4]])
+    by_price = [p["id"] for page in self._pages(url, sort="-price", limit=2) for p in page]
+    self.assertEqual(by_price, [ids[4], ids[2], ids[0], ids[5], ids[1], ids[6], ids[3]])
+    by_name = [p["name"] for page in self._pages(url, sort="name", limit=4) for p in page]
+    self.assertEqual(by_name, sorted(names))
+
+    pages = self._pages(url, status="AVAILABLE", sort="-name", limit=2)
+    self.assertEqual([p["name"] for page in pages for p in page],
+      ["tea", "pen", "cup", "book"])
+    pages = self._pages(url, in_cart_status="IN_CART", limit=1)
+    self.assertEqual([p["id"] for page in pages for p in page], [ids[1], ids[5]])
+
+    # a page starts after the last product read, whatever was deleted since
+    resp = self.app.get(url, query_string={"sort": "price", "limit": 2}).get_json()
+    self.app.delete("{0}/{1}".format(url, ids[1]))
+    resp = self.app.get(url, query_string={"sort": "price", "limit": 2, "after": resp["next"]})
+    self.assertEqual([p["id"] for p in resp.get_json()["products"]], [ids[5], ids[0]])
+
+    resp = self.app.get(url, query_string={"sort": "updated_at"})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.get(url, query_string={"in_cart_status": "LOST"})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.get(url, query_string={"after": "not a cursor"})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.get("/wishlists/0/products")
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
   def test_get_a_product_in_a_wishlist(self):
     """Get a product in a wishlist"""
     w_instance_1 = WishlistFactory()
@@ -564,6 +768,113 @@ class TestWishlistsServer(unittest.TestCase):
       json={'name': None}, content_type="application/json")
     self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+  def test_patch_product_in_wishlist(self):
+    """Patch a product with a single statement"""
+    w_instance_1 = WishlistFactory()
+    w_instance_1.create()
+    p_instance_1 = Product(wishlist_id=w_instance_1.id, inventory_product_id=1, name="book",\
+      price=12.5, status=Availability.AVAILABLE, short_desc="best book")
+    p_instance_1.create()
+    url = "/wishlists/{0}/products/{1}".format(w_instance_1.id, p_instance_1.id)
+    db.session.remove()
+
+    statements = []
+    def record(*args):
+      statements.append(args[2])
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.patch(url, json={'price': 9, 'status': 'UNAVAILABLE'},
+        content_type="application/json")
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    data = resp.get_json()
+    self.assertEqual((data['price'], data['status']), (9, 'UNAVAILABLE'))
+    self.assertEqual((data['name'], data['short_desc']), ('book', 'best book'))
+    # the row is not loaded first where the database has UPDATE ... RETURNING
+    self.assertTrue(statements[-2].startswith("UPDATE product"))
+    self.assertTrue(statements[-1].startswith("INSERT INTO change"))
+    self.assertEqual(len(statements), 2 if db.engine.dialect.implicit_returning else 3)
+    db_product = Product.find_by_id(p_instance_1.id)
+    self.assertEqual((db_product.price, db_product.status), (9, Availability.UNAVAILABLE))
+
+    resp = self.app.patch("/wishlists/{0}/products/{1}".format(w_instance_1.id + 1,
+      p_instance_1.id), json={'price': 1}, content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    resp = self.app.patch(url, json={'wishlist_id': 1}, content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.patch(url, json={'price': 'free'}, content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.patch(url, json={'price': True}, content_type="application/json")
+    self.assertEqual(resp.get_json()["message"], "Field price should be a number")
+    resp = self.app.patch(url, json={'inventory_product_id': 1.9},
+      content_type="application/json")
+    self.assertEqual((resp.status_code, resp.get_json()["message"]),
+      (status.HTTP_400_BAD_REQUEST, "Field inventory_product_id should be an integer"))
+    resp = self.app.patch(url, json="not a dictionary", content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.patch(url, json={'price': 1}, content_type="multipart/form-data")
+    self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    resp = self.app.patch("/wishlists/abs/products/1", json={'price': 1},
+      content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+  def test_bulk_add_to_cart_and_order(self):
+    """Move many products to the cart, then order them"""
+    w_instance_1 = WishlistFactory()
+    w_instance_1.create()
+    product_ids = []
+    for inventory_product_id, availability in enumerate((Availability.AVAILABLE,
+      Availability.AVAILABLE, Availability.UNAVAILABLE, Availability.AVAILABLE)):
+      product = Product(wishlist_id=w_instance_1.id, inventory_product_id=inventory_product_id,
+        name="book", price=12.5, status=availability)
+      product.create()
+      product_ids.append(product.id)
+    url = "/wishlists/{0}/products".format(w_instance_1.id)
+
+    resp = self.app.put(url + "/add-to-cart", json={'product_ids': product_ids[:2]})
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    self.assertEqual([p['id'] for p in resp.get_json()], [str(pid) for pid in product_ids[:2]])
+    self.assertEqual({p['in_cart_status'] for p in resp.get_json()}, {'IN_CART'})
+
+    # without product_ids, the available products not in the cart yet are moved
+    resp = self.app.put(url + "/add-to-cart")
+    self.assertEqual([p['id'] for p in resp.get_json()], [str(product_ids[3])])
+
+    resp = self.app.put(url + "/order", json={'product_ids': [product_ids[0], product_ids[2]]})
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    self.assertEqual([(p['id'], p['in_cart_status']) for p in resp.get_json()],
+      [(str(product_ids[0]), 'ORDERED')])
+    resp = self.app.put(url + "/order")
+    self.assertEqual([p['id'] for p in resp.get_json()],
+      [str(product_ids[1]), str(product_ids[3])])
+
+    statuses = [p.in_cart_status for p in Product.find_all_by_wishlist_id(w_instance_1.id)]
+    self.assertEqual(statuses, [InCartStatus.ORDERED, InCartStatus.ORDERED,
+      InCartStatus.DEFAULT, InCartStatus.ORDERED])
+
+    resp = self.app.put("/wishlists/{0}/products/add-to-cart".format(w_instance_1.id + 1))
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    resp = self.app.put("/wishlists/{0}/products/order".format(w_instance_1.id + 1))
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    # a body that is not json moves nothing, instead of every product
+    product = Product(wishlist_id=w_instance_1.id, inventory_product_id=9, name="mug",
+      price=3, status=Availability.AVAILABLE)
+    product.create()
+    resp = self.app.put(url + "/add-to-cart", data='{"product_ids": [1',
+      content_type="application/json")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    for action in ("/add-to-cart", "/order"):
+      resp = self.app.put(url + action, data='{"product_ids": []}', content_type="text/plain")
+      self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    self.assertEqual(Product.find_by_id(product.id).in_cart_status, InCartStatus.DEFAULT)
+    resp = self.app.put(url + "/add-to-cart", json={'product_ids': ['1']})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.put(url + "/order", json=[1])
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.put("/wishlists/abc/products/order")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
   def test_add_product_to_cart(self):
     """ Tests "Add product to shopcart" action on a product in a wishlist """
     w_instance_1 = WishlistFactory()
@@ -586,3 +897,255 @@ class TestWishlistsServer(unittest.TestCase):
     resp = self.app.put("/wishlists/abs/products/ebd/add-to-cart")
     self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+
+  def test_batch(self):
+    """Run many writes in one transaction"""
+    wishlist = WishlistFactory()
+    wishlist.create()
+    product = Product(wishlist_id=wishlist.id, inventory_product_id=1, name="book",
+      price=12.5, status=Availability.AVAILABLE)
+    product.create()
+    url = "/wishlists/{0}".format(wishlist.id)
+    operations = [
+      {"method": "POST", "path": BASE_URL, "body": {"name": "gifts", "user_id": 7}},
+      {"method": "PUT", "path": url, "body": {"name": "renamed"}},
+      {"method": "POST", "path": url + "/products", "body": {"name": "mug", "price": 3,
+        "status": "AVAILABLE", "inventory_product_id": 2}},
+      {"method": "PATCH", "path": "{0}/products/{1}".format(url, product.id),
+        "body": {"price": 10}},
+      {"method": "PUT", "path": "{0}/products/{1}/add-to-cart".format(url, product.id)},
+    ]
+    commits = []
+    def record(conn):
+      commits.append(conn)
+    event.listen(db.engine, "commit", record)
+    try:
+      resp = self.app.post("/batch", json=operations)
+    finally:
+      event.remove(db.engine, "commit", record)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    self.assertEqual(len(commits), 1)
+    data = resp.get_json()
+    self.assertIsNone(data["failed"])
+    self.assertEqual([result["status"] for result in data["results"]], [201, 200, 201, 200, 200])
+    self.assertEqual(data["results"][1]["body"]["name"], "renamed")
+    created = data["results"][0]["body"]["id"]
+    self.assertEqual(self.app.get("{0}/{1}".format(BASE_URL, created)).status_code,
+      status.HTTP_200_OK)
+    products = self.app.get(url).get_json()["products"]
+    self.assertEqual([(p["price"], p["in_cart_status"]) for p in products],
+      [(10, "IN_CART"), (3, "DEFAULT")])
+
+  def test_batch_rolls_back(self):
+    """A batch stops at the first failing operation and commits nothing"""
+    wishlist = WishlistFactory()
+    wishlist.create()
+    url = "/wishlists/{0}".format(wishlist.id)
+    resp = self.app.post("/batch", json=[
+      {"method": "PUT", "path": url, "body": {"name": "renamed"}},
+      {"method": "DELETE", "path": url},
+      {"method": "PUT", "path": BASE_URL + "/0", "body": {"name": "missing"}},
+      {"method": "POST", "path": BASE_URL, "body": {"name": "never", "user_id": 7}},
+    ])
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    data = resp.get_json()
+    self.assertEqual(data["failed"], 2)
+    self.assertEqual([result["status"] for result in data["results"]], [200, 204, 404])
+    resp = self.app.get(url)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    self.assertEqual(resp.get_json()["name"], wishlist.name)
+    self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+
+    for operations in ({"method": "POST"}, [{"method": "GET", "path": BASE_URL}],
+      [{"method": "POST", "path": "/batch", "body": []}], [{"method": "PUT"}],
+      [{"method": "DELETE", "path": url}] * 101):
+      resp = self.app.post("/batch", json=operations)
+      self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.post("/batch", data="[]")
+    self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+  def test_upsert_product(self):
+    """A product is added once to a wishlist, upsert updates it instead"""
+    wishlist = WishlistFactory()
+    wishlist.create()
+    url = "/wishlists/{0}/products".format(wishlist.id)
+    product = {"name": "mug", "price": 12.5, "status": "AVAILABLE", "inventory_product_id": 7}
+    resp = self.app.post(url, query_string={"upsert": "true"}, json=product)
+    self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+    created = resp.get_json()
+    self.app.put("{0}/{1}/add-to-cart".format(url, created["id"]))
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+      statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.post(url, query_string={"upsert": "true"},
+        json=dict(product, price=3, short_desc="blue"))
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    self.assertEqual(resp.headers["Location"], "http://localhost{0}/{1}".format(url,
+      created["id"]))
+    # the cart status is kept
+    self.assertEqual(resp.get_json(), dict(created, price=3, short_desc="blue",
+      in_cart_status="IN_CART"))
+    if db.engine.dialect.name == "postgresql":
+      self.assertEqual(len(statements), 2)
+      self.assertIn("ON CONFLICT (wishlist_id, inventory_product_id) DO UPDATE", statements[0])
+
+    resp = self.app.post(url, json=product)
+    self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+    other = self.app.post(url, json=dict(product, inventory_product_id=8)).get_json()
+    resp = self.app.patch("{0}/{1}".format(url, other["id"]), json={"inventory_product_id": 7})
+    self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+    resp = self.app.post(url, query_string={"upsert": "maybe"}, json=product)
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    self.assertEqual([p["inventory_product_id"] for p in self.app.get("/wishlists/{0}"
+      .format(wishlist.id)).get_json()["products"]], [7, 8])
+
+  def _add_products(self, wishlist_id, inventory_product_ids):
+    url = "/wishlists/{0}/products".format(wishlist_id)
+    return [self.app.post(url, json={"name": "item {0}".format(ipid), "price": 5,
+      "status": "AVAILABLE", "inventory_product_id": ipid}).get_json()
+      for ipid in inventory_product_ids]
+
+  def test_clone_wishlist(self):
+    """Copy a wishlist and its products in one statement"""
+    wishlist = Wishlist(name="gifts", user_id=7)
+    wishlist.create()
+    products = self._add_products(wishlist.id, [1, 2, 3])
+    self.app.put("/wishlists/{0}/products/{1}/add-to-cart".format(wishlist.id,
+      products[0]["id"]))
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+      statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.post("/wishlists/{0}/clone".format(wishlist.id))
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+    copy = resp.get_json()
+    self.assertEqual(resp.headers["Location"], "http://localhost/wishlists/{0}".format(copy["id"]))
+    self.assertEqual((copy["name"], copy["user_id"]), ("gifts 1", 7))
+    self.assertEqual([(p["inventory_product_id"], p["in_cart_status"], p["wishlist_id"])
+      for p in copy["products"]], [(1, "DEFAULT", copy["id"]), (2, "DEFAULT", copy["id"]),
+      (3, "DEFAULT", copy["id"])])
+    self.assertEqual(len([s for s in statements if s.startswith("INSERT INTO product")]), 1)
+    # the wishlist is left as it was
+    self.assertEqual(self.app.get("/wishlists/{0}".format(wishlist.id)).get_json()["products"],
+      [dict(products[0], in_cart_status="IN_CART")] + products[1:])
+
+    resp = self.app.post("/wishlists/{0}/clone".format(wishlist.id), json={"name": "gifts"})
+    self.assertEqual(resp.get_json()["name"], "gifts 2")
+    resp = self.app.post("/wishlists/{0}/clone".format(wishlist.id), json={"name": "books"})
+    self.assertEqual(resp.get_json()["name"], "books")
+    resp = self.app.post("/wishlists/{0}/clone".format(wishlist.id), json={"name": 3})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.post("/wishlists/{0}/clone".format(wishlist.id), data="name",
+      content_type="text/plain")
+    self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    resp = self.app.post("/wishlists/0/clone")
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    # the copy of a 64 character name needs a suffix that does not fit
+    long_name = Wishlist(name="n" * 64, user_id=7)
+    long_name.create()
+    resp = self.app.post("/wishlists/{0}/clone".format(long_name.id))
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.post("/wishlists/{0}/clone".format(long_name.id), json={"name": "n" * 64})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    self.assertEqual(Wishlist.find_names_by_user_id(7).count("n" * 64), 1)
+
+  def test_merge_wishlists(self):
+    """Move the products of a wishlist to another one and delete it"""
+    wishlist = Wishlist(name="gifts", user_id=7)
+    wishlist.create()
+    target = Wishlist(name="books", user_id=7)
+    target.create()
+    moved = self._add_products(wishlist.id, [1, 2])
+    kept = self._add_products(target.id, [2, 3])
+    url = "/wishlists/{0}/merge".format(wishlist.id)
+
+    resp = self.app.post(url, query_string={"into": wishlist.id})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.post(url)
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+    resp = self.app.post(url, query_string={"into": 0})
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    other = Wishlist(name="other", user_id=8)
+    other.create()
+    resp = self.app.post(url, query_string={"into": other.id})
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    resp = self.app.post(url, query_string={"into": target.id})
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    merged = resp.get_json()
+    self.assertEqual(merged["id"], target.id)
+    # the product of inventory item 2 already in the target is kept
+    self.assertEqual({(p["id"], p["inventory_product_id"], p["wishlist_id"])
+      for p in merged["products"]}, {(moved[0]["id"], 1, target.id),
+      (kept[0]["id"], 2, target.id), (kept[1]["id"], 3, target.id)})
+    resp = self.app.get("/wishlists/{0}".format(wishlist.id))
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    resp = self.app.get("/wishlists/{0}/products/{1}".format(wishlist.id, moved[1]["id"]))
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+  def test_summaries(self):
+    """Summarize the products of a wishlist and of a user in the database"""
+    wishlist = Wishlist(name="gifts", user_id=7)
+    wishlist.create()
+    other = Wishlist(name="books", user_id=7)
+    other.create()
+    empty = Wishlist(name="empty", user_id=7)
+    empty.create()
+    for index, price in enumerate([5, 12.5, 2.5]):
+      Product(wishlist_id=wishlist.id, inventory_product_id=index + 1, name="item", price=price,
+        status=Availability.UNAVAILABLE if index == 2 else Availability.AVAILABLE).create()
+    top = Product(wishlist_id=other.id, inventory_product_id=1, name="lamp", price=40,
+      status=Availability.AVAILABLE)
+    top.create()
+    products = Product.find_all_by_wishlist_id(wishlist.id)
+    self.app.put("/wishlists/{0}/products/{1}/add-to-cart".format(wishlist.id, products[0].id))
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+      statements.append(statement)
+    url = "/wishlists/{0}/summary".format(wishlist.id)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      resp = self.app.get(url)
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+    summary = resp.get_json()
+    self.assertEqual((summary["wishlist_id"], summary["item_count"], summary["total_price"],
+      summary["average_price"]), (wishlist.id, 3, 20, 20 / 3))
+    self.assertEqual(summary["by_status"], {"AVAILABLE": 2, "UNAVAILABLE": 1})
+    self.assertEqual(summary["by_in_cart_status"], {"DEFAULT": 2, "IN_CART": 1, "ORDERED": 0})
+    self.assertEqual(summary["most_expensive"]["id"], str(products[1].id))
+    # the products are counted by the database, not loaded, the wishlist is not read apart
+    queries = [s for s in statements if s.lstrip().startswith("SELECT")]
+    self.assertEqual(len(queries), 2)
+    self.assertIn("FROM wishlist LEFT OUTER JOIN product", queries[0])
+    self.assertIn("GROUP BY", queries[0])
+    summary = self.app.get("/wishlists/{0}/summary".format(empty.id)).get_json()
+    self.assertEqual((summary["item_count"], summary["total_price"], summary["average_price"],
+      summary["most_expensive"]), (0, 0, None, None))
+    self.assertEqual(summary["by_status"], {"AVAILABLE": 0, "UNAVAILABLE": 0})
+
+    summary = self.app.get("/users/7/summary").get_json()
+    self.assertEqual((summary["user_id"], summary["item_count"], summary["total_price"]),
+      (7, 4, 60))
+    self.assertEqual(summary["by_status"], {"AVAILABLE": 3, "UNAVAILABLE": 1})
+    self.assertEqual(summary["most_expensive"]["id"], str(top.id))
+    summary = self.app.get("/users/8/summary").get_json()
+    self.assertEqual((summary["item_count"], summary["total_price"], summary["average_price"],
+      summary["most_expensive"]), (0, 0, None, None))
+    self.assertEqual(summary["by_in_cart_status"], {"DEFAULT": 0, "IN_CART": 0, "ORDERED": 0})
+
+    resp = self.app.get("/wishlists/0/summary")
+    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+    resp = self.app.get("/users/x/summary")
+    self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)